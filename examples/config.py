@@ -37,6 +37,41 @@ email = 'your.email@whatever.edu'
 # to create it at startup.
 gradedb_file = '~/.schoolutils/grades.db'
 
+# Connection profile for the grade database: one of 'interactive'
+# (the default), 'interactive-wal', 'bulk-load', or 'read-only-report'.
+# These tune SQLite's journaling, caching and memory-mapping settings
+# for different kinds of work; set this to '' to use SQLite's default
+# settings.  The 'interactive-wal' and 'bulk-load' profiles switch the
+# database to SQLite's write-ahead log (WAL) mode, which makes saving
+# faster and lets reports run while you enter grades.  The switch is
+# permanent, and WAL mode does not work on network filesystems, so
+# only use these profiles if your database is stored on a local disk.
+gradedb_profile = 'interactive'
+
+# How often the grading program saves your work to the grade database.
+# Changes are committed once gradedb_commit_every changes have been
+# made, or once the oldest unsaved change is gradedb_commit_interval
+# seconds old, whichever comes first.  (The age of unsaved changes is
+# checked when you save another change or are next asked for input,
+# so while the program waits for you, recent changes stay unsaved.)
+# Changes are always committed when you return to the main menu.
+# Smaller values lose less work if the program crashes, and hold the
+# database's write lock for less time; larger values make entering
+# many grades at once a little faster.
+gradedb_commit_every = 20       # int
+gradedb_commit_interval = 10.0  # seconds
+
+# If gradedb_in_memory is True, the grading program copies your grade
+# database into memory when it opens it, and works on the copy.  This
+# makes the program much faster if the database is on a slow network
+# drive.  Saved changes are written back to the file every
+# gradedb_snapshot_interval seconds (as you save more changes), and
+# when the database is closed; if the program crashes, changes made
+# since the last write are lost.  Don't open the same database in
+# another program while this is on.
+gradedb_in_memory = False
+gradedb_snapshot_interval = 60.0  # seconds
+
 #
 # Grading options
 #
@@ -33,6 +33,11 @@ CONFIG_DEFAULTS = {
     'email': '',
     'institution': '',
     'gradedb_file': '',
+    'gradedb_profile': 'interactive',
+    'gradedb_commit_every': 20,
+    'gradedb_commit_interval': 10.0,
+    'gradedb_in_memory': False,
+    'gradedb_snapshot_interval': 60.0,
     'current_semester': '',
     'current_year': datetime.date.today().year,
     'current_courses': [],
@@ -0,0 +1,256 @@
+"""
+aio.py
+
+asyncio interface to the grade database
+"""
+# This file is part of the schoolutils package.
+# Copyright (C) 2013 Richard Lawrence <richard.lawrence@berkeley.edu>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# This module requires Python 3.5 or later; the rest of schoolutils
+# does not import it.
+
+import asyncio, threading
+from concurrent import futures
+
+from schoolutils.grading import db, pool
+
+# the db functions available as coroutines: functions which only read
+# run on the reader threads, and functions which write run on the
+# writer thread
+READ_FUNCTIONS = [
+    'select_courses', 'select_assignments', 'select_students',
+    'select_course_memberships', 'select_grades',
+    'select_grades_changed_since', 'select_grades_for_course_members',
+    'select_grade_distribution', 'get_student_id', 'grades_high_water_mark',
+    'read_changes', 'last_change_seq',
+]
+
+WRITE_FUNCTIONS = [
+    'create_course', 'create_or_update_course', 'delete_course_cascade',
+    'create_assignment', 'create_or_update_assignment',
+    'delete_assignment_cascade',
+    'create_student', 'update_student', 'create_or_update_student',
+    'upsert_students_bulk', 'delete_student_cascade',
+    'create_course_member', 'create_course_members_bulk',
+    'delete_course_member', 'delete_course_members',
+    'create_grade', 'create_grades_bulk', 'create_or_update_grade',
+    'upsert_grade', 'upsert_grades_bulk', 'create_grade_if_absent',
+    'update_grade', 'update_grades_bulk',
+]
+
+# default number of reader threads, and of calls of each kind which may
+# be waiting or running at once
+READERS = 4
+MAX_PENDING_READS = 64
+MAX_PENDING_WRITES = 16
+
+class AsyncGradeDB(object):
+    """Coroutine interface to a grade database, for asyncio programs.
+
+       Usage:
+         gradedb = AsyncGradeDB('/path/to/grades.db')
+         students = await gradedb.select_students(course_id=course_id)
+         grade_id = await gradedb.upsert_grade(assignment_id=a, student_id=s,
+                                               value='A-')
+         await gradedb.close()
+
+       Each of the functions in READ_FUNCTIONS and WRITE_FUNCTIONS is a
+       coroutine method with the same arguments as the db function, less
+       the connection.  Other db functions, or functions of your own
+       which take a connection as their first argument, can be run with
+       the read and write methods.
+
+       Blocking database work happens on threads, never on the event
+       loop: reads run on a pool of reader threads, each with its own
+       connection, and writes run one at a time on a single writer
+       thread, since SQLite only allows one writer anyway.  Each call
+       is a transaction of its own: a write which succeeds is
+       committed, and one which raises an exception is rolled back.
+       Readers see the database as of the last committed write.  In
+       SQLite's default rollback journal mode, a commit waits for
+       running reads to finish; pass profile='interactive-wal' (for a
+       database on a local disk) so that reads and writes don't block
+       each other.  Like db.connect, AsyncGradeDB uses no connection
+       profile by default.
+
+       Backpressure: at most max_pending_reads reads and
+       max_pending_writes writes may be queued or running at once.
+       Further calls wait, without blocking the event loop, for an
+       earlier one to finish.
+
+       Cancellation: cancelling a call which has not yet started
+       removes it from its queue.  Cancelling a call which is running
+       interrupts its SQL statement (see sqlite3.Connection.interrupt);
+       a write is then rolled back.
+    """
+    def __init__(self, path, readers=READERS,
+                 max_pending_reads=MAX_PENDING_READS,
+                 max_pending_writes=MAX_PENDING_WRITES,
+                 **connect_args):
+        """Open an asynchronous interface to a grade database.
+           path is the path of the grade database.
+           readers is the number of reader threads and connections.
+           max_pending_reads and max_pending_writes limit the number of
+             calls of each kind which may be queued or running at once.
+           Any other keyword arguments are passed to db.connect.
+           Connections are opened as they are needed, on the threads
+           which use them.
+        """
+        if connect_args.get('in_memory'):
+            # each thread would work on its own copy of the database
+            raise ValueError("AsyncGradeDB cannot use in-memory connections")
+        if max_pending_reads < 1 or max_pending_writes < 1:
+            raise ValueError("max_pending_reads and max_pending_writes "
+                             "must be at least 1")
+
+        self.path = path
+        self.max_pending_reads = max_pending_reads
+        self.max_pending_writes = max_pending_writes
+
+        self._read_pool = pool.ConnectionPool(path, size=readers,
+                                              timeout=None, **connect_args)
+        self._write_pool = pool.ConnectionPool(path, size=1, timeout=None,
+                                               **connect_args)
+        self._readers = futures.ThreadPoolExecutor(max_workers=readers)
+        self._writer = futures.ThreadPoolExecutor(max_workers=1)
+        # created on first use, so they belong to the running event loop
+        self._read_slots = None
+        self._write_slots = None
+        self._closed = False
+
+    async def read(self, function, *args, **kwargs):
+        """Run function(connection, *args, **kwargs) on a reader thread
+           and return its result"""
+        if self._read_slots is None:
+            self._read_slots = asyncio.Semaphore(self.max_pending_reads)
+        return await self._run(self._readers, self._read_pool,
+                               self._read_slots, function, args, kwargs)
+
+    async def write(self, function, *args, **kwargs):
+        """Run function(connection, *args, **kwargs) on the writer
+           thread, commit, and return its result"""
+        if self._write_slots is None:
+            self._write_slots = asyncio.Semaphore(self.max_pending_writes)
+        return await self._run(self._writer, self._write_pool,
+                               self._write_slots, function, args, kwargs)
+
+    async def close(self):
+        """Close the database: wait for running calls to finish, then
+           close all connections.  Calls which have not started are
+           cancelled."""
+        if self._closed:
+            return
+        self._closed = True
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._shutdown)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def _run(self, executor, connection_pool, slots, function,
+                   args, kwargs):
+        "Run a job on an executor, holding one of its slots until it finishes"
+        async with slots:
+            if self._closed:
+                raise pool.PoolClosed("Grade database is closed")
+            job = Job(connection_pool, function, args, kwargs)
+            try:
+                return await asyncio.wrap_future(executor.submit(job))
+            except asyncio.CancelledError:
+                job.cancel()
+                raise
+
+    def _shutdown(self):
+        "Stop the worker threads and close their connections"
+        for executor in (self._writer, self._readers):
+            try:
+                executor.shutdown(wait=True, cancel_futures=True)
+            except TypeError:
+                # cancel_futures requires Python 3.9
+                executor.shutdown(wait=True)
+        self._write_pool.close()
+        self._read_pool.close()
+
+class Job(object):
+    """A call to a db function, run on a worker thread with a pooled
+       connection.  A job may be cancelled from another thread: before
+       it starts, it then never runs; while it runs, its connection is
+       interrupted.
+    """
+    def __init__(self, connection_pool, function, args, kwargs):
+        self.connection_pool = connection_pool
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.connection = None
+        self.cancelled = False
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self.connection_pool.connection() as conn:
+            with self._lock:
+                if self.cancelled:
+                    raise futures.CancelledError()
+                self.connection = conn
+            try:
+                result = self.function(conn, *self.args, **self.kwargs)
+            finally:
+                with self._lock:
+                    self.connection = None
+                    cancelled = self.cancelled
+            if cancelled:
+                # cancelled between statements: roll back anyway
+                raise futures.CancelledError()
+            return result
+
+    def cancel(self):
+        "Cancel the job, interrupting its SQL statement if it is running"
+        with self._lock:
+            self.cancelled = True
+            if self.connection is not None:
+                self.connection.interrupt()
+
+#
+# coroutine versions of the db functions
+#
+def reader(name):
+    "Make a coroutine method which runs a db function on a reader thread"
+    function = getattr(db, name)
+    async def method(self, *args, **kwargs):
+        return await self.read(function, *args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = "Coroutine version of db.%s" % name
+    return method
+
+def writer(name):
+    "Make a coroutine method which runs a db function on the writer thread"
+    function = getattr(db, name)
+    async def method(self, *args, **kwargs):
+        return await self.write(function, *args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = "Coroutine version of db.%s" % name
+    return method
+
+for name in READ_FUNCTIONS:
+    setattr(AsyncGradeDB, name, reader(name))
+for name in WRITE_FUNCTIONS:
+    setattr(AsyncGradeDB, name, writer(name))
+del name
@@ -21,7 +21,21 @@ Database interface for grading utilities
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
 # 02110-1301, USA.
 
-import sys, sqlite3, datetime
+import os, re, sys, math, sqlite3, datetime, time, calendar, contextlib, collections
+
+from schoolutils.grading import calculator_helpers
+
+try:
+    from urllib import pathname2url
+except ImportError:
+    # Python 3
+    from urllib.request import pathname2url
+
+try:
+    string_types = basestring
+except NameError:
+    # Python 3
+    string_types = str
 
 class GradeDBException(Exception):
     def __init__(self, error_str, query=None, params=None): 
@@ -46,28 +60,469 @@ class NoRecordsFound(GradeDBException):
 class MultipleRecordsFound(GradeDBException):
     pass
 
-def connect(path, create=False):
+class ChangesPruned(GradeDBException):
+    pass
+
+class GradeDBConnection(sqlite3.Connection):
+    """A connection to a grade database.
+       connect returns instances of this class.  Besides everything a
+       sqlite3.Connection provides, it records the path and connection
+       profile it was opened with, whether it is read-only, and which
+       optional schema features the database has.
+    """
+    path = None
+    profile = None
+    read_only = False
+    student_search_index = False
+    unique_grades = False
+    grade_matrix = False
+    attached = ()
+    # number of statements executed, if counting; see reset_query_count
+    query_count = None
+    # QueryTracer recording the statements executed, if tracing
+    tracer = None
+    # for in-memory connections: a connection to the database file,
+    # and the state of the database when it was last written back to
+    # it; see snapshot
+    in_memory = False
+    disk = None
+    snapshot_state = None
+    snapshot_time = None
+    # nesting depth of transaction_control blocks; see in_transaction
+    transaction_depth = 0
+
+    def close(self):
+        if self.disk is not None:
+            try:
+                if in_transaction(self):
+                    # as for any connection, uncommitted changes are
+                    # discarded on close
+                    self.rollback()
+                snapshot(self)
+            finally:
+                self.disk.close()
+                self.disk = None
+        sqlite3.Connection.close(self)
+
+    def cursor(self, factory=None):
+        if factory is None:
+            factory = TracingCursor if self.tracer else GradeDBCursor
+        return sqlite3.Connection.cursor(self, factory)
+
+    # on Python 3, sqlite3.Connection.execute bypasses cursor(), so
+    # these go through it explicitly; statements are traced and
+    # counted by the cursor
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+class GradeDBCursor(sqlite3.Cursor):
+    """A cursor on a GradeDBConnection.
+       Statements executed on the cursor, or through the connection's
+       execute and executemany methods, are included in the
+       connection's query count.
+    """
+    def execute(self, sql, parameters=()):
+        if self.connection.query_count is not None:
+            self.connection.query_count += 1
+        return sqlite3.Cursor.execute(self, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        if self.connection.query_count is not None:
+            self.connection.query_count += 1
+        return sqlite3.Cursor.executemany(self, sql, seq_of_parameters)
+
+class TracingCursor(GradeDBCursor):
+    """A cursor which reports each statement it executes to its
+       connection's tracer.
+       The time recorded for a statement includes the time spent
+       fetching its rows, which is when SQLite does most of the work
+       for a SELECT.  A statement is reported once all of its rows
+       have been fetched, or when the cursor executes another
+       statement or is closed.
+    """
+    _trace = None
+
+    def execute(self, sql, parameters=()):
+        self._finish_trace()
+        start = time.time()
+        try:
+            GradeDBCursor.execute(self, sql, parameters)
+        except sqlite3.Error as e:
+            self._trace = [sql, parameters, time.time() - start, 0]
+            self._finish_trace(error=e)
+            raise
+        self._trace = [sql, parameters, time.time() - start, 0]
+        if self.description is None:
+            # not a query; there are no rows to fetch
+            self._trace[3] = max(self.rowcount, 0)
+            self._finish_trace()
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish_trace()
+        start = time.time()
+        try:
+            GradeDBCursor.executemany(self, sql, seq_of_parameters)
+        except sqlite3.Error as e:
+            self._trace = [sql, None, time.time() - start, 0]
+            self._finish_trace(error=e)
+            raise
+        self._trace = [sql, None, time.time() - start, max(self.rowcount, 0)]
+        self._finish_trace()
+        return self
+
+    def fetchone(self):
+        start = time.time()
+        row = GradeDBCursor.fetchone(self)
+        self._add_fetch(start, int(row is not None), row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        start = time.time()
+        rows = GradeDBCursor.fetchmany(self, size)
+        self._add_fetch(start, len(rows), len(rows) < size)
+        return rows
+
+    def fetchall(self):
+        start = time.time()
+        rows = GradeDBCursor.fetchall(self)
+        self._add_fetch(start, len(rows), True)
+        return rows
+
+    def __next__(self):
+        start = time.time()
+        try:
+            row = GradeDBCursor.__next__(self)
+        except StopIteration:
+            self._add_fetch(start, 0, True)
+            raise
+        self._add_fetch(start, 1, False)
+        return row
+    next = __next__ # Python 2
+
+    def close(self):
+        self._finish_trace()
+        GradeDBCursor.close(self)
+
+    def _add_fetch(self, start, num_rows, done):
+        "Add the time and rows of a fetch to the current statement's trace"
+        if self._trace:
+            self._trace[2] += time.time() - start
+            self._trace[3] += num_rows
+            if done:
+                self._finish_trace()
+
+    def _finish_trace(self, error=None):
+        "Report the current statement to the connection's tracer"
+        trace, self._trace = self._trace, None
+        tracer = self.connection.tracer
+        if trace and tracer:
+            sql, params, elapsed, num_rows = trace
+            tracer.record(self.connection, sql, params, elapsed, num_rows,
+                          error=error)
+
+def reset_query_count(db_connection):
+    """Start counting the statements executed on a connection, or
+       restart the count at zero.
+       Each call to execute or executemany counts as one statement.
+       Returns the previous count, or None if statements were not
+       being counted.
+    """
+    count = db_connection.query_count
+    db_connection.query_count = 0
+    return count
+
+#
+# query tracing
+#
+
+# statements which take at least this many seconds are logged as slow
+SLOW_QUERY_TIME = 0.1
+
+class QueryTracer(object):
+    """Records the statements executed on one or more connections.
+
+       Usage:
+         tracer = QueryTracer(log=sys.stderr)
+         db_connection = connect(path, tracer=tracer)
+         ...
+         sys.stderr.write(tracer.summary())
+
+       For each statement, the tracer records its wall-clock time and
+       the number of rows it returned or changed.  Statements are
+       aggregated by their SQL text, and by the section of the program
+       which ran them (see section); summary reports the totals.
+
+       log, if provided, should be a file-like object; a line is
+         written to it for every statement.
+       slow_query_time is a time in seconds.  Statements which take at
+         least this long are written (to log, or to sys.stderr if no
+         log is given) as slow queries, along with their query plans
+         if explain_slow is True.  None disables the slow query log.
+    """
+    def __init__(self, log=None, slow_query_time=SLOW_QUERY_TIME,
+                 explain_slow=True):
+        self.log = log
+        self.slow_query_time = slow_query_time
+        self.explain_slow = explain_slow
+        # SQL text -> [count, total time, max time, total rows]
+        self.queries = {}
+        # section name -> [count, total time]
+        self.sections = {}
+        self.current_sections = []
+
+    @contextlib.contextmanager
+    def section(self, name):
+        """Context manager: attribute the statements executed inside the
+           block to a named section of the program, such as a menu
+           action.  Sections may be nested."""
+        self.current_sections.append(name)
+        try:
+            yield self
+        finally:
+            self.current_sections.pop()
+
+    def record(self, db_connection, sql, params, elapsed, num_rows,
+               error=None):
+        "Record a statement which has finished executing"
+        # the original text is kept for EXPLAIN, since collapsing its
+        # whitespace would break any -- comments
+        text = ' '.join(sql.split())
+        stats = self.queries.setdefault(text, [0, 0.0, 0.0, 0])
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+        stats[3] += num_rows
+        section = '/'.join(self.current_sections)
+        if section:
+            section_stats = self.sections.setdefault(section, [0, 0.0])
+            section_stats[0] += 1
+            section_stats[1] += elapsed
+
+        line = "%9.3f ms %6d rows  %s%s%s%s\n" % (
+            elapsed * 1000, num_rows,
+            "[%s] " % section if section else '',
+            text,
+            "  %r" % (params,) if params else '',
+            "  ERROR: %s" % error if error else '')
+        slow = (self.slow_query_time is not None and
+                elapsed >= self.slow_query_time)
+        if self.log and not slow:
+            self.log.write(line)
+        elif slow:
+            out = self.log or sys.stderr
+            out.write("SLOW QUERY: " + line)
+            if self.explain_slow and not error:
+                for detail in explain_query_plan(db_connection, sql,
+                                                 params or ()):
+                    out.write("  plan: %s\n" % detail)
+
+    def summary(self, limit=10):
+        """Summarize the statements recorded so far.
+           Returns a string listing the time and number of statements
+           for each section, and the limit statements with the most
+           total time."""
+        lines = []
+        if self.sections:
+            lines.append("Time by section:")
+            for name, (count, total) in sorted(
+                    self.sections.items(), key=lambda i: -i[1][1]):
+                lines.append("%9.3f ms %6d queries  %s" %
+                             (total * 1000, count, name))
+        lines.append("Slowest queries (by total time):")
+        top = sorted(self.queries.items(), key=lambda i: -i[1][1])
+        for sql, (count, total, mx, num_rows) in top[:limit]:
+            lines.append("%9.3f ms total, %9.3f ms max, %6d calls, "
+                         "%6d rows  %s" %
+                         (total * 1000, mx * 1000, count, num_rows, sql))
+        return '\n'.join(lines) + '\n'
+
+def explain_query_plan(db_connection, query, params=()):
+    """Ask SQLite how it will execute a query.
+       Returns a list of strings describing the steps of the query
+       plan, e.g. 'SEARCH grades USING INDEX grades_student_idx
+       (student_id=?)', or an empty list if the statement cannot be
+       explained.  The query itself is not executed.
+    """
+    try:
+        # a plain cursor bypasses tracing and query counting; on
+        # Python 2, sqlite3.Connection.execute would not, since it
+        # goes through GradeDBConnection.cursor
+        cursor = sqlite3.Cursor(db_connection)
+        rows = cursor.execute("EXPLAIN QUERY PLAN " + query,
+                              params).fetchall()
+    except sqlite3.Error:
+        return []
+    return [r[-1] for r in rows]
+
+# size of sqlite3's per-connection cache of prepared statements;
+# sqlite3's own default is 100 (Python 2) or 128 (Python 3)
+CACHED_STATEMENTS = 256
+
+# number of rows the iter_* functions fetch from SQLite at a time
+ARRAYSIZE = 256
+
+# number of rows on each page returned by the iter_*_pages functions
+PAGE_SIZE = 50
+
+# INSERT/UPDATE ... RETURNING requires SQLite 3.35 or later; without
+# it, the id of an upserted row must be looked up with a second query
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Connection profiles: named sets of PRAGMA settings tuned for
+# different workloads.  Values are applied in the order listed in
+# PROFILE_PRAGMAS; a profile may omit any of them to keep SQLite's
+# default.  Note that journal_mode=WAL is persistent (it is stored in
+# the database file) and is not supported on network filesystems.
+PROFILE_PRAGMAS = ['journal_mode', 'synchronous', 'cache_size', 'mmap_size',
+                   'temp_store', 'query_only']
+PROFILES = {
+    # many small transactions from a single user.  This keeps the
+    # database's journal mode, so it is safe on network filesystems
+    'interactive': {
+        'cache_size': -16000,      # in KiB when negative
+        'mmap_size': 64 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+    },
+    # as 'interactive', for databases on a local disk: readers in
+    # other processes (e.g. reports) don't block or get blocked by
+    # writes, and commits are cheaper
+    'interactive-wal': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -16000,
+        'mmap_size': 64 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+    },
+    # large imports and recalculations: trade durability of the
+    # last few transactions (on power loss) for write throughput
+    'bulk-load': {
+        'journal_mode': 'WAL',
+        'synchronous': 'OFF',
+        'cache_size': -128000,
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+    },
+    # large read-only queries, e.g. generating reports
+    'read-only-report': {
+        'cache_size': -64000,
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+        'query_only': 'ON',
+    },
+}
+
+# tables every grade database must have
+REQUIRED_TABLES = ['students', 'courses', 'course_memberships',
+                   'assignments', 'grades']
+
+def connect(path, create=False, cached_statements=CACHED_STATEMENTS,
+            profile=None, read_only=False, check_same_thread=True,
+            row_type='row', tracer=None, in_memory=False):
     """Create a connection to a grade database at the given path.
        If create is True and the database lacks each of the required tables,
          initializes the database by calling gradedb_init.
-       Returns a sqlite3.Connection object appropriately initialized
+       cached_statements, if provided, sets the number of prepared
+         statements that the connection keeps for reuse.
+       profile, if provided, should be the name of a connection profile
+         in PROFILES; see apply_profile.
+       If read_only is True, the database is opened in SQLite's read-only
+         mode, and create is ignored.  A read-only connection never
+         takes a write lock, so it can be used (e.g., by a separate
+         process generating reports) while another connection is
+         entering grades; use read_transaction to read from a single
+         consistent snapshot.  The database must already be at the
+         current schema version.
+       check_same_thread is passed to sqlite3.connect; pass False only
+         if the connection will be handed between threads that never
+         use it at the same time (see schoolutils.grading.pool).
+       row_type, if provided, should be one of the row types in
+         ROW_TYPES; see set_row_type.
+       tracer, if provided, should be a QueryTracer, which will record
+         every statement executed on the connection.
+       If in_memory is True, the database is copied into memory with
+         SQLite's backup API, and every query is served from the
+         in-memory copy, which is much faster when the file is on a
+         slow (e.g., network) filesystem.  Committed changes are
+         written back to the file by snapshot, and when the
+         connection is closed; changes made since the last snapshot
+         are lost if the program crashes.  Nothing else should write
+         to the file while it is open in memory.
+       Returns a GradeDBConnection object appropriately initialized
          for the grading application.
     """
+    if profile and profile not in PROFILES:
+        raise ValueError("Unknown connection profile: %s" % profile)
+    if row_type not in ROW_TYPES:
+        raise ValueError("Unknown row type: %s" % row_type)
+    if in_memory and not HAS_BACKUP:
+        raise ConnectionError("In-memory databases require Python 3.7 "
+                              "or later (for sqlite3's backup API)")
+
     try:
-        conn = sqlite3.connect(path)
+        if in_memory:
+            if read_only:
+                disk = connect_read_only(path,
+                                         check_same_thread=check_same_thread)
+            else:
+                disk = sqlite3.connect(path,
+                                       check_same_thread=check_same_thread)
+            # opened as a URI, like read-only connections, so that
+            # attach_database can attach other databases read-only
+            conn = sqlite3.connect('file::memory:', uri=True,
+                                   cached_statements=cached_statements,
+                                   check_same_thread=check_same_thread,
+                                   factory=GradeDBConnection)
+            disk.backup(conn)
+            conn.in_memory = True
+            conn.disk = disk
+            conn.snapshot_state = snapshot_state(conn)
+            conn.snapshot_time = time.time()
+        elif read_only:
+            conn = connect_read_only(path,
+                                     cached_statements=cached_statements,
+                                     check_same_thread=check_same_thread,
+                                     factory=GradeDBConnection)
+        else:
+            conn = sqlite3.connect(path, cached_statements=cached_statements,
+                                   check_same_thread=check_same_thread,
+                                   factory=GradeDBConnection)
     except sqlite3.OperationalError as e:
         raise ConnectionError(e.args[0])
-       
+    conn.path = path
+    conn.read_only = read_only
+    conn.tracer = tracer
+    register_functions(conn)
+
+    # test that db is writeable.  This only examines file permissions,
+    # so unlike a test write, it costs no journal write or fsync
+    if not (read_only or is_writeable(path)):
+        conn.close()
+        raise ConnectionError("Database is read-only.")
+
     try:
+        if profile:
+            apply_profile(conn, profile)
+        # INSERT OR REPLACE must fire DELETE triggers for the rows it
+        # replaces, or indexes maintained by triggers go stale
+        conn.execute("PRAGMA recursive_triggers = ON;")
+        # enforce foreign keys, and let deletes cascade (see
+        # add_cascading_deletes)
+        conn.execute("PRAGMA foreign_keys = ON;")
+
         # test that db has all required tables 
-        expected_tbls = ['students', 'courses', 'course_memberships',
-                         'assignments', 'grades']
+        expected_tbls = REQUIRED_TABLES
         existing_tbls = [t[0] for t in
                          conn.execute("SELECT name FROM sqlite_master "
                                       "WHERE type='table';").fetchall()]
         missing = [t for t in expected_tbls if t not in existing_tbls]
 
-        if create and len(missing) == len(expected_tbls):
+        if create and not read_only and len(missing) == len(expected_tbls):
             # only initialize a new db when none of the tables exist;
             # any other situation indicates a data integrity problem
             # the user must resolve manually
@@ -75,24 +530,344 @@ def connect(path, create=False):
         elif missing:
             raise sqlite3.DatabaseError("Missing tables: %s" %
                                         ", ".join(missing))
+
+        # bring existing databases up to the current schema version
+        if not read_only:
+            gradedb_migrate(conn)
+        elif schema_version(conn) < SCHEMA_VERSION:
+            raise sqlite3.DatabaseError(
+                "Database schema is out of date; open it once without "
+                "read_only to upgrade it.")
+
+        conn.student_search_index = check_student_search_index(conn)
+        conn.unique_grades = has_unique_grades_index(conn)
+        conn.grade_matrix = has_grade_matrix(conn)
+
+        if in_memory:
+            # write back any migrations, or a newly created database
+            snapshot(conn)
             
     except sqlite3.DatabaseError as e:
+        if conn.disk is not None:
+            # don't write back a database which failed to open
+            conn.disk.close()
+            conn.disk = None
         conn.close()
         raise ConnectionError(e.args[0])
-
-    try:
-        # test that db is writeable
-        conn.execute("CREATE TABLE write_test (id INTEGER);")
-        conn.execute("DROP TABLE write_test;")
-        conn.commit()
-    except sqlite3.Error: # DatabaseError or OperationalError
-        conn.close()
-        raise ConnectionError("Database is read-only.")
  
-    conn.row_factory = sqlite3.Row
+    set_row_type(conn, row_type)
 
     return conn
+
+# sqlite3.Connection.backup, used by in-memory connections, requires
+# Python 3.7
+HAS_BACKUP = hasattr(sqlite3.Connection, 'backup')
+
+# number of pages snapshot copies to the database file at a time
+SNAPSHOT_PAGES = 256
+# default number of seconds between snapshots of in-memory databases
+# in the grading program
+SNAPSHOT_INTERVAL = 60.0
+
+def snapshot(db_connection, pages=SNAPSHOT_PAGES):
+    """Write an in-memory grade database (see connect) back to its file.
+       The database is copied with SQLite's backup API, pages pages at
+       a time, and only if it has changed since it was loaded or last
+       written back.  Only committed changes may be written back, so
+       there must be no open transaction.  Read-only connections are
+       never written back.
+       Returns True if the file was written.
+    """
+    if not db_connection.in_memory:
+        raise ValueError("Only in-memory databases can be snapshotted")
+    if in_transaction(db_connection):
+        raise sqlite3.ProgrammingError(
+            "Commit or roll back before writing the database to disk")
+    state = snapshot_state(db_connection)
+    if db_connection.read_only or state == db_connection.snapshot_state:
+        return False
+
+    db_connection.backup(db_connection.disk, pages=pages)
+    db_connection.snapshot_state = state
+    db_connection.snapshot_time = time.time()
+    return True
+
+def snapshot_state(db_connection):
+    """Returns a value which changes whenever a database's data or
+       schema changes"""
+    return (db_connection.total_changes,
+            db_connection.execute("PRAGMA schema_version;").fetchone()[0])
+
+# sqlite3.connect accepts URIs, such as 'file:grades.db?mode=ro', from
+# Python 3.4
+HAS_URI = sys.version_info >= (3, 4)
+
+def connect_read_only(path, **connect_args):
+    """Open a SQLite database read-only.
+       connect_args are passed to sqlite3.connect.  Where URIs are not
+       supported, the database is opened normally and writes are
+       refused with PRAGMA query_only instead.
+    """
+    if HAS_URI:
+        return sqlite3.connect("file:%s?mode=ro" % pathname2url(path),
+                               uri=True, **connect_args)
+
+    # like mode=ro, don't create a missing database
+    if not os.path.exists(path):
+        raise sqlite3.OperationalError("unable to open database file")
+    conn = sqlite3.connect(path, **connect_args)
+    conn.execute("PRAGMA query_only = ON;")
+    return conn
+
+def is_writeable(path):
+    """Determine whether a grade database file can be written to.
+       SQLite also needs to create journal files next to the database,
+       so the enclosing directory must be writeable, too.  In-memory
+       databases are always writeable.
+    """
+    if not path or path == ':memory:':
+        return True
+    path = os.path.abspath(path)
+    return (os.access(path, os.W_OK) and
+            os.access(os.path.dirname(path), os.W_OK))
+
+def apply_profile(db_connection, profile):
+    """Apply a connection profile to a grade database connection.
+       profile should be the name of a profile in PROFILES.
+       The profile's PRAGMA settings take effect immediately; this
+       function may be used to switch an open connection to a different
+       profile, e.g., before a large import.  It must not be called
+       while a transaction is open.
+       The journal_mode setting is skipped on read-only connections,
+       since it can only be changed by a writer.
+    """
+    try:
+        settings = PROFILES[profile]
+    except KeyError:
+        raise ValueError("Unknown connection profile: %s" % profile)
+
+    read_only = getattr(db_connection, 'read_only', False)
+    for pragma in PROFILE_PRAGMAS:
+        if pragma == 'journal_mode' and read_only:
+            continue
+        if pragma in settings:
+            # PRAGMA does not accept parameters:
+            db_connection.execute("PRAGMA %s = %s;" %
+                                  (pragma, settings[pragma])).fetchall()
+    if isinstance(db_connection, GradeDBConnection):
+        db_connection.profile = profile
+
+# SQL functions: grade conversions and averages from calculator_helpers,
+# registered on every connection by register_functions, so queries can
+# compute with letter grades inside SQLite.  Like SQL's own functions
+# and aggregates, these return NULL rather than NaN, and aggregates
+# skip NULLs and values they cannot convert.
+def sql_scalar(convert):
+    "Wrap a conversion function from calculator_helpers for use in SQL"
+    def function(value):
+        if value is None:
+            return None
+        try:
+            result = convert(value)
+        except (ValueError, TypeError):
+            return None
+        if isinstance(result, float) and math.isnan(result):
+            return None
+        return result
+    return function
+
+def sql_number(value):
+    """Convert a grade value to a number for a SQL aggregate:
+       numbers are unchanged, letter grades are converted to the 4.0
+       scale, and anything else is None"""
+    if isinstance(value, string_types):
+        value = calculator_helpers.letter_to_points(value)
+    if value is None or math.isnan(value):
+        return None
+    return value
+
+class WeightedAverage(object):
+    """SQL aggregate weighted_avg(value, weight): the average of the
+       values, weighted by the weights.
+       Unlike calculator_helpers.weighted_average, the result is
+       divided by the sum of the weights of the values that are
+       present, so it does not count missing grades as zeroes.
+       Letter grades are averaged on the 4.0 scale.
+    """
+    def __init__(self):
+        self.total = 0.0
+        self.weights = 0.0
+
+    def step(self, value, weight):
+        value = sql_number(value)
+        if value is None or weight is None:
+            return
+        self.total += value * weight
+        self.weights += weight
+
+    def finalize(self):
+        if not self.weights:
+            return None
+        return self.total / self.weights
+
+class LetterAverage(object):
+    """SQL aggregate letter_avg(letter): the 4.0-scale average of
+       letter grades, as computed by
+       calculator_helpers.letter_grade_average.  Grades which are not
+       letters on the scale, such as 'I', are skipped.
+    """
+    def __init__(self):
+        self.points = []
+
+    def step(self, letter):
+        points = sql_scalar(calculator_helpers.letter_to_points)(letter)
+        if points is not None:
+            self.points.append(points)
+
+    def finalize(self):
+        if not self.points:
+            return None
+        return calculator_helpers.unweighted_average(self.points)
+
+SQL_FUNCTIONS = [
+    # (name, number of arguments, function)
+    ('letter_to_points', 1, sql_scalar(calculator_helpers.letter_to_points)),
+    ('points_to_letter', 1, sql_scalar(calculator_helpers.points_to_letter)),
+    ('letter_to_percentage', 1,
+     sql_scalar(calculator_helpers.letter_to_percentage)),
+    ('percentage_to_letter', 1,
+     sql_scalar(calculator_helpers.percentage_to_letter)),
+]
+
+SQL_AGGREGATES = [
+    # (name, number of arguments, aggregate class)
+    ('weighted_avg', 2, WeightedAverage),
+    ('letter_avg', 1, LetterAverage),
+]
+
+def register_functions(db_connection):
+    """Register the grade conversion functions in SQL_FUNCTIONS and the
+       aggregates in SQL_AGGREGATES on a connection.  connect does
+       this for every connection it opens, so queries may use, e.g.:
+         SELECT points_to_letter(letter_avg(value)) FROM grades
+         WHERE assignment_id=?;
+       The scalar functions are registered as deterministic, where
+       SQLite and Python support it, so they can also be used in
+       indexes and WHERE clauses the query planner can optimize.
+    """
+    for name, num_args, function in SQL_FUNCTIONS:
+        try:
+            db_connection.create_function(name, num_args, function,
+                                          deterministic=True)
+        except (TypeError, sqlite3.NotSupportedError):
+            # deterministic requires Python 3.8 and SQLite 3.8.3
+            db_connection.create_function(name, num_args, function)
+    for name, num_args, aggregate in SQL_AGGREGATES:
+        db_connection.create_aggregate(name, num_args, aggregate)
     
+# Row types: the kinds of rows returned by select_* functions.
+#  'row': sqlite3.Row objects (the default)
+#  'record': compact, immutable tuples with a generated class for each
+#     set of result columns (see record_type); these take less memory
+#     than sqlite3.Row, which matters for large result sets
+#  'tuple': plain tuples; the smallest and fastest option, but fields
+#     can only be accessed by index, not by name
+# 'row' and 'record' rows both support access by field name, e.g.
+# row['value'], and can be passed as keyword arguments with **row.
+ROW_TYPES = ['row', 'record', 'tuple']
+
+def set_row_type(db_connection, row_type):
+    """Set the type of rows returned by queries on a connection.
+       row_type should be one of the row types in ROW_TYPES.
+       Returns the connection's previous row type.
+    """
+    previous = row_type_of(db_connection)
+    if row_type == 'row':
+        db_connection.row_factory = sqlite3.Row
+    elif row_type == 'record':
+        db_connection.row_factory = record_factory()
+    elif row_type == 'tuple':
+        db_connection.row_factory = None
+    else:
+        raise ValueError("Unknown row type: %s" % row_type)
+
+    return previous
+
+def row_type_of(db_connection):
+    "Returns the row type (see ROW_TYPES) of rows returned by a connection"
+    factory = db_connection.row_factory
+    if factory is None:
+        return 'tuple'
+    elif factory is sqlite3.Row:
+        return 'row'
+    else:
+        return 'record'
+
+@contextlib.contextmanager
+def using_row_type(db_connection, row_type):
+    """Context manager: temporarily set the type of rows returned by
+       queries on a connection (see set_row_type)."""
+    previous = set_row_type(db_connection, row_type)
+    try:
+        yield db_connection
+    finally:
+        set_row_type(db_connection, previous)
+
+def record_factory():
+    """Returns a row factory that produces compact records.
+       Each distinct set of result columns gets its own record class
+       (see record_type); the factory remembers the class for the
+       query it last saw, so looking it up costs nothing per row.
+    """
+    last = [None, None] # description, record class
+    def factory(cursor, row):
+        description = cursor.description
+        if description is not last[0]:
+            last[0] = description
+            last[1] = record_type(tuple(d[0] for d in description))
+        return tuple.__new__(last[1], row)
+    return factory
+
+_record_types = {}
+
+def record_type(fields):
+    """Returns a record class for rows with the given column names.
+       Records are namedtuples, so they use no more memory than a
+       tuple, and fields may be accessed by attribute (record.value)
+       or index (record[6]).  Like sqlite3.Row, they also support
+       access by column name (record['value']) and keys(); as with
+       sqlite3.Row, column names are not case-sensitive.
+       Classes are cached, so each set of fields generates one class.
+    """
+    try:
+        return _record_types[fields]
+    except KeyError:
+        pass
+
+    # rename=True replaces column names that are not valid Python
+    # identifiers, e.g. 'count(*)', for attribute access
+    base = collections.namedtuple('Record', fields, rename=True)
+    # the first column with a name wins, as for sqlite3.Row
+    index = dict((f.lower(), i)
+                 for i, f in reversed(list(enumerate(fields))))
+
+    class Record(base):
+        __slots__ = ()
+
+        def __getitem__(self, key):
+            if isinstance(key, string_types):
+                try:
+                    key = index[key.lower()]
+                except KeyError:
+                    raise IndexError("No item with that key")
+            return tuple.__getitem__(self, key)
+
+        def keys(self):
+            return list(fields)
+
+    _record_types[fields] = Record
+    return Record
+
 def gradedb_init(db_connection):
     """Create a new SQLite database for storing grades.
        Creates a database with tables:
@@ -101,6 +876,7 @@ def gradedb_init(db_connection):
          course_memberships (id, student_id, course_id)
          assignments (id, course_id, name, description, due_date, grade_type, points, weight)
          grades (id, assignment_id, student_id, value, timestamp)
+       and then applies all schema migrations (see gradedb_migrate).
        db_connection should be a sqlite database connection.
     """
     db_connection.executescript("""
@@ -147,8 +923,545 @@ def gradedb_init(db_connection):
       FOREIGN KEY(student_id) REFERENCES students(id)
     );
     """)
-    return db_connection.commit()
-    
+    db_connection.commit()
+    return gradedb_migrate(db_connection)
+
+#
+# schema migrations
+#
+# Each migration is a (version, migration) pair, where version is the
+# value of PRAGMA user_version once the migration has been applied.
+# A migration is either a string containing a SQL script, or a
+# callable which accepts a db_connection.  Migrations are run in
+# order, each inside its own transaction, by gradedb_migrate.  Append
+# new migrations to the end of this list; never edit or reorder
+# migrations that have already been released.
+
+STUDENT_SEARCH_TRIGGERS = """
+CREATE TRIGGER students_fts_insert AFTER INSERT ON students BEGIN
+  INSERT INTO students_fts (rowid, last_name, first_name, email)
+  VALUES (new.id, new.last_name, new.first_name, new.email);
+END;
+CREATE TRIGGER students_fts_delete AFTER DELETE ON students BEGIN
+  INSERT INTO students_fts (students_fts, rowid, last_name, first_name, email)
+  VALUES ('delete', old.id, old.last_name, old.first_name, old.email);
+END;
+CREATE TRIGGER students_fts_update AFTER UPDATE ON students BEGIN
+  INSERT INTO students_fts (students_fts, rowid, last_name, first_name, email)
+  VALUES ('delete', old.id, old.last_name, old.first_name, old.email);
+  INSERT INTO students_fts (rowid, last_name, first_name, email)
+  VALUES (new.id, new.last_name, new.first_name, new.email);
+END;
+"""
+
+def create_student_search_index(db_connection):
+    """Create a full-text index for fuzzy searches on students.
+       The index is an FTS5 table using the trigram tokenizer, so it
+       can find any substring (of at least 3 characters) of students'
+       last names, first names and emails.  Triggers on the students
+       table keep it up to date.
+       If this SQLite library lacks FTS5 or the trigram tokenizer
+       (SQLite 3.34 or later), no index is created, and select_students
+       falls back on LIKE matching.
+       Returns True if the index was created.
+    """
+    if not fts5_available(db_connection):
+        return False
+
+    execute_script(db_connection, """
+    CREATE VIRTUAL TABLE students_fts USING fts5(
+      last_name, first_name, email,
+      content='students', content_rowid='id',
+      tokenize='trigram'
+    );
+    """)
+    execute_script(db_connection, STUDENT_SEARCH_TRIGGERS)
+    db_connection.execute(
+        "INSERT INTO students_fts (students_fts) VALUES ('rebuild');")
+    return True
+
+def fts5_available(db_connection):
+    """Returns True if the SQLite library supports FTS5 tables with the
+       trigram tokenizer.
+       This reads the library's compile options rather than creating a
+       test table, so it works on read-only connections, too.  (An
+       FTS5 module loaded as an extension is not detected.)
+    """
+    if sqlite3.sqlite_version_info < (3, 34, 0):
+        return False
+    options = [r[0] for r in
+               db_connection.execute("PRAGMA compile_options;").fetchall()]
+    return 'ENABLE_FTS5' in options
+
+def has_student_search_index(db_connection):
+    "Returns True if a grade database has a full-text index on students"
+    return bool(db_connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE name='students_fts';").fetchall())
+
+def check_student_search_index(db_connection):
+    """Determine whether the full-text index on students can be used.
+       A database may have been indexed by a SQLite library with FTS5,
+       and then opened by one without it, whose student writes would
+       fail in the triggers that keep the index up to date.  So on
+       writable connections, the triggers are dropped while FTS5 is
+       unavailable, and recreated (and the index rebuilt) once it is
+       available again.  Like the migrations, this commits.
+       Returns True if the index exists and FTS5 is available.
+    """
+    if not has_student_search_index(db_connection):
+        return False
+    available = fts5_available(db_connection)
+    if db_connection.read_only:
+        return available
+
+    has_triggers = bool(db_connection.execute(
+        "SELECT 1 FROM sqlite_master "
+        "WHERE type='trigger' AND name='students_fts_insert';").fetchall())
+    if available and not has_triggers:
+        with transaction_control(db_connection):
+            execute_script(db_connection, STUDENT_SEARCH_TRIGGERS)
+            db_connection.execute(
+                "INSERT INTO students_fts (students_fts) VALUES ('rebuild');")
+        db_connection.commit()
+    elif has_triggers and not available:
+        with transaction_control(db_connection):
+            execute_script(db_connection, """
+            DROP TRIGGER students_fts_insert;
+            DROP TRIGGER students_fts_delete;
+            DROP TRIGGER students_fts_update;
+            """)
+        db_connection.commit()
+    return available
+
+def create_unique_grades_index(db_connection):
+    """Constrain the grades table to one grade per student per assignment.
+       The constraint is a unique index on (assignment_id, student_id),
+       which lets create_or_update_grade and upsert_grades_bulk save a
+       grade with a single UPSERT statement.  It replaces the plain
+       index on the same columns.
+       If the grades table already contains more than one grade for
+       some student and assignment, no index is created; see
+       find_duplicate_grades.  Without the index, grades are saved by
+       updating the most recent existing grade, or inserting a new one.
+       Returns True if the index was created.
+    """
+    if find_duplicate_grades(db_connection):
+        return False
+
+    execute_script(db_connection, """
+    CREATE UNIQUE INDEX IF NOT EXISTS grades_assignment_student_key
+      ON grades (assignment_id, student_id);
+    DROP INDEX IF EXISTS grades_assignment_student_idx;
+    """)
+    return True
+
+def has_unique_grades_index(db_connection):
+    """Returns True if a grade database allows only one grade per student
+       per assignment"""
+    return bool(db_connection.execute(
+        "SELECT 1 FROM sqlite_master "
+        "WHERE name='grades_assignment_student_key';").fetchall())
+
+def find_duplicate_grades(db_connection):
+    """Find students with more than one grade for the same assignment.
+       Returns a list of rows with fields assignment_id, student_id,
+       and num_grades.  This list must be empty before
+       create_unique_grades_index can succeed.
+    """
+    return db_connection.execute("""
+    SELECT assignment_id, student_id, count(*) AS num_grades
+    FROM grades
+    GROUP BY assignment_id, student_id
+    HAVING count(*) > 1;
+    """).fetchall()
+
+def add_cascading_deletes(db_connection):
+    """Declare the foreign keys of the course_memberships, assignments
+       and grades tables with ON DELETE CASCADE.
+       Deleting a course then also deletes its assignments and
+       memberships, and the grades for its assignments; deleting an
+       assignment or a student deletes their grades.  SQLite performs
+       these deletes itself, using the indexes on the foreign key
+       columns, as part of a single DELETE statement.
+       Rows which refer to a course, assignment or student that no
+       longer exists are unreachable by the select_* functions, and
+       would violate the foreign keys.  They are not deleted, but
+       moved to a table named orphaned_<table> (e.g.,
+       orphaned_grades), so the user can recover or discard them;
+       see orphaned_rows.
+    """
+    for table, condition in ORPHAN_CONDITIONS:
+        num_orphans = db_connection.execute(
+            "SELECT count(*) FROM %s WHERE %s;" % (table, condition)
+            ).fetchone()[0]
+        if not num_orphans:
+            continue
+        orphan_table = 'orphaned_' + table
+        db_connection.execute("CREATE TABLE IF NOT EXISTS %s AS "
+                              "SELECT * FROM %s WHERE 0;" %
+                              (orphan_table, table))
+        db_connection.execute("INSERT INTO %s SELECT * FROM %s WHERE %s;" %
+                              (orphan_table, table, condition))
+        db_connection.execute("DELETE FROM %s WHERE %s;" % (table, condition))
+    rebuild_table(db_connection, 'course_memberships', """
+    CREATE TABLE %(table)s (
+      id INTEGER PRIMARY KEY,
+      student_id INTEGER NOT NULL,
+      course_id INTEGER NOT NULL,
+      FOREIGN KEY(student_id) REFERENCES students(id) ON DELETE CASCADE,
+      FOREIGN KEY(course_id) REFERENCES courses(id) ON DELETE CASCADE,
+      UNIQUE(student_id, course_id) ON CONFLICT IGNORE
+    );
+    """)
+    rebuild_table(db_connection, 'assignments', """
+    CREATE TABLE %(table)s (
+      id INTEGER PRIMARY KEY,
+      course_id INTEGER NOT NULL,
+      name TEXT,
+      description TEXT,
+      due_date TEXT,
+      grade_type TEXT,
+      weight NUMERIC,
+      FOREIGN KEY(course_id) REFERENCES courses(id) ON DELETE CASCADE
+    );
+    """)
+    rebuild_table(db_connection, 'grades', """
+    CREATE TABLE %(table)s (
+      id INTEGER PRIMARY KEY,
+      assignment_id INTEGER NOT NULL,
+      student_id INTEGER NOT NULL,
+      -- rely on SQLite's dynamic types to store letter grades as text:
+      value NUMERIC,
+      timestamp TEXT,
+      FOREIGN KEY(assignment_id) REFERENCES assignments(id) ON DELETE CASCADE,
+      FOREIGN KEY(student_id) REFERENCES students(id) ON DELETE CASCADE
+    );
+    """)
+
+# rows which refer to a missing course, assignment or student, in the
+# order they must be moved by add_cascading_deletes: removing an
+# orphaned assignment orphans its grades
+ORPHAN_CONDITIONS = [
+    ('course_memberships',
+     "student_id IS NULL OR student_id NOT IN (SELECT id FROM students) "
+     "OR course_id IS NULL OR course_id NOT IN (SELECT id FROM courses)"),
+    ('assignments',
+     "course_id IS NULL OR course_id NOT IN (SELECT id FROM courses)"),
+    ('grades',
+     "assignment_id IS NULL OR assignment_id NOT IN (SELECT id FROM assignments) "
+     "OR student_id IS NULL OR student_id NOT IN (SELECT id FROM students)"),
+]
+
+def orphaned_rows(db_connection):
+    """Return a dictionary mapping the names of tables to the number
+       of their rows which add_cascading_deletes moved to
+       orphaned_<table>, for the tables which had any.
+    """
+    orphans = {}
+    for table, condition in ORPHAN_CONDITIONS:
+        orphan_table = 'orphaned_' + table
+        exists = db_connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?;",
+            (orphan_table,)).fetchone()
+        if exists:
+            num_rows = db_connection.execute(
+                "SELECT count(*) FROM %s;" % orphan_table).fetchone()[0]
+            if num_rows:
+                orphans[table] = num_rows
+    return orphans
+
+def normalize_grade_timestamps(db_connection):
+    """Store grade timestamps as integers, and index them.
+       Timestamps were stored as whatever the caller passed, which
+       was usually a datetime (stored by sqlite3 as ISO 8601 text),
+       but sometimes a number of seconds since the epoch.  They are
+       converted to integer microseconds since the Unix epoch (see
+       make_timestamp), so they compare correctly and can be found
+       with a range scan on the new index.  Timestamps which cannot
+       be interpreted are set to NULL.
+    """
+    rebuild_table(db_connection, 'grades', """
+    CREATE TABLE %(table)s (
+      id INTEGER PRIMARY KEY,
+      assignment_id INTEGER NOT NULL,
+      student_id INTEGER NOT NULL,
+      -- rely on SQLite's dynamic types to store letter grades as text:
+      value NUMERIC,
+      -- microseconds since the Unix epoch:
+      timestamp INTEGER,
+      FOREIGN KEY(assignment_id) REFERENCES assignments(id) ON DELETE CASCADE,
+      FOREIGN KEY(student_id) REFERENCES students(id) ON DELETE CASCADE
+    );
+    """)
+    # the INTEGER column affinity has already converted numeric
+    # strings; what remains is text, and numbers of seconds
+    rows = db_connection.execute("""
+    SELECT id, timestamp FROM grades
+    WHERE typeof(timestamp) NOT IN ('integer', 'null')
+       OR timestamp < ?;
+    """, (MAX_EPOCH_SECONDS,)).fetchall()
+    db_connection.executemany(
+        "UPDATE grades SET timestamp=? WHERE id=?;",
+        [(parse_legacy_timestamp(r[1]), r[0]) for r in rows])
+    db_connection.execute("CREATE INDEX IF NOT EXISTS grades_timestamp_idx "
+                          "ON grades (timestamp);")
+
+# timestamps smaller than this are taken to be in seconds rather than
+# microseconds (it is in the year 5138)
+MAX_EPOCH_SECONDS = 100000000000
+
+def parse_legacy_timestamp(value):
+    """Convert a timestamp stored by an older version of this module
+       to integer microseconds since the epoch.  Returns None if value
+       cannot be interpreted."""
+    if isinstance(value, string_types):
+        try:
+            value = float(value)
+        except ValueError:
+            for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S',
+                        '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+                try:
+                    return make_timestamp(
+                        datetime.datetime.strptime(value.strip(), fmt))
+                except ValueError:
+                    pass
+            return None
+    if abs(value) < MAX_EPOCH_SECONDS:
+        return int(round(value * 1000000))
+    return int(value)
+
+# The change log keeps about this many of the most recent changes;
+# older entries are pruned each time CHANGE_LOG_PRUNE_EVERY new
+# entries have been added.  (These values are written into the change
+# log's triggers when it is created.)
+CHANGE_LOG_SIZE = 100000
+CHANGE_LOG_PRUNE_EVERY = 1000
+
+# tables whose changes are recorded in the change log, and an
+# expression for the id of the course a changed row belongs to, in
+# terms of the row's old or new values
+CHANGE_LOG_TABLES = [
+    ('students', "NULL"),
+    ('course_memberships', "%(row)s.course_id"),
+    ('assignments', "%(row)s.course_id"),
+    ('grades', "(SELECT course_id FROM assignments "
+               "WHERE id=%(row)s.assignment_id)"),
+    ]
+
+def create_change_log(db_connection):
+    """Create a log of changes to students, course memberships,
+       assignments and grades.
+       Triggers on those tables append a row to the change_log table
+       for every row inserted, updated or deleted, including rows
+       deleted by cascading deletes.  Each entry has a sequence number
+       (seq), which always increases, so a consumer can ask for just
+       the changes after the last one it saw; see read_changes.
+       Triggers also prune the log, keeping about CHANGE_LOG_SIZE of
+       the most recent entries.
+    """
+    script = """
+    CREATE TABLE change_log (
+      seq INTEGER PRIMARY KEY AUTOINCREMENT,
+      table_name TEXT NOT NULL,
+      row_id INTEGER NOT NULL,
+      operation TEXT NOT NULL,
+      course_id INTEGER,
+      -- microseconds since the Unix epoch:
+      timestamp INTEGER NOT NULL
+    );
+    CREATE TRIGGER change_log_prune AFTER INSERT ON change_log
+    WHEN new.seq %% %(prune_every)d = 0 BEGIN
+      DELETE FROM change_log WHERE seq <= new.seq - %(size)d;
+    END;
+    """ % {'prune_every': CHANGE_LOG_PRUNE_EVERY, 'size': CHANGE_LOG_SIZE}
+
+    trigger = """
+    CREATE TRIGGER change_log_%(table)s_%(operation)s
+    AFTER %(event)s ON %(table)s BEGIN
+      INSERT INTO change_log
+        (table_name, row_id, operation, course_id, timestamp)
+      VALUES ('%(table)s', %(row)s.id, '%(operation)s', %(course_id)s,
+              CAST((julianday('now') - 2440587.5) * 86400000000 AS INTEGER));
+    END;
+    """
+    for table, course_id in CHANGE_LOG_TABLES:
+        for operation, row in [('insert', 'new'), ('update', 'new'),
+                               ('delete', 'old')]:
+            script += trigger % {
+                'table': table,
+                'operation': operation,
+                'event': operation.upper(),
+                'row': row,
+                'course_id': course_id % {'row': row},
+                }
+
+    execute_script(db_connection, script)
+
+def add_numeric_grade_columns(db_connection):
+    """Add numeric versions of grade values to the grades table.
+       Letter grades are stored as text in grades.value, so SQLite
+       cannot aggregate them.  The new columns points_value and
+       percent_value hold each grade as a number: numeric grades are
+       copied unchanged, and letter grades are converted using the
+       POINTS and PERCENTS scales in calculator_helpers, as
+       calculation_for_type does.  Values that cannot be converted
+       (e.g., 'I') are NULL, so AVG, MIN and MAX skip them.
+       Triggers keep the columns up to date as grades are written,
+       and indexes on (assignment_id, points_value) and
+       (assignment_id, percent_value) serve per-assignment MIN, MAX
+       and range queries.
+    """
+    points = numeric_grade_expression('new.value', calculator_helpers.POINTS)
+    percent = numeric_grade_expression('new.value', calculator_helpers.PERCENTS)
+    execute_script(db_connection, """
+    ALTER TABLE grades ADD COLUMN points_value REAL;
+    ALTER TABLE grades ADD COLUMN percent_value REAL;
+    CREATE TRIGGER grades_numeric_insert AFTER INSERT ON grades BEGIN
+      UPDATE grades SET points_value=%(points)s, percent_value=%(percent)s
+      WHERE id=new.id;
+    END;
+    CREATE TRIGGER grades_numeric_update AFTER UPDATE OF value ON grades BEGIN
+      UPDATE grades SET points_value=%(points)s, percent_value=%(percent)s
+      WHERE id=new.id;
+    END;
+    -- setting the numeric columns is not a change to the grade
+    DROP TRIGGER IF EXISTS change_log_grades_update;
+    CREATE TRIGGER change_log_grades_update
+    AFTER UPDATE OF id, assignment_id, student_id, value, timestamp ON grades BEGIN
+      INSERT INTO change_log
+        (table_name, row_id, operation, course_id, timestamp)
+      VALUES ('grades', new.id, 'update',
+              (SELECT course_id FROM assignments WHERE id=new.assignment_id),
+              CAST((julianday('now') - 2440587.5) * 86400000000 AS INTEGER));
+    END;
+    """ % {'points': points, 'percent': percent})
+    db_connection.execute("UPDATE grades SET points_value=%s, percent_value=%s;" %
+                          (numeric_grade_expression('value',
+                                                    calculator_helpers.POINTS),
+                           numeric_grade_expression('value',
+                                                    calculator_helpers.PERCENTS)))
+    execute_script(db_connection, """
+    CREATE INDEX grades_assignment_points_idx
+      ON grades (assignment_id, points_value);
+    CREATE INDEX grades_assignment_percent_idx
+      ON grades (assignment_id, percent_value);
+    """)
+
+def numeric_grade_expression(value, scale):
+    """Construct a SQL expression converting a grade value to a number.
+       value should be a SQL expression for the grade value, and scale
+       a grade scale like calculator_helpers.POINTS.  Numbers are
+       unchanged, letter grades are converted with the scale (as by
+       calculator_helpers.letter_to_number), and anything else is NULL.
+    """
+    cases = ["WHEN typeof(%s) IN ('integer', 'real') THEN %s" % (value, value)]
+    for letter, number, mx, mn in scale:
+        if number == number: # NaN has no SQL equivalent; leave it NULL
+            cases.append("WHEN %s = '%s' THEN %r" %
+                         (value, letter.replace("'", "''"), float(number)))
+    return "(CASE %s ELSE NULL END)" % ' '.join(cases)
+
+MIGRATIONS = [
+    (1, """
+    -- secondary indexes for the joins and filters used by select_*
+    -- and delete_* functions
+    CREATE INDEX IF NOT EXISTS grades_assignment_student_idx
+      ON grades (assignment_id, student_id);
+    CREATE INDEX IF NOT EXISTS grades_student_idx
+      ON grades (student_id);
+    CREATE INDEX IF NOT EXISTS assignments_course_due_date_idx
+      ON assignments (course_id, due_date);
+    CREATE INDEX IF NOT EXISTS course_memberships_course_idx
+      ON course_memberships (course_id);
+    CREATE INDEX IF NOT EXISTS courses_year_semester_idx
+      ON courses (year, semester);
+    CREATE INDEX IF NOT EXISTS students_name_idx
+      ON students (last_name, first_name);
+    """),
+    (2, create_student_search_index),
+    (3, create_unique_grades_index),
+    (4, add_cascading_deletes),
+    (5, normalize_grade_timestamps),
+    (6, create_change_log),
+    (7, add_numeric_grade_columns),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def schema_version(db_connection):
+    "Returns the schema version (PRAGMA user_version) of a grade database"
+    return db_connection.execute("PRAGMA user_version;").fetchone()[0]
+
+def gradedb_migrate(db_connection):
+    """Apply any pending schema migrations to a grade database.
+       Each migration in MIGRATIONS with a version greater than the
+         database's current PRAGMA user_version is applied, in order,
+         in its own transaction; user_version is updated in the same
+         transaction, so a failed migration leaves the database at
+         the previous version.
+       Each transaction takes the write lock as it begins (BEGIN
+         IMMEDIATE) and reads user_version again under the lock, so
+         when several connections open an old database at once, each
+         migration is applied by only one of them, and the others
+         wait for it and skip it.
+       Foreign key enforcement is turned off while migrations run, so
+         that they can rebuild tables (see rebuild_table); a migration
+         which introduces foreign key violations is rolled back.
+         (Violations already in the database are left to
+         add_cascading_deletes.)
+       Returns the schema version of the database after migrating.
+    """
+    db_connection.commit()
+    current = schema_version(db_connection)
+    if current >= SCHEMA_VERSION:
+        return current
+
+    # foreign_keys cannot be changed inside a transaction
+    foreign_keys = db_connection.execute("PRAGMA foreign_keys;").fetchone()[0]
+    db_connection.execute("PRAGMA foreign_keys = OFF;")
+    try:
+        for version, migration in MIGRATIONS:
+            if version <= current:
+                continue
+            with transaction_control(db_connection, "BEGIN IMMEDIATE;"):
+                try:
+                    # another connection may have applied this
+                    # migration since user_version was last read
+                    current = schema_version(db_connection)
+                    if version <= current:
+                        db_connection.rollback()
+                        continue
+                    violations = foreign_key_violations(db_connection)
+                    if callable(migration):
+                        migration(db_connection)
+                    else:
+                        execute_script(db_connection, migration)
+                    new_violations = sorted(
+                        foreign_key_violations(db_connection) - violations)
+                    if new_violations:
+                        raise sqlite3.IntegrityError(
+                            "Migration %d violates foreign key constraints "
+                            "on table %s" % (version, new_violations[0][0]))
+                    # PRAGMA does not accept parameters:
+                    db_connection.execute("PRAGMA user_version = %d;" %
+                                          version)
+                    db_connection.commit()
+                except sqlite3.Error:
+                    db_connection.rollback()
+                    raise
+            current = version
+    finally:
+        if foreign_keys:
+            db_connection.execute("PRAGMA foreign_keys = ON;")
+
+    return current
+
+def foreign_key_violations(db_connection):
+    """Returns the set of rows which violate foreign key constraints,
+       as (table, rowid, referenced table) tuples"""
+    return set((r[0], r[1], r[2]) for r in
+               db_connection.execute("PRAGMA foreign_key_check;").fetchall())
+
 def insert_sample_data(db_connection):
     "Insert some sample data into a grade database"
     db_connection.executescript("""
@@ -165,38 +1478,185 @@ def insert_sample_data(db_connection):
     INSERT INTO assignments VALUES (4, 1, 'Exam grade', 'Final exam', '2012-12-14', 'letter', 0.25);
     INSERT INTO assignments VALUES (5, 2, 'HW1', 'problem set', '2012-01-29', 'points', 105);
     INSERT INTO assignments VALUES (6, 2, 'HW2', 'problem set', '2012-02-05', 'points', 96);
-    INSERT INTO grades VALUES (1, 1, 1, 'C-', '1111111111');
-    INSERT INTO grades VALUES (2, 2, 1, 'B-', '1111111111');
-    INSERT INTO grades VALUES (3, 3, 1, 'A', '1111111111');
-    INSERT INTO grades VALUES (4, 4, 1, 'B+', '1111111111');
-    INSERT INTO grades VALUES (5, 1, 2, 'A', '1111111113');
-    INSERT INTO grades VALUES (6, 2, 2, 'A', '1111111113');
-    INSERT INTO grades VALUES (7, 3, 2, 'A', '1111111113');
-    INSERT INTO grades VALUES (8, 4, 2, 'A', '1111111113');
-    INSERT INTO grades VALUES (9, 5, 1, 104, '1111111113');
-    INSERT INTO grades VALUES (10, 6, 1, 90, '1111111113');
+    INSERT INTO grades (id, assignment_id, student_id, value, timestamp) VALUES (1, 1, 1, 'C-', 1111111111000000);
+    INSERT INTO grades (id, assignment_id, student_id, value, timestamp) VALUES (2, 2, 1, 'B-', 1111111111000000);
+    INSERT INTO grades (id, assignment_id, student_id, value, timestamp) VALUES (3, 3, 1, 'A', 1111111111000000);
+    INSERT INTO grades (id, assignment_id, student_id, value, timestamp) VALUES (4, 4, 1, 'B+', 1111111111000000);
+    INSERT INTO grades (id, assignment_id, student_id, value, timestamp) VALUES (5, 1, 2, 'A', 1111111113000000);
+    INSERT INTO grades (id, assignment_id, student_id, value, timestamp) VALUES (6, 2, 2, 'A', 1111111113000000);
+    INSERT INTO grades (id, assignment_id, student_id, value, timestamp) VALUES (7, 3, 2, 'A', 1111111113000000);
+    INSERT INTO grades (id, assignment_id, student_id, value, timestamp) VALUES (8, 4, 2, 'A', 1111111113000000);
+    INSERT INTO grades (id, assignment_id, student_id, value, timestamp) VALUES (9, 5, 1, 104, 1111111113000000);
+    INSERT INTO grades (id, assignment_id, student_id, value, timestamp) VALUES (10, 6, 1, 90, 1111111113000000);
     """)
     return db_connection.commit()
 
 def gradedb_clear(db_connection):
     "Drop all tables in a grade database"
+    # drop tables which refer to other tables first, so their foreign
+    # keys are not checked (or cascaded) as the tables are dropped
     db_connection.executescript("""
-    DROP TABLE students;
-    DROP TABLE courses;
+    DROP TABLE grades;
     DROP TABLE course_memberships;
     DROP TABLE assignments;
-    DROP TABLE grades;
+    DROP TABLE students;
+    DROP TABLE courses;
+    DROP TABLE IF EXISTS students_fts;
+    DROP TABLE IF EXISTS grade_matrix;
+    DROP TABLE IF EXISTS change_log;
+    DROP TABLE IF EXISTS orphaned_course_memberships;
+    DROP TABLE IF EXISTS orphaned_assignments;
+    DROP TABLE IF EXISTS orphaned_grades;
+    PRAGMA user_version = 0;
     """)
     return db_connection.commit()
     
+#
+# grade matrix
+#
+# The grade matrix is an optional table which stores, for every
+# member of every course, a row for each assignment in the course,
+# with the member's grade (if any) for that assignment.  It is the
+# result set of select_grades_for_course_members, kept up to date by
+# triggers, so that reading a course's grade table does not have to
+# join the memberships, assignments and grades tables.
+GRADE_MATRIX_SCHEMA = """
+CREATE TABLE grade_matrix (
+  course_id INTEGER NOT NULL,
+  student_id INTEGER NOT NULL,
+  assignment_id INTEGER NOT NULL,
+  grade_id INTEGER,
+  value NUMERIC,
+  PRIMARY KEY (course_id, student_id, assignment_id)
+) WITHOUT ROWID;
+CREATE TRIGGER grade_matrix_member_insert AFTER INSERT ON course_memberships BEGIN
+  INSERT OR IGNORE INTO grade_matrix
+    (course_id, student_id, assignment_id, grade_id, value)
+  SELECT new.course_id, new.student_id, assignments.id, grades.id, grades.value
+  FROM assignments
+       LEFT OUTER JOIN grades ON (grades.assignment_id=assignments.id AND grades.student_id=new.student_id)
+  WHERE assignments.course_id=new.course_id;
+END;
+CREATE TRIGGER grade_matrix_member_delete AFTER DELETE ON course_memberships BEGIN
+  DELETE FROM grade_matrix
+  WHERE course_id=old.course_id AND student_id=old.student_id;
+END;
+CREATE TRIGGER grade_matrix_member_update
+AFTER UPDATE OF student_id, course_id ON course_memberships BEGIN
+  DELETE FROM grade_matrix
+  WHERE course_id=old.course_id AND student_id=old.student_id;
+  INSERT OR IGNORE INTO grade_matrix
+    (course_id, student_id, assignment_id, grade_id, value)
+  SELECT new.course_id, new.student_id, assignments.id, grades.id, grades.value
+  FROM assignments
+       LEFT OUTER JOIN grades ON (grades.assignment_id=assignments.id AND grades.student_id=new.student_id)
+  WHERE assignments.course_id=new.course_id;
+END;
+CREATE TRIGGER grade_matrix_assignment_insert AFTER INSERT ON assignments BEGIN
+  INSERT OR IGNORE INTO grade_matrix
+    (course_id, student_id, assignment_id, grade_id, value)
+  SELECT new.course_id, course_memberships.student_id, new.id, grades.id, grades.value
+  FROM course_memberships
+       LEFT OUTER JOIN grades ON (grades.assignment_id=new.id AND grades.student_id=course_memberships.student_id)
+  WHERE course_memberships.course_id=new.course_id;
+END;
+CREATE TRIGGER grade_matrix_assignment_delete AFTER DELETE ON assignments BEGIN
+  DELETE FROM grade_matrix
+  WHERE course_id=old.course_id AND assignment_id=old.id;
+END;
+CREATE TRIGGER grade_matrix_assignment_update
+AFTER UPDATE OF id, course_id ON assignments BEGIN
+  DELETE FROM grade_matrix
+  WHERE course_id=old.course_id AND assignment_id=old.id;
+  INSERT OR IGNORE INTO grade_matrix
+    (course_id, student_id, assignment_id, grade_id, value)
+  SELECT new.course_id, course_memberships.student_id, new.id, grades.id, grades.value
+  FROM course_memberships
+       LEFT OUTER JOIN grades ON (grades.assignment_id=new.id AND grades.student_id=course_memberships.student_id)
+  WHERE course_memberships.course_id=new.course_id;
+END;
+CREATE TRIGGER grade_matrix_grade_insert AFTER INSERT ON grades BEGIN
+  UPDATE grade_matrix SET grade_id=new.id, value=new.value
+  WHERE course_id=(SELECT course_id FROM assignments WHERE id=new.assignment_id)
+    AND student_id=new.student_id AND assignment_id=new.assignment_id;
+END;
+CREATE TRIGGER grade_matrix_grade_delete AFTER DELETE ON grades BEGIN
+  UPDATE grade_matrix SET grade_id=NULL, value=NULL
+  WHERE course_id=(SELECT course_id FROM assignments WHERE id=old.assignment_id)
+    AND student_id=old.student_id AND assignment_id=old.assignment_id
+    AND grade_id=old.id;
+END;
+CREATE TRIGGER grade_matrix_grade_update
+AFTER UPDATE OF id, assignment_id, student_id, value ON grades BEGIN
+  UPDATE grade_matrix SET grade_id=NULL, value=NULL
+  WHERE course_id=(SELECT course_id FROM assignments WHERE id=old.assignment_id)
+    AND student_id=old.student_id AND assignment_id=old.assignment_id
+    AND grade_id=old.id;
+  UPDATE grade_matrix SET grade_id=new.id, value=new.value
+  WHERE course_id=(SELECT course_id FROM assignments WHERE id=new.assignment_id)
+    AND student_id=new.student_id AND assignment_id=new.assignment_id;
+END;
+INSERT INTO grade_matrix
+  (course_id, student_id, assignment_id, grade_id, value)
+SELECT course_memberships.course_id, course_memberships.student_id,
+       assignments.id, grades.id, grades.value
+FROM (course_memberships, assignments USING (course_id))
+     LEFT OUTER JOIN grades ON (course_memberships.student_id=grades.student_id AND assignments.id=grades.assignment_id);
+"""
+
+GRADE_MATRIX_TRIGGERS = [
+    'grade_matrix_member_insert', 'grade_matrix_member_delete',
+    'grade_matrix_member_update', 'grade_matrix_assignment_insert',
+    'grade_matrix_assignment_delete', 'grade_matrix_assignment_update',
+    'grade_matrix_grade_insert', 'grade_matrix_grade_delete',
+    'grade_matrix_grade_update',
+    ]
+
+def create_grade_matrix(db_connection):
+    """Create the grade matrix for a grade database.
+       Once the matrix exists, select_grades_for_course_members,
+       iter_grades_for_course_members and iter_students_with_grades
+       read from it, rather than joining the memberships, assignments
+       and grades tables, and triggers on those tables keep it up to
+       date.  The matrix is stored in the database file, so it only
+       needs to be created once.
+       The matrix holds one grade per student per assignment, so it
+       can only be created for a database with a unique grades index
+       (see create_unique_grades_index).  Like other functions in this
+       module, this does not commit.
+       Returns True if the matrix was created.
+    """
+    if not has_unique_grades_index(db_connection):
+        return False
+    if has_grade_matrix(db_connection):
+        return True
+
+    with savepoint(db_connection, 'create_grade_matrix'):
+        execute_script(db_connection, GRADE_MATRIX_SCHEMA)
+    db_connection.grade_matrix = True
+    return True
+
+def drop_grade_matrix(db_connection):
+    """Drop the grade matrix and its triggers from a grade database.
+       Like other functions in this module, this does not commit."""
+    with savepoint(db_connection, 'drop_grade_matrix'):
+        for trigger in GRADE_MATRIX_TRIGGERS:
+            db_connection.execute("DROP TRIGGER IF EXISTS %s;" % trigger)
+        db_connection.execute("DROP TABLE IF EXISTS grade_matrix;")
+    db_connection.grade_matrix = False
+
+def has_grade_matrix(db_connection):
+    "Returns True if a grade database has a grade matrix"
+    return bool(db_connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE name='grade_matrix';").fetchall())
+
 #
 # basic CRUD operations and some convenience interfaces
 #
-def select_courses(db_connection, course_id=None, year=None, semester=None,
-                   name=None, number=None, student_id=None):
-    """Return a result set of courses.
-       Rows in the result set have the format:
-       (id, name, number, year, semester)
+def courses_query(db_connection, course_id=None, year=None, semester=None,
+                  name=None, number=None, student_id=None):
+    """Construct the query and parameters for select_courses
+       and iter_courses.
     """
     if not student_id:
         # don't perform a join without student information
@@ -220,8 +1680,28 @@ def select_courses(db_connection, course_id=None, year=None, semester=None,
         [course_id, year, semester, name, number, student_id])
     query = add_where_clause(base_query, constraints)
     
+    return query, params
+
+def select_courses(db_connection, course_id=None, year=None, semester=None,
+                   name=None, number=None, student_id=None):
+    """Return a result set of courses.
+       Rows in the result set have the format:
+       (id, name, number, year, semester)
+    """
+    query, params = courses_query(
+        db_connection,
+        course_id=course_id, year=year, semester=semester, name=name,
+        number=number, student_id=student_id)
     return db_connection.execute(query, params).fetchall()
 
+def iter_courses(db_connection, arraysize=ARRAYSIZE, **filters):
+    """Return an iterator over the rows selected by select_courses.
+       Accepts the same arguments as select_courses, passed
+       as keyword arguments; see iter_query.
+    """
+    query, params = courses_query(db_connection, **filters)
+    return iter_query(db_connection, query, params, arraysize=arraysize)
+
 def create_course(db_connection, year=None, semester=None, name=None,
                   number=None):
     """Create a new course in the database.
@@ -234,31 +1714,24 @@ def create_course(db_connection, year=None, semester=None, name=None,
         ['year', 'semester', 'name', 'number'],
         [year, semester, name, number])
     query = base_query % {'fields': fields, 'places': places}
-    db_connection.execute(query, params)
-
-    return last_insert_rowid(db_connection)
+    return db_connection.execute(query, params).lastrowid
 
 def create_or_update_course(db_connection, course_id=None, year=None,
                             semester=None, name=None, number=None):
     """Create a new course or update a record of an existing course.
        Returns the id of the created or updated row.
 
-       WARNING: This function uses SQLite's INSERT OR REPLACE
-       statement rather than an UPDATE statement.  If you pass
-       course_id, it *will* erase data in an existing row of the
-       courses table on a conflict; you must provide all values to
-       replace the existing data.
-    """
-    base_query = """
-    INSERT OR REPLACE INTO courses (%(fields)s) VALUES (%(places)s);
+       If you pass course_id and a course with that id exists, it is
+       updated in place with the values you provide; values you do
+       not provide are left unchanged.
     """
-    fields, places, params = make_values_clause(
+    query, params = make_upsert_query(
+        'courses', ['id'],
         ['id', 'year', 'semester', 'name', 'number'],
         [course_id, year, semester, name, number])
-    query = base_query % {'fields': fields, 'places': places}
-    db_connection.execute(query, params)
+    cursor = db_connection.execute(query, params)
 
-    return last_insert_rowid(db_connection)
+    return course_id or cursor.lastrowid
 
 def delete_course_etc(db_connection, course_id=None):
     """Delete a course and all associated rows.
@@ -269,36 +1742,45 @@ def delete_course_etc(db_connection, course_id=None):
        course_id is required; this function will not delete more than
        one course.
     """
+    return delete_course_cascade(db_connection, course_id=course_id)['courses']
+
+def delete_course_cascade(db_connection, course_id=None):
+    """Delete a course and all associated rows.
+       The course's assignments and memberships, and the grades for its
+       assignments, are deleted by the foreign keys' ON DELETE CASCADE
+       actions, as part of a single DELETE statement.
+       Returns a dictionary mapping each table name to the number of
+       rows deleted from that table.
+
+       course_id is required; this function will not delete more than
+       one course.
+    """
     if not course_id:
         raise ValueError("course_id is required to delete course row.")
-    
-    grades_query = """
-    DELETE FROM grades WHERE assignment_id IN
-      (SELECT id FROM assignments WHERE course_id=?);
-    """
-    assignments_query = """
-    DELETE FROM assignments WHERE course_id=?;
-    """
-    members_query = """
-    DELETE FROM course_memberships WHERE course_id=?;
-    """
-    course_query = """
-    DELETE FROM courses WHERE id=?;
-    """
-    params = (course_id,)
-    db_connection.execute(grades_query, params)
-    db_connection.execute(assignments_query, params)
-    db_connection.execute(members_query, params)
-    db_connection.execute(course_query, params)
 
-    return num_changes(db_connection)   
+    counts_query = """
+    SELECT (SELECT count(*) FROM assignments WHERE course_id=:id),
+           (SELECT count(*) FROM course_memberships WHERE course_id=:id),
+           (SELECT count(*) FROM grades, assignments
+            ON grades.assignment_id=assignments.id
+            WHERE assignments.course_id=:id);
+    """
+    params = {'id': course_id}
+    with savepoint(db_connection):
+        counts = db_connection.execute(counts_query, params).fetchone()
+        num_courses = db_connection.execute(
+            "DELETE FROM courses WHERE id=:id;", params).rowcount
+
+    if not num_courses:
+        return {'courses': 0, 'assignments': 0, 'course_memberships': 0,
+                'grades': 0}
+    return {'courses': num_courses, 'assignments': counts[0],
+            'course_memberships': counts[1], 'grades': counts[2]}
     
-def select_assignments(db_connection, assignment_id=None, course_id=None,
-                       year=None, semester=None, name=None):
-    """Return a result set of assignments.
-       The rows in the result set have the format:
-       (assignment_id, course_id, assignment_name, due_date, grade_type, weight,
-         description)
+def assignments_query(db_connection, assignment_id=None, course_id=None,
+                      year=None, semester=None, name=None):
+    """Construct the query and parameters for select_assignments
+       and iter_assignments.
     """
     base_query = """
     SELECT assignments.id, courses.id AS course_id,
@@ -316,8 +1798,29 @@ def select_assignments(db_connection, assignment_id=None, course_id=None,
         [assignment_id, year, semester, course_id, name])
     query = add_where_clause(base_query, constraints)
     
+    return query, params
+
+def select_assignments(db_connection, assignment_id=None, course_id=None,
+                       year=None, semester=None, name=None):
+    """Return a result set of assignments.
+       The rows in the result set have the format:
+       (assignment_id, course_id, assignment_name, due_date, grade_type, weight,
+         description)
+    """
+    query, params = assignments_query(
+        db_connection,
+        assignment_id=assignment_id, course_id=course_id, year=year,
+        semester=semester, name=name)
     return db_connection.execute(query, params).fetchall()
 
+def iter_assignments(db_connection, arraysize=ARRAYSIZE, **filters):
+    """Return an iterator over the rows selected by select_assignments.
+       Accepts the same arguments as select_assignments, passed
+       as keyword arguments; see iter_query.
+    """
+    query, params = assignments_query(db_connection, **filters)
+    return iter_query(db_connection, query, params, arraysize=arraysize)
+
 def create_assignment(db_connection, course_id=None, name=None, description=None,
                       due_date=None, grade_type=None, weight=None):
     """Create a new assignment in the database.
@@ -330,9 +1833,7 @@ def create_assignment(db_connection, course_id=None, name=None, description=None
         ['course_id', 'name', 'description', 'due_date', 'grade_type', 'weight'],
         [course_id, name, description, due_date, grade_type, weight])
     query = base_query % {'fields': fields, 'places': places}
-    db_connection.execute(query, params)
-
-    return last_insert_rowid(db_connection)
+    return db_connection.execute(query, params).lastrowid
   
 def create_or_update_assignment(db_connection, assignment_id=None,
                                 course_id=None, name=None, description=None,
@@ -340,25 +1841,20 @@ def create_or_update_assignment(db_connection, assignment_id=None,
     """Create a new assignment or update a record of an existing assignment.
        Returns the id of the created or updated row.
 
-       WARNING: This function uses SQLite's INSERT OR REPLACE
-       statement rather than an UPDATE statement.  If you pass
-       assignment_id, it *will* erase data in an existing row of the
-       assignments table on a conflict; you must provide all values to
-       replace the existing data.
+       If you pass assignment_id and an assignment with that id
+       exists, it is updated in place with the values you provide;
+       values you do not provide are left unchanged.  course_id is
+       always required, since it is needed to create a new row.
     """
-    base_query = """
-    INSERT OR REPLACE INTO assignments (%(fields)s) VALUES (%(places)s);
-    """
-    fields, places, params = make_values_clause(
+    query, params = make_upsert_query(
+        'assignments', ['id'],
         ['id', 'course_id', 'name', 'description', 'due_date',
          'grade_type', 'weight'],
         [assignment_id, course_id, name, description, due_date,
          grade_type, weight])
+    cursor = db_connection.execute(query, params)
     
-    query = base_query % {'fields': fields, 'places': places}
-    db_connection.execute(query, params)
-    
-    return last_insert_rowid(db_connection)
+    return assignment_id or cursor.lastrowid
 
 def delete_assignment_and_grades(db_connection, assignment_id=None):
     """Delete an assignment and all associated grades.
@@ -367,29 +1863,75 @@ def delete_assignment_and_grades(db_connection, assignment_id=None):
        assignment_id is required; this function will not delete more than
        one assignment.
     """
+    return delete_assignment_cascade(
+        db_connection, assignment_id=assignment_id)['assignments']
+
+def delete_assignment_cascade(db_connection, assignment_id=None):
+    """Delete an assignment and all associated grades.
+       The grades are deleted by the foreign key's ON DELETE CASCADE
+       action, as part of a single DELETE statement.
+       Returns a dictionary mapping each table name to the number of
+       rows deleted from that table.
+
+       assignment_id is required; this function will not delete more than
+       one assignment.
+    """
     if not assignment_id:
         raise ValueError("assignment_id is required to delete assignment row.")
-    
-    query1 = "DELETE FROM grades WHERE assignment_id=?;"
-    query2 = "DELETE FROM assignments WHERE id=?;"
-    params = (assignment_id,)
-    db_connection.execute(query1, params)
-    db_connection.execute(query2, params)
-
-    return num_changes(db_connection)
 
-def select_students(db_connection, student_id=None, year=None, semester=None,
-                    course_id=None, course_name=None, last_name=None,
-                    first_name=None, sid=None, email=None,
-                    fuzzy=False):
-    """Return a result set of students.
-       The rows in the result set have the format:
-       (student_id, last_name, first_name, sid, email)
-       If fuzzy is True, this function will use SQLite's LIKE clause to perform 
-         case-insensitive fuzzy matching on last_name, first_name, email, and
-         course_name fields 
+    params = (assignment_id,)
+    with savepoint(db_connection):
+        num_grades = db_connection.execute(
+            "SELECT count(*) FROM grades WHERE assignment_id=?;",
+            params).fetchone()[0]
+        num_assignments = db_connection.execute(
+            "DELETE FROM assignments WHERE id=?;", params).rowcount
+
+    return {'assignments': num_assignments,
+            'grades': num_grades if num_assignments else 0}
+
+def students_query(db_connection, student_id=None, year=None, semester=None,
+                   course_id=None, course_name=None, last_name=None,
+                   first_name=None, sid=None, email=None,
+                   fuzzy=False, after=None, limit=None):
+    """Construct the query and parameters for select_students
+       and iter_students.
     """
-    if course_id or course_name: 
+    # search the full-text index for terms long enough to be indexed
+    # as trigrams; shorter terms are LIKE-matched as usual.  Results
+    # ranked by relevance cannot be paged by name, so paged searches
+    # always use LIKE.
+    paged = after is not None or limit is not None
+    match_terms = []
+    if (fuzzy and not paged and
+        getattr(db_connection, 'student_search_index', False)):
+        for col, val in [('last_name', last_name), ('first_name', first_name),
+                         ('email', email)]:
+            if val and len(val) >= 3:
+                match_terms.append((col, val))
+    use_index = bool(match_terms)
+
+    if use_index and (course_id or course_name):
+        base_query = """
+        SELECT students.id, students.last_name, students.first_name,
+               students.sid, students.email
+        FROM students_fts
+             JOIN students ON students.id=students_fts.rowid
+             JOIN course_memberships ON course_memberships.student_id=students.id
+             JOIN courses ON course_memberships.course_id=courses.id
+        %(where)s
+        ORDER BY students_fts.rank, students.last_name ASC, students.first_name ASC
+        """
+    elif use_index:
+        base_query = """
+        SELECT students.id, students.last_name, students.first_name,
+               students.sid, students.email
+        FROM students_fts
+             JOIN students ON students.id=students_fts.rowid
+        %(where)s
+        ORDER BY students_fts.rank, students.last_name ASC, students.first_name ASC
+        """
+    elif course_id or course_name: 
         base_query = """
         SELECT students.id, students.last_name, students.first_name,
                students.sid, students.email
@@ -397,7 +1939,8 @@ def select_students(db_connection, student_id=None, year=None, semester=None,
         ON (course_memberships.student_id=students.id AND
             course_memberships.course_id=courses.id)
         %(where)s
-        ORDER BY students.last_name ASC, students.first_name ASC
+        ORDER BY students.last_name ASC, students.first_name ASC,
+                 students.id ASC
         """
     else:
         # don't perform a join without any course information to constrain the query:
@@ -407,7 +1950,8 @@ def select_students(db_connection, student_id=None, year=None, semester=None,
                students.sid, students.email
         FROM students
         %(where)s
-        ORDER BY students.last_name ASC, students.first_name ASC
+        ORDER BY students.last_name ASC, students.first_name ASC,
+                 students.id ASC
         """
 
     exact_fields = ['courses.year', 'courses.semester', 'courses.id',
@@ -416,12 +1960,20 @@ def select_students(db_connection, student_id=None, year=None, semester=None,
     fuzzy_fields = ['students.last_name', 'students.first_name', 'students.email',
                     'courses.name']
     fuzzy_vals = [last_name, first_name, email, course_name]
+    match_expr = None
        
     if not fuzzy:
         exact_fields = exact_fields + fuzzy_fields
         exact_vals = exact_vals + fuzzy_vals
         fuzzy_fields = fuzzy_vals = []
-    else:    
+    else:
+        if use_index:
+            indexed = [c for c, v in match_terms]
+            fuzzy_vals = [None if f.split('.')[1] in indexed else v
+                          for f, v in zip(fuzzy_fields, fuzzy_vals)]
+            match_expr = " AND ".join('%s : "%s"' % (c, v.replace('"', '""'))
+                                      for c, v in match_terms)
+
         # for now, just assume that we should glob on both left and
         # right of every field with a LIKE constraint
         add_glob = lambda s: '%' + s + '%' if s else s
@@ -432,11 +1984,74 @@ def select_students(db_connection, student_id=None, year=None, semester=None,
                                                   extra=constraints,
                                                   extra_params=params,
                                                   cmp_op="LIKE")
+    constraints, params = make_conjunction_clause(['students_fts'], [match_expr],
+                                                  extra=constraints,
+                                                  extra_params=params,
+                                                  cmp_op="MATCH")
+    if after is not None:
+        constraints, params = make_keyset_clause(
+            ['students.last_name', 'students.first_name', 'students.id'],
+            after, extra=constraints, extra_params=params)
 
     query = add_where_clause(base_query, constraints)
+    query, params = add_limit_clause(query, params, limit)
     
+    return query, params
+
+def select_students(db_connection, student_id=None, year=None, semester=None,
+                    course_id=None, course_name=None, last_name=None,
+                    first_name=None, sid=None, email=None,
+                    fuzzy=False, after=None, limit=None):
+    """Return a result set of students.
+       The rows in the result set have the format:
+       (student_id, last_name, first_name, sid, email)
+       If fuzzy is True, this function performs case-insensitive fuzzy
+         matching on last_name, first_name, email, and course_name
+         fields.  When the database has a full-text index on students
+         (see create_student_search_index), name and email searches of
+         3 or more characters use the index, and results are ordered
+         by relevance; otherwise, SQLite's LIKE clause is used.
+       after and limit page through the results, which are then
+         ordered by name: after, if given, should be the tuple
+         (last_name, first_name, student_id) of the last student on
+         the previous page, and limit is the number of students on a
+         page.  Each page is found with the name index, so it costs
+         the same however far into the roster it is; see
+         iter_student_pages.
+    """
+    query, params = students_query(
+        db_connection,
+        student_id=student_id, year=year, semester=semester,
+        course_id=course_id, course_name=course_name, last_name=last_name,
+        first_name=first_name, sid=sid, email=email, fuzzy=fuzzy,
+        after=after, limit=limit)
     return db_connection.execute(query, params).fetchall()
 
+def iter_students(db_connection, arraysize=ARRAYSIZE, **filters):
+    """Return an iterator over the rows selected by select_students.
+       Accepts the same arguments as select_students, passed
+       as keyword arguments; see iter_query.
+    """
+    query, params = students_query(db_connection, **filters)
+    return iter_query(db_connection, query, params, arraysize=arraysize)
+
+def iter_student_pages(db_connection, page_size=PAGE_SIZE, after=None,
+                       **filters):
+    """Return an iterator over pages of the rows selected by
+       select_students, ordered by name.  Each page is a list of at
+       most page_size rows, fetched with its own query when it is
+       needed.  Accepts the same filters as select_students, passed
+       as keyword arguments; after may be given to start after a
+       particular student.
+    """
+    def select_page(after):
+        return select_students(db_connection, after=after, limit=page_size,
+                               **filters)
+    def page_key(row):
+        return (row[1], row[2], row[0]) # (last_name, first_name, id)
+
+    return iter_pages(select_page, page_key, page_size, after=after)
+
 def get_student_id(db_connection, first_name=None, last_name=None,
                    sid=None, email=None):
     """Find a student in the grade database.
@@ -477,9 +2092,7 @@ def create_student(db_connection, first_name=None, last_name=None, sid=None,
         ['first_name', 'last_name', 'sid', 'email'],
         [first_name, last_name, sid, email])
     query = base_query % {'fields': fields, 'places': places}
-    db_connection.execute(query, params)
-
-    return last_insert_rowid(db_connection)
+    return db_connection.execute(query, params).lastrowid
 
 def update_student(db_connection, student_id=None, last_name=None,
                    first_name=None, sid=None, email=None):
@@ -497,22 +2110,18 @@ def update_student(db_connection, student_id=None, last_name=None,
             db_connection,
             last_name=last_name, first_name=first_name, sid=sid)
 
-    fields = ['last_name', 'first_name', 'sid', 'email']
-    old_values = db_connection.execute(
-        "SELECT %s FROM students WHERE id=?" % ', '.join(fields),
-        (student_id,)).fetchone()
-    new_values = [last_name, first_name, sid, email]
-    update_values = overlay(old_values, new_values)
-    
-    base_query = """
+    # overlay the new values on the existing data in the UPDATE
+    # itself, rather than reading the existing row first
+    query = """
     UPDATE students
-    SET %(updates)s
-    WHERE %(where)s;
+    SET last_name=COALESCE(NULLIF(?, ''), last_name),
+        first_name=COALESCE(NULLIF(?, ''), first_name),
+        sid=COALESCE(NULLIF(?, ''), sid),
+        email=COALESCE(NULLIF(?, ''), email)
+    WHERE id=?;
     """
-    update_clause, params = make_constraint_clause(", ", fields, update_values)
-    query = base_query % {'updates': update_clause,
-                          'where': "id=?"}
-    db_connection.execute(query, params + (student_id,))
+    params = (last_name, first_name, sid, email, student_id)
+    db_connection.execute(query, params)
     
     return student_id
 
@@ -521,31 +2130,123 @@ def create_or_update_student(db_connection, student_id=None, last_name=None,
     """Create a new student or update a record of an existing student.
        Returns the id of the created or updated row.
 
-       WARNING: This function uses SQLite's INSERT OR REPLACE
-       statement rather than an UPDATE statement.  If you pass
-       student_id or sid, it *will* erase data in an existing row of
-       the students table on a conflict; you must provide all values
-       to replace the existing data.
-    """
-    base_query = """
-    INSERT OR REPLACE INTO students (%(fields)s) VALUES (%(places)s);
+       An existing student is found by student_id if you pass it, and
+       otherwise by sid.  The existing row is updated in place with
+       the values you provide; values you do not provide are left
+       unchanged.  (If you pass both student_id and a sid which
+       belongs to a different student, IntegrityError is raised.)
     """
-    fields, places, params = make_values_clause(
+    if student_id:
+        conflict_fields = ['id']
+    else:
+        conflict_fields = ['sid']
+    returning = bool(sid and not student_id and HAS_RETURNING)
+    query, params = make_upsert_query(
+        'students', conflict_fields,
         ['id', 'last_name', 'first_name', 'sid', 'email'],
-        [student_id, last_name, first_name, sid, email])    
-    
-    query = base_query % {'fields': fields, 'places': places}
-    db_connection.execute(query, params)
-    
-    return last_insert_rowid(db_connection)
+        [student_id, last_name, first_name, sid, email],
+        returning=returning)
+    cursor = db_connection.execute(query, params)
+
+    if student_id:
+        return student_id
+    elif sid:
+        # on a conflict, the existing student's id is not available
+        # from lastrowid
+        row = returning and cursor.fetchone()
+        if row:
+            return row[0]
+        return db_connection.execute("SELECT id FROM students WHERE sid=?;",
+                                     (sid,)).fetchone()[0]
+    else:
+        return cursor.lastrowid
+
+def upsert_students_bulk(db_connection, students):
+    """Create or update many students in a single transaction.
+       students should be an iterable of dictionaries with keys
+         sid, last_name, first_name, email
+         The sid is used to find existing records.  Other keys are
+         ignored.
+       Existing students (with the same sid) are updated in place, so
+         their ids, course memberships and grades are preserved; as
+         in update_student, existing data is not replaced with empty
+         values.  Students without a sid cannot be matched to an
+         existing record, so they are always created, as by
+         create_student.
+       Returns a list of the ids of the created or updated rows, in
+         the same order as students.
+
+       Requires SQLite 3.24 or later (for UPSERT).
+    """
+    query = """
+    INSERT INTO students (sid, last_name, first_name, email)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT (sid) DO UPDATE SET
+      last_name=COALESCE(NULLIF(excluded.last_name, ''), last_name),
+      first_name=COALESCE(NULLIF(excluded.first_name, ''), first_name),
+      email=COALESCE(NULLIF(excluded.email, ''), email);
+    """
+    insert_query = """
+    INSERT INTO students (last_name, first_name, email) VALUES (?, ?, ?);
+    """
+    params = [(s.get('sid') or None, s.get('last_name'), s.get('first_name'),
+               s.get('email'))
+              for s in students]
+    if not params:
+        return []
+
+    new_ids = {} # index in params -> id, for students without a sid
+    with savepoint(db_connection):
+        db_connection.executemany(query, [p for p in params if p[0]])
+        for i, p in enumerate(params):
+            if not p[0]:
+                new_ids[i] = db_connection.execute(insert_query,
+                                                   p[1:]).lastrowid
+
+    sids = [p[0] for p in params if p[0]]
+    ids = {}
+    for chunk in chunks(sorted(set(sids)), MAX_QUERY_PARAMS):
+        rows = db_connection.execute(
+            "SELECT sid, id FROM students WHERE sid IN (%s);" %
+            ', '.join('?' for sid in chunk),
+            chunk).fetchall()
+        ids.update((r[0], r[1]) for r in rows)
+
+    return [ids[p[0]] if p[0] else new_ids[i] for i, p in enumerate(params)]
+
+def delete_student_cascade(db_connection, student_id=None):
+    """Delete a student and all associated rows.
+       The student's course memberships and grades are deleted by the
+       foreign keys' ON DELETE CASCADE actions, as part of a single
+       DELETE statement.
+       Returns a dictionary mapping each table name to the number of
+       rows deleted from that table.
+
+       student_id is required; this function will not delete more than
+       one student.
+    """
+    if not student_id:
+        raise ValueError("student_id is required to delete student row.")
 
-def select_course_memberships(db_connection, member_id=None, course_id=None,
-                              student_id=None):
-    """Return a result set of course memberships.
-       The rows in the result set have the format:
-         (course_membership_id, course_id, student_id)
-       For joins with students or courses table, see select_students and
-         select_courses.
+    counts_query = """
+    SELECT (SELECT count(*) FROM course_memberships WHERE student_id=:id),
+           (SELECT count(*) FROM grades WHERE student_id=:id);
+    """
+    params = {'id': student_id}
+    with savepoint(db_connection):
+        counts = db_connection.execute(counts_query, params).fetchone()
+        num_students = db_connection.execute(
+            "DELETE FROM students WHERE id=:id;", params).rowcount
+
+    if not num_students:
+        return {'students': 0, 'course_memberships': 0, 'grades': 0}
+    return {'students': num_students, 'course_memberships': counts[0],
+            'grades': counts[1]}
+
+def course_memberships_query(db_connection, member_id=None, course_id=None,
+                             student_id=None):
+    """Construct the query and parameters for select_course_memberships
+       and iter_course_memberships.
     """
     base_query = """
     SELECT id, course_id, student_id
@@ -557,8 +2258,31 @@ def select_course_memberships(db_connection, member_id=None, course_id=None,
         [member_id, course_id, student_id])
     query = add_where_clause(base_query, constraints)
 
-    return db_connection.execute(query, params).fetchall()
+    return query, params
     
+
+def select_course_memberships(db_connection, member_id=None, course_id=None,
+                              student_id=None):
+    """Return a result set of course memberships.
+       The rows in the result set have the format:
+         (course_membership_id, course_id, student_id)
+       For joins with students or courses table, see select_students and
+         select_courses.
+    """
+    query, params = course_memberships_query(
+        db_connection,
+        member_id=member_id, course_id=course_id, student_id=student_id)
+    return db_connection.execute(query, params).fetchall()
+
+def iter_course_memberships(db_connection, arraysize=ARRAYSIZE,
+                            **filters):
+    """Return an iterator over the rows selected by select_course_memberships.
+       Accepts the same arguments as select_course_memberships, passed
+       as keyword arguments; see iter_query.
+    """
+    query, params = course_memberships_query(db_connection, **filters)
+    return iter_query(db_connection, query, params, arraysize=arraysize)
+
 def create_course_member(db_connection, course_id=None, student_id=None):
     """Create a new course_membership record in the database.
        Returns the id of the inserted row.
@@ -570,9 +2294,40 @@ def create_course_member(db_connection, course_id=None, student_id=None):
         ['course_id', 'student_id'],
         [course_id, student_id])
     query = base_query % {'fields': fields, 'places': places}
-    db_connection.execute(query, params)
-
-    return last_insert_rowid(db_connection)
+    return db_connection.execute(query, params).lastrowid
+
+def create_course_members_bulk(db_connection, memberships):
+    """Create many course_membership records in a single transaction.
+       memberships should be an iterable of dictionaries with keys
+         course_id, student_id
+       Memberships which already exist are left alone.
+       Returns a list of the ids of the (new or existing) rows, in the
+         same order as memberships.
+    """
+    query = """
+    INSERT INTO course_memberships (course_id, student_id) VALUES (?, ?);
+    """
+    params = [(m['course_id'], m['student_id']) for m in memberships]
+    if not params:
+        return []
+
+    with savepoint(db_connection):
+        db_connection.executemany(query, params)
+
+    ids = {}
+    by_course = {}
+    for course_id, student_id in params:
+        by_course.setdefault(course_id, set()).add(student_id)
+    for course_id, student_ids in by_course.items():
+        for chunk in chunks(sorted(student_ids), MAX_QUERY_PARAMS):
+            rows = db_connection.execute(
+                "SELECT student_id, id FROM course_memberships "
+                "WHERE course_id=? AND student_id IN (%s);" %
+                ', '.join('?' for sid in chunk),
+                (course_id,) + tuple(chunk)).fetchall()
+            ids.update(((course_id, r[0]), r[1]) for r in rows)
+
+    return [ids[p] for p in params]
 
 def delete_course_member(db_connection, member_id=None, course_id=None,
                          student_id=None):
@@ -603,8 +2358,7 @@ def delete_course_member(db_connection, member_id=None, course_id=None,
         extra=constraints, extra_params=params)
     query = add_where_clause(base_query, constraints)
 
-    db_connection.execute(query, params)
-    return num_changes(db_connection)
+    return db_connection.execute(query, params).rowcount
 
 def delete_course_members(db_connection, member_id=None, course_id=None,
                           student_id=None):
@@ -630,35 +2384,270 @@ def delete_course_members(db_connection, member_id=None, course_id=None,
         [member_id, course_id, student_id])
     query = add_where_clause(base_query, constraints)
 
-    db_connection.execute(query, params)
-
-    return num_changes(db_connection)
+    return db_connection.execute(query, params).rowcount
     
+def grades_query(db_connection, grade_id=None, student_id=None,
+                 course_id=None, assignment_id=None, sid=None,
+                 after=None, limit=None):
+    """Construct the query and parameters for select_grades
+       and iter_grades.
+    """
+    if after is None and limit is None:
+        base_query = """
+        SELECT grades.id,
+               students.id AS student_id,
+               assignments.course_id AS course_id, assignments.id AS assignment_id,
+               assignments.name AS assignment_name,
+               grades.value
+        FROM grades, assignments, students
+        ON grades.assignment_id=assignments.id AND grades.student_id=students.id
+        %(where)s
+        """
+    else:
+        # pages are ordered by grade id, i.e., grades' primary key
+        base_query = """
+        SELECT grades.id,
+               students.id AS student_id,
+               assignments.course_id AS course_id, assignments.id AS assignment_id,
+               assignments.name AS assignment_name,
+               grades.value
+        FROM grades, assignments, students
+        ON grades.assignment_id=assignments.id AND grades.student_id=students.id
+        %(where)s
+        ORDER BY grades.id ASC
+        """
+     
+    constraints, params = make_conjunction_clause(
+        ['grades.id', 'students.id', 'assignments.course_id', 'assignments.id',
+         'students.sid'],
+        [grade_id, student_id, course_id, assignment_id, sid])
+    if after is not None:
+        constraints, params = make_keyset_clause(
+            ['grades.id'], [after], extra=constraints, extra_params=params)
+    query = add_where_clause(base_query, constraints)
+    query, params = add_limit_clause(query, params, limit)
+   
+    return query, params
+
 def select_grades(db_connection, grade_id=None, student_id=None,
-                  course_id=None, assignment_id=None):
+                  course_id=None, assignment_id=None, sid=None,
+                  after=None, limit=None):
     """Get a result set of grades for a given student or course.
        The rows in the result set have the format:
        (grade_id, student_id, course_id, assignment_id, assignment_name,
          grade_value)
        course_id may be supplied to limit results to one course.
+       sid may be supplied instead of student_id to find a student's
+       grades by their student ID number.
+       after and limit page through the results, which are then
+         ordered by grade id: after, if given, should be the id of the
+         last grade on the previous page, and limit is the number of
+         grades on a page; see iter_grade_pages.
+    """
+    query, params = grades_query(
+        db_connection,
+        grade_id=grade_id, student_id=student_id, course_id=course_id,
+        assignment_id=assignment_id, sid=sid, after=after, limit=limit)
+    return db_connection.execute(query, params).fetchall()
+
+def iter_grades(db_connection, arraysize=ARRAYSIZE, **filters):
+    """Return an iterator over the rows selected by select_grades.
+       Accepts the same arguments as select_grades, passed
+       as keyword arguments; see iter_query.
+    """
+    query, params = grades_query(db_connection, **filters)
+    return iter_query(db_connection, query, params, arraysize=arraysize)
+
+def iter_grade_pages(db_connection, page_size=PAGE_SIZE, after=None,
+                     **filters):
+    """Return an iterator over pages of the rows selected by
+       select_grades, ordered by grade id.  Each page is a list of at
+       most page_size rows, fetched with its own query when it is
+       needed.  Accepts the same filters as select_grades, passed as
+       keyword arguments.
+    """
+    def select_page(after):
+        return select_grades(db_connection, after=after, limit=page_size,
+                             **filters)
+    def page_key(row):
+        return row[0] # grade id
+
+    return iter_pages(select_page, page_key, page_size, after=after)
+
+def grades_changed_since_query(db_connection, since, course_id=None):
+    """Construct the query and parameters for select_grades_changed_since
+       and iter_grades_changed_since.
     """
+    if since is None:
+        # all grades, including any with no timestamp
+        base_query = """
+        SELECT grades.id,
+               grades.student_id,
+               assignments.course_id AS course_id,
+               assignments.id AS assignment_id,
+               assignments.name AS assignment_name,
+               grades.value,
+               grades.timestamp
+        FROM grades JOIN assignments ON (grades.assignment_id=assignments.id)
+        %(where)s
+        ORDER BY grades.id ASC;
+        """
+        constraints, params = make_conjunction_clause(
+            ['assignments.course_id'], [course_id])
+        return add_where_clause(base_query, constraints), params
+
+    # grades are keyed on the sequence number of their latest entry
+    # in the change log, which is assigned in commit order
     base_query = """
     SELECT grades.id,
-           students.id AS student_id,
+           grades.student_id,
            assignments.course_id AS course_id, assignments.id AS assignment_id,
            assignments.name AS assignment_name,
-           grades.value
-    FROM grades, assignments, students
-    ON grades.assignment_id=assignments.id AND grades.student_id=students.id
+           grades.value,
+           grades.timestamp
+    FROM grades JOIN assignments ON (grades.assignment_id=assignments.id)
+         JOIN (SELECT row_id, max(seq) AS seq
+               FROM change_log
+               WHERE table_name='grades' AND seq > ?
+               GROUP BY row_id) AS changes ON (changes.row_id=grades.id)
     %(where)s
+    ORDER BY changes.seq ASC;
     """
-     
     constraints, params = make_conjunction_clause(
-        ['grades.id', 'students.id', 'assignments.course_id', 'assignments.id'],
-        [grade_id, student_id, course_id, assignment_id])
+        ['assignments.course_id'], [course_id])
     query = add_where_clause(base_query, constraints)
-   
-    return db_connection.execute(query, params).fetchall()
+
+    return query, (since,) + tuple(params)
+
+def select_grades_changed_since(db_connection, since, course_id=None):
+    """Get a result set of the grades created or updated after a given
+       point in the change log (see create_change_log).
+       since should be a change log sequence number, such as one
+         returned by grades_high_water_mark.  If it is None, all
+         grades are returned.
+       course_id may be supplied to limit results to one course.
+       The rows in the result set have the format:
+       (grade_id, student_id, course_id, assignment_id, assignment_name,
+         grade_value, timestamp)
+       and are ordered by when they were last changed (or by id, if
+       since is None).  Only grades which still exist are returned;
+       deleting a grade does not count as changing it.
+       Raises ChangesPruned if changes after since have been pruned
+         from the change log.
+    """
+    with read_transaction(db_connection):
+        if since is not None:
+            ensure_changes_available(db_connection, since)
+        query, params = grades_changed_since_query(db_connection, since,
+                                                   course_id=course_id)
+        return db_connection.execute(query, params).fetchall()
+
+def iter_grades_changed_since(db_connection, since, arraysize=ARRAYSIZE,
+                              **filters):
+    """Return an iterator over the rows selected by select_grades_changed_since.
+       Accepts the same arguments as select_grades_changed_since, passed
+       as keyword arguments; see iter_query.
+    """
+    if since is not None:
+        ensure_changes_available(db_connection, since)
+    query, params = grades_changed_since_query(db_connection, since,
+                                               **filters)
+    return iter_query(db_connection, query, params, arraysize=arraysize)
+
+def grades_high_water_mark(db_connection):
+    """Returns the sequence number of the most recent change in the
+       change log.
+       Saving this value and later passing it to
+       select_grades_changed_since returns just the grades that have
+       changed in the meantime.  Read it in the same transaction as
+       the grades it covers (see read_transaction), so that no change
+       is committed in between.
+    """
+    return last_change_seq(db_connection)
+
+def grades_for_course_members_query(db_connection, student_id=None,
+                                    course_id=None, order_by_student=False):
+    """Construct the query and parameters for select_grades_for_course_members
+       and iter_grades_for_course_members.
+       If order_by_student is True, the rows are ordered by student, in
+       the same order as select_students returns them, and then by
+       assignment due date.
+    """
+    if getattr(db_connection, 'grade_matrix', False):
+        # the grade matrix already contains exactly these rows
+        # (see create_grade_matrix), so it only needs to be joined
+        # with assignments for their names, weights and types
+        if order_by_student:
+            base_query = """
+            SELECT assignments.id AS assignment_id,
+                   assignments.name AS assignment_name,
+                   assignments.weight,
+                   assignments.grade_type,
+                   grade_matrix.student_id,
+                   grade_matrix.grade_id,
+                   grade_matrix.value
+            FROM grade_matrix
+                 JOIN assignments ON (grade_matrix.assignment_id=assignments.id)
+                 JOIN students ON (grade_matrix.student_id=students.id)
+            %(where)s
+            ORDER BY students.last_name ASC, students.first_name ASC,
+                     students.id ASC, assignments.due_date ASC,
+                     assignments.id ASC;
+            """
+        else:
+            base_query = """
+            SELECT assignments.id AS assignment_id,
+                   assignments.name AS assignment_name,
+                   assignments.weight,
+                   assignments.grade_type,
+                   grade_matrix.student_id,
+                   grade_matrix.grade_id,
+                   grade_matrix.value
+            FROM grade_matrix
+                 JOIN assignments ON (grade_matrix.assignment_id=assignments.id)
+            %(where)s;
+            """
+        fields = ['grade_matrix.course_id', 'grade_matrix.student_id']
+    elif order_by_student:
+        base_query = """
+        SELECT assignments.id AS assignment_id,
+               assignments.name AS assignment_name,
+               assignments.weight,
+               assignments.grade_type,
+               course_memberships.student_id,
+               grades.id AS grade_id,
+               grades.value
+        FROM (course_memberships, assignments USING (course_id))
+             JOIN students ON (course_memberships.student_id=students.id)
+             LEFT OUTER JOIN grades ON (course_memberships.student_id=grades.student_id AND assignments.id=grades.assignment_id)
+        %(where)s
+        ORDER BY students.last_name ASC, students.first_name ASC,
+                 students.id ASC, assignments.due_date ASC,
+                 assignments.id ASC;
+        """
+        fields = ['course_memberships.course_id',
+                  'course_memberships.student_id']
+    else:
+        base_query = """
+        SELECT assignments.id AS assignment_id,
+               assignments.name AS assignment_name,
+               assignments.weight,
+               assignments.grade_type,
+               course_memberships.student_id,
+               grades.id AS grade_id,
+               grades.value
+        FROM (course_memberships, assignments USING (course_id))
+             LEFT OUTER JOIN grades ON (course_memberships.student_id=grades.student_id AND assignments.id=grades.assignment_id)
+        %(where)s;
+        """
+        fields = ['course_memberships.course_id',
+                  'course_memberships.student_id']
+
+    constraints, params = make_conjunction_clause(
+        fields, [course_id, student_id])
+    query = add_where_clause(base_query, constraints)
+
+    return query, params
 
 def select_grades_for_course_members(db_connection, student_id=None, course_id=None):
     """Select grades for members of a given course, for all assignments in that course.
@@ -676,34 +2665,139 @@ def select_grades_for_course_members(db_connection, student_id=None, course_id=N
        The result set has the following columns:
        assignment_id, assignment_name, weight, grade_type, grade_id, student_id, value
     """
-    base_query = """
-    SELECT assignments.id AS assignment_id,
-           assignments.name AS assignment_name,
-           assignments.weight,
-           assignments.grade_type,
-           course_memberships.student_id,
-           grades.id AS grade_id,
-           grades.value
-    FROM (course_memberships, assignments USING (course_id))
-         LEFT OUTER JOIN grades ON (course_memberships.student_id=grades.student_id AND assignments.id=grades.assignment_id)
-    %(where)s;
-    """
+    query, params = grades_for_course_members_query(
+        db_connection,
+        student_id=student_id, course_id=course_id)
+    return db_connection.execute(query, params).fetchall()
 
+def iter_grades_for_course_members(db_connection, arraysize=ARRAYSIZE,
+                                   **filters):
+    """Return an iterator over the rows selected by select_grades_for_course_members.
+       Accepts the same arguments as select_grades_for_course_members, passed
+       as keyword arguments; see iter_query.
+    """
+    query, params = grades_for_course_members_query(db_connection,
+                                                    **filters)
+    return iter_query(db_connection, query, params, arraysize=arraysize)
+
+def iter_students_with_grades(db_connection, course_id, arraysize=ARRAYSIZE):
+    """Return an iterator over the members of a course and their grades.
+       Yields a pair (student, grades) for each student in the course,
+       in the order select_students returns them, where grades is a
+       list of the student's rows from select_grades_for_course_members
+       (one per assignment in the course).
+
+       The students and grades are each streamed from the database and
+       merged as they arrive, so only one student's grades are held in
+       memory at a time.
+    """
+    students = iter_students(db_connection, course_id=course_id,
+                             arraysize=arraysize)
+    grades = iter_grades_for_course_members(db_connection,
+                                            course_id=course_id,
+                                            order_by_student=True,
+                                            arraysize=arraysize)
+    # both streams are ordered the same way, so a student's grade rows
+    # always arrive together, at the same point as the student.  Columns
+    # are accessed by position so this works with any row type:
+    # students.id is column 0 of a student row, and student_id is
+    # column 4 of a grade row.
+    pending = next(grades, None)
+    for student in students:
+        student_grades = []
+        while pending is not None and pending[4] == student[0]:
+            student_grades.append(pending)
+            pending = next(grades, None)
+        yield student, student_grades
+
+def grade_bin_expression():
+    """Construct a SQL expression for the histogram bin of a grade.
+       Letter grades are binned by their value; grades for '4points'
+       and 'percentage' assignments by the index of the range they
+       fall in, in calculator_helpers.POINTS or PERCENTS (excluding
+       the last, dummy range).  The expression is NULL for other grade
+       types, and for numbers which fall in no range.
+    """
+    def numeric_bins(scale):
+        return ' '.join("WHEN %s >= %r AND %s < %r THEN %d" %
+                        (NUMERIC_GRADE, float(mn), NUMERIC_GRADE, float(mx), i)
+                        for i, (letter, val, mx, mn) in enumerate(scale[:-1]))
+
+    return """(CASE
+      WHEN assignments.grade_type = 'letter' THEN grades.value
+      WHEN assignments.grade_type = '4points' THEN (CASE %s END)
+      WHEN assignments.grade_type = 'percentage' THEN (CASE %s END)
+    END)""" % (numeric_bins(calculator_helpers.POINTS),
+               numeric_bins(calculator_helpers.PERCENTS))
+
+# the numeric value of a grade on its assignment's scale (see
+# add_numeric_grade_columns)
+NUMERIC_GRADE = """(CASE WHEN assignments.grade_type = 'percentage'
+            THEN grades.percent_value ELSE grades.points_value END)"""
+
+def grade_distribution_query(db_connection, course_id=None, assignment_id=None):
+    """Construct the query and parameters for select_grade_distribution.
+    """
+    def build():
+        return """
+        SELECT assignments.id AS assignment_id,
+               grades.id IS NULL AS missing,
+               %(bin)s AS bin,
+               count(*) AS num_rows,
+               count(%(numeric)s) AS num_values,
+               total(%(numeric)s) AS sum_value,
+               min(%(numeric)s) AS min_value,
+               max(%(numeric)s) AS max_value,
+               group_concat(CASE WHEN grades.id IS NULL
+                                 THEN course_memberships.student_id END)
+                 AS missing_students
+        FROM (course_memberships, assignments USING (course_id))
+             LEFT OUTER JOIN grades ON (course_memberships.student_id=grades.student_id AND assignments.id=grades.assignment_id)
+        %%(where)s
+        GROUP BY assignments.id, missing, bin;
+        """ % {'bin': grade_bin_expression(), 'numeric': NUMERIC_GRADE}
+
+    base_query = compiled('grade_distribution', build)
     constraints, params = make_conjunction_clause(
-        ['course_memberships.course_id', 'course_memberships.student_id'],
-        [course_id, student_id])
+        ['assignments.course_id', 'assignments.id'],
+        [course_id, assignment_id])
     query = add_where_clause(base_query, constraints)
 
+    return query, params
+
+def select_grade_distribution(db_connection, course_id=None, assignment_id=None):
+    """Summarize the grades of course members for each assignment.
+       The grades are grouped in SQLite by assignment and histogram bin
+       (see grade_bin_expression), so a whole course is summarized by
+       a single query, without fetching the individual grades.  The
+       result set has one row per group, with the following columns:
+         assignment_id
+         missing: 1 for the group of course members with no grade for
+           the assignment, 0 otherwise
+         bin: the histogram bin of the group's grades
+         num_rows: the number of grades (or members without a grade)
+           in the group
+         num_values, sum_value, min_value, max_value: the count, sum,
+           minimum and maximum of the group's grades as numbers on the
+           assignment's scale (see add_numeric_grade_columns),
+           ignoring grades with no numeric value
+         missing_students: for the missing group, the ids of the
+           members without a grade, separated by commas
+       Statistics for an assignment are obtained by combining its
+       groups; see schoolutils.reporting.reports.GradeReport.
+    """
+    query, params = grade_distribution_query(
+        db_connection, course_id=course_id, assignment_id=assignment_id)
     return db_connection.execute(query, params).fetchall()
 
 def create_grade(db_connection, assignment_id=None, student_id=None, value=None,
                  timestamp=None):
     """Create a new grade in the database.
        The timestamp field is automatically generated if not provided.
+       It may be a datetime or an integer timestamp (see make_timestamp).
        Returns the id of the inserted row.
     """
-    if not timestamp:
-        timestamp = datetime.datetime.now()
+    timestamp = make_timestamp(timestamp)
 
     base_query = """
     INSERT INTO grades (%(fields)s) VALUES (%(places)s);
@@ -712,34 +2806,198 @@ def create_grade(db_connection, assignment_id=None, student_id=None, value=None,
         ['assignment_id', 'student_id', 'value', 'timestamp'],
         [assignment_id, student_id, value, timestamp])
     query = base_query % {'fields': fields, 'places': places}
-    db_connection.execute(query, params)
-
-    return last_insert_rowid(db_connection)
+    return db_connection.execute(query, params).lastrowid
+
+def create_grades_bulk(db_connection, grades):
+    """Create many new grades in a single transaction.
+       grades should be an iterable of dictionaries with keys
+         assignment_id, student_id, value, and optionally timestamp
+       The timestamp field is automatically generated for grades that
+         do not provide one.
+       Returns a list of the ids of the inserted rows, in the same
+         order as grades.
+    """
+    now = make_timestamp()
+    query = """
+    INSERT INTO grades (assignment_id, student_id, value, timestamp)
+    VALUES (?, ?, ?, ?);
+    """
+    params = [(g['assignment_id'], g['student_id'], g['value'],
+               make_timestamp(g.get('timestamp') or now))
+              for g in grades]
+    if not params:
+        return []
+
+    # executemany does not report the id of each row it inserts, and
+    # ids need not be consecutive (e.g., if a trigger inserts into
+    # grades), so rows are inserted one at a time, reusing one
+    # prepared statement
+    ids = []
+    with savepoint(db_connection):
+        cursor = db_connection.cursor()
+        try:
+            for p in params:
+                ids.append(cursor.execute(query, p).lastrowid)
+        finally:
+            cursor.close()
+
+    return ids
 
 def create_or_update_grade(db_connection, grade_id=None, assignment_id=None,
                            student_id=None, value=None, timestamp=None):
     """Create a new grade or update a record of an existing grade.
        Returns the id of the created or updated row.
-       
-       WARNING: This function uses SQLite's INSERT OR REPLACE
-       statement rather than an UPDATE statement.  If you pass
-       grade_id, it *will* erase data in an existing row of the grades
-       table; you must provide all values to replace the existing data. 
+
+       assignment_id and student_id are always required.
+       If you pass grade_id, that grade is updated in place with the
+       values you provide; values you do not provide are left
+       unchanged.  Otherwise, the student's current grade for the
+       assignment is updated, or a new grade is created if the student
+       has none.  (If the database allows more than one grade per
+       student per assignment -- see create_unique_grades_index -- the
+       most recently created one is updated.)
+       The timestamp field is automatically generated if not provided.
     """
-    base_query = """
-    INSERT OR REPLACE INTO grades (%(fields)s) VALUES (%(places)s);
+    timestamp = make_timestamp(timestamp)
+
+    if grade_id:
+        query, params = make_upsert_query(
+            'grades', ['id'],
+            ['id', 'assignment_id', 'student_id', 'value', 'timestamp'],
+            [grade_id, assignment_id, student_id, value, timestamp])
+        db_connection.execute(query, params)
+        return grade_id
+
+    return upsert_grade(db_connection, assignment_id=assignment_id,
+                        student_id=student_id, value=value,
+                        timestamp=timestamp)
+
+def upsert_grade(db_connection, assignment_id=None, student_id=None,
+                 value=None, timestamp=None):
+    """Save a student's grade for an assignment, replacing the value of
+       any existing grade.
+       assignment_id and student_id are required.
+       The timestamp field is automatically generated if not provided.
+       Returns the id of the created or updated row.
+
+       When the database has a unique index on grades (see
+       create_unique_grades_index), the grade is saved with a single
+       INSERT ... ON CONFLICT DO UPDATE statement.  Otherwise, the most
+       recently created existing grade is updated, or a new grade is
+       inserted if there is none.
     """
-    if not timestamp:
-        timestamp = datetime.datetime.now()
-        
-    fields, places, params = make_values_clause(
-        ['id', 'assignment_id', 'student_id', 'value', 'timestamp'],
-        [grade_id, assignment_id, student_id, value, timestamp])    
-    
-    query = base_query % {'fields': fields, 'places': places}
-    db_connection.execute(query, params)
-    
-    return last_insert_rowid(db_connection)
+    if not (assignment_id and student_id):
+        raise sqlite3.IntegrityError(
+            "assignment_id and student_id are required to save a grade")
+    timestamp = make_timestamp(timestamp)
+
+    if db_connection.unique_grades:
+        if HAS_RETURNING:
+            return db_connection.execute(
+                returning_id(UPSERT_GRADE_QUERY),
+                (assignment_id, student_id, value, timestamp)).fetchone()[0]
+        db_connection.execute(UPSERT_GRADE_QUERY,
+                              (assignment_id, student_id, value, timestamp))
+    else:
+        with savepoint(db_connection):
+            cursor = db_connection.execute(
+                returning_id(UPDATE_LATEST_GRADE_QUERY),
+                (value, timestamp, assignment_id, student_id))
+            row = HAS_RETURNING and cursor.fetchone()
+            if row:
+                return row[0]
+            if cursor.rowcount == 0:
+                return create_grade(db_connection,
+                                    assignment_id=assignment_id,
+                                    student_id=student_id, value=value,
+                                    timestamp=timestamp)
+
+    return db_connection.execute(
+        "SELECT max(id) FROM grades WHERE assignment_id=? AND student_id=?;",
+        (assignment_id, student_id)).fetchone()[0]
+
+def upsert_grades_bulk(db_connection, grades):
+    """Save many grades in a single transaction, replacing the values of
+       any existing grades, as upsert_grade does.
+       grades should be an iterable of dictionaries with keys
+         assignment_id, student_id, value, and optionally timestamp
+       The timestamp field is automatically generated for grades that
+         do not provide one.
+       Returns the number of grades saved.
+    """
+    now = make_timestamp()
+    params = []
+    for g in grades:
+        if not (g.get('assignment_id') and g.get('student_id')):
+            raise sqlite3.IntegrityError(
+                "assignment_id and student_id are required to save a grade")
+        params.append((g['assignment_id'], g['student_id'], g['value'],
+                       make_timestamp(g.get('timestamp') or now)))
+    if not params:
+        return 0
+
+    with savepoint(db_connection):
+        if db_connection.unique_grades:
+            db_connection.executemany(UPSERT_GRADE_QUERY, params)
+        else:
+            for p in params:
+                upsert_grade(db_connection, assignment_id=p[0],
+                             student_id=p[1], value=p[2], timestamp=p[3])
+
+    return len(params)
+
+def create_grade_if_absent(db_connection, assignment_id=None,
+                           student_id=None, value=None, timestamp=None):
+    """Create a grade, unless the student already has a grade for the
+       assignment.
+       assignment_id and student_id are required.
+       The timestamp field is automatically generated if not provided.
+       Returns the id of the new grade, or None if the student already
+       had a grade (which is left unchanged).
+
+       This checks for an existing grade and inserts the new one in a
+       single statement.
+    """
+    if not (assignment_id and student_id):
+        raise sqlite3.IntegrityError(
+            "assignment_id and student_id are required to save a grade")
+    timestamp = make_timestamp(timestamp)
+
+    if db_connection.unique_grades:
+        query = """
+        INSERT INTO grades (assignment_id, student_id, value, timestamp)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (assignment_id, student_id) DO NOTHING;
+        """
+        params = (assignment_id, student_id, value, timestamp)
+    else:
+        query = """
+        INSERT INTO grades (assignment_id, student_id, value, timestamp)
+        SELECT ?, ?, ?, ?
+        WHERE NOT EXISTS (SELECT 1 FROM grades
+                          WHERE assignment_id=? AND student_id=?);
+        """
+        params = (assignment_id, student_id, value, timestamp,
+                  assignment_id, student_id)
+    cursor = db_connection.execute(query, params)
+
+    if cursor.rowcount == 0:
+        return None
+    return cursor.lastrowid
+
+UPSERT_GRADE_QUERY = """
+INSERT INTO grades (assignment_id, student_id, value, timestamp)
+VALUES (?, ?, ?, ?)
+ON CONFLICT (assignment_id, student_id) DO UPDATE SET
+  value=excluded.value,
+  timestamp=excluded.timestamp;
+"""
+
+UPDATE_LATEST_GRADE_QUERY = """
+UPDATE grades
+SET value=?, timestamp=?
+WHERE id=(SELECT max(id) FROM grades WHERE assignment_id=? AND student_id=?);
+"""
 
 def update_grade(db_connection, grade_id=None, value=None):
     """Update a record of an existing grade.
@@ -760,16 +3018,725 @@ def update_grade(db_connection, grade_id=None, value=None):
     SET value=?, timestamp=?
     WHERE id=?;
     """
-    params = (value, datetime.datetime.now(), grade_id)
+    params = (value, make_timestamp(), grade_id)
     db_connection.execute(query, params)
     
     return grade_id
 
+def update_grades_bulk(db_connection, grades):
+    """Update the values of many existing grades in a single transaction.
+       grades should be an iterable of dictionaries with keys
+         grade_id, value
+       As in update_grade, the timestamp of each grade is automatically
+         updated.
+       Returns a list of the ids of the updated rows.
+    """
+    now = make_timestamp()
+    query = """
+    UPDATE grades
+    SET value=?, timestamp=?
+    WHERE id=?;
+    """
+    params = []
+    for g in grades:
+        if not g.get('grade_id'):
+            raise sqlite3.IntegrityError(
+                "grade_id is required to update a grade")
+        params.append((g['value'], now, g['grade_id']))
+    if not params:
+        return []
+
+    with savepoint(db_connection):
+        db_connection.executemany(query, params)
+
+    return [p[2] for p in params]
+
    
            
+#
+# change log
+#
+def read_changes(db_connection, after_seq=0, limit=None, course_id=None):
+    """Read entries from the change log (see create_change_log).
+       Returns a list of the changes with a sequence number greater
+         than after_seq, oldest first.  Each row has the fields
+         seq, table_name, row_id, operation, course_id, timestamp
+         where operation is 'insert', 'update' or 'delete'.
+       To follow the log, pass the seq of the last change you have
+         processed as after_seq; start from last_change_seq after
+         reading the data you need in full.
+       limit, if given, is the maximum number of changes to return.
+       course_id, if given, limits the changes to rows belonging to
+         that course; changes to students, and grades deleted along
+         with their assignment, have no course and are omitted.
+       Raises ChangesPruned if some changes after after_seq have
+         already been pruned from the log, so the caller cannot bring
+         its copy of the data up to date from the log alone.
+    """
+    with read_transaction(db_connection):
+        ensure_changes_available(db_connection, after_seq)
+
+        base_query = """
+        SELECT seq, table_name, row_id, operation, course_id, timestamp
+        FROM change_log
+        %(where)s
+        ORDER BY seq ASC
+        """
+        constraints, params = make_conjunction_clause(
+            ['course_id'], [course_id],
+            extra='seq > ?', extra_params=(after_seq,))
+        query = add_where_clause(base_query, constraints)
+        if limit is not None:
+            query += " LIMIT ?"
+            params += (limit,)
+        return db_connection.execute(query + ";", params).fetchall()
+
+def ensure_changes_available(db_connection, after_seq):
+    """Ensure that no changes after after_seq have been pruned from the
+       change log; raises ChangesPruned if they have"""
+    oldest = db_connection.execute(
+        "SELECT min(seq) FROM change_log;").fetchone()[0]
+    if oldest is None:
+        oldest = last_change_seq(db_connection) + 1
+    if after_seq < oldest - 1:
+        raise ChangesPruned(
+            "Changes after %d have been pruned from the change log; "
+            "the oldest remaining change is %d" % (after_seq, oldest))
+
+def last_change_seq(db_connection):
+    """Returns the sequence number of the most recent change in the
+       change log, or 0 if nothing has been logged yet"""
+    row = db_connection.execute(
+        "SELECT seq FROM sqlite_sequence WHERE name='change_log';").fetchone()
+    return row[0] if row else 0
+
+def prune_change_log(db_connection, keep=CHANGE_LOG_SIZE):
+    """Delete all but the most recent keep entries from the change log.
+       The log is pruned automatically as it grows; this function can
+       shrink it further.  Like other functions in this module, it
+       does not commit.
+       Returns the number of entries deleted.
+    """
+    return db_connection.execute(
+        "DELETE FROM change_log WHERE seq <= ?;",
+        (last_change_seq(db_connection) - keep,)).rowcount
+
+#
+# multiple databases
+#
+# Grade databases for several terms can be ATTACHed to one connection,
+# and the multi_select_* functions then run a select_* query against
+# each of them, combining the results with UNION ALL.  Each database
+# has its own ids, so every row is labeled with the name of the
+# database it came from, in a gradedb column.
+
+# tables which qualify_tables prefixes with a database name
+GRADEDB_TABLES = ['students', 'students_fts', 'courses', 'course_memberships',
+                  'assignments', 'grades', 'grade_matrix', 'change_log']
+
+# a table name used as a table, rather than as the qualifier of a
+# column (as in students.id)
+TABLE_REFERENCE = re.compile(r'(?<![\w.])(%s)\b(?!\s*\.)' %
+                             '|'.join(GRADEDB_TABLES))
+
+def attach_database(db_connection, path, name=None):
+    """Attach another grade database to a connection.
+       name is the schema name for the attached database; it defaults
+         to the file's name, without its extension, with characters
+         that may not appear in a SQL identifier replaced by '_'.
+       The attached database is opened read-only if db_connection is
+         read-only.  (Where URIs are not supported, it is attached by
+         path, and the PRAGMA query_only set by connect_read_only
+         refuses writes to it instead.)  It must already exist and contain the grade
+         database tables, but it may be at an older schema version.
+       SQLite allows at most 10 attached databases by default.
+       Any open transaction on db_connection is committed first.
+       Returns the schema name of the attached database.
+    """
+    if not os.path.exists(path):
+        raise ConnectionError("No grade database at %s" % path)
+    if name is None:
+        name = re.sub(r'\W', '_', os.path.splitext(os.path.basename(path))[0])
+        if not re.match(r'[A-Za-z_]', name):
+            name = 'db_' + name
+        base, n = name, 1
+        while name.lower() in [d.lower() for d in databases(db_connection)]:
+            n += 1
+            name = '%s_%d' % (base, n)
+    elif not re.match(r'^[A-Za-z_]\w*$', name):
+        raise ValueError("Invalid database name: %s" % name)
+    if name.lower() in ('main', 'temp'):
+        raise ValueError("Invalid database name: %s" % name)
+
+    # ATTACH cannot be run inside a transaction
+    db_connection.commit()
+    if db_connection.read_only and HAS_URI:
+        # read-only connections are opened with URIs (see
+        # connect_read_only), so ATTACH accepts one too; otherwise,
+        # SQLite would create a file named "file:..."
+        location = "file:%s?mode=ro" % pathname2url(path)
+    else:
+        location = path
+    try:
+        db_connection.execute("ATTACH DATABASE ? AS %s;" % name, (location,))
+    except sqlite3.OperationalError as e:
+        raise ConnectionError(e.args[0])
+
+    tables = set(r[0] for r in db_connection.execute(
+        "SELECT name FROM %s.sqlite_master WHERE type='table';" % name))
+    missing = [t for t in REQUIRED_TABLES if t not in tables]
+    if missing:
+        db_connection.execute("DETACH DATABASE %s;" % name)
+        raise ConnectionError("%s is not a grade database; missing tables: %s"
+                              % (path, ", ".join(missing)))
+
+    db_connection.attached = list(db_connection.attached) + [name]
+    # the same query is run against every database, and attached
+    # databases may lack the full-text index on students, so fuzzy
+    # searches fall back on LIKE while databases are attached
+    db_connection.student_search_index = False
+    return name
+
+def detach_database(db_connection, name):
+    """Detach a database attached with attach_database.
+       Any open transaction on db_connection is committed first."""
+    db_connection.commit()
+    db_connection.execute("DETACH DATABASE %s;" % name)
+    db_connection.attached = [d for d in db_connection.attached if d != name]
+    if not db_connection.attached:
+        db_connection.student_search_index = (
+            has_student_search_index(db_connection) and
+            fts5_available(db_connection))
+
+def connect_multi(paths, **connect_args):
+    """Connect to several grade databases at once.
+       The first database in paths is opened with connect, which
+       accepts any other keyword arguments; the rest are attached to
+       that connection with attach_database.
+       Returns the connection; see multi_select_students,
+       multi_select_courses and multi_select_grades.
+    """
+    if not paths:
+        raise ValueError("At least one grade database is required")
+    conn = connect(paths[0], **connect_args)
+    try:
+        for path in paths[1:]:
+            attach_database(conn, path)
+    except:
+        conn.close()
+        raise
+    return conn
+
+def databases(db_connection):
+    """Returns the schema names of the grade databases open on a
+       connection: 'main', followed by any attached databases"""
+    return ['main'] + list(db_connection.attached)
+
+def qualify_tables(query, schema):
+    """Rewrite a query so it reads the grade database tables in schema.
+       Table references like 'FROM grades' become 'FROM schema.grades';
+       column references like 'grades.value' are unchanged, since they
+       refer to the table by its unqualified name.  This is only meant
+       for the queries constructed by this module's *_query functions.
+    """
+    def build():
+        return TABLE_REFERENCE.sub(
+            lambda m: '%s.%s' % (schema, m.group(1)), query)
+
+    return compiled(('qualify', query, schema), build)
+
+def multi_query(db_connection, query, params=()):
+    """Run a query against every grade database open on a connection.
+       query and params should be the result of one of the *_query
+       functions.  The query is run against each database in turn
+       (see qualify_tables), so each part uses that database's
+       indexes, and the results are combined with UNION ALL.
+       Returns the rows, each with an extra first column, gradedb,
+       naming the database it came from.  Rows are grouped by
+       database, in the order of databases(db_connection).
+    """
+    schemas = databases(db_connection)
+
+    def build():
+        body = query.strip().rstrip(';')
+        return " UNION ALL ".join(
+            "SELECT * FROM (SELECT '%s' AS gradedb, * FROM (%s))" %
+            (schema, qualify_tables(body, schema))
+            for schema in schemas) + ";"
+
+    sql = compiled(('multi', query, tuple(schemas)), build)
+    return db_connection.execute(sql, tuple(params) * len(schemas)).fetchall()
+
+def multi_select_students(db_connection, **filters):
+    """Select students from every grade database open on a connection.
+       Accepts the same arguments as select_students, passed as keyword
+       arguments; see multi_query for the format of the result.
+    """
+    query, params = students_query(db_connection, **filters)
+    return multi_query(db_connection, query, params)
+
+def multi_select_courses(db_connection, **filters):
+    """Select courses from every grade database open on a connection.
+       Accepts the same arguments as select_courses, passed as keyword
+       arguments; see multi_query for the format of the result.
+    """
+    query, params = courses_query(db_connection, **filters)
+    return multi_query(db_connection, query, params)
+
+def multi_select_grades(db_connection, **filters):
+    """Select grades from every grade database open on a connection.
+       Accepts the same arguments as select_grades, passed as keyword
+       arguments; see multi_query for the format of the result.
+       Since ids differ between databases, use sid to find one
+       student's grades in every term:
+         multi_select_grades(conn, sid='12345678')
+    """
+    query, params = grades_query(db_connection, **filters)
+    return multi_query(db_connection, query, params)
+
+#
+# archiving
+#
+
+# tables copied to an archive by archive_semesters, in an order that
+# satisfies their foreign keys
+ARCHIVE_TABLES = ['students', 'courses', 'course_memberships',
+                  'assignments', 'grades']
+
+def archive_semesters(db_connection, archive_path, semesters, compact=True):
+    """Move the courses of some semesters into an archive database.
+       semesters should be a list of (year, semester) pairs.
+       Every course in those semesters is copied to the grade database
+         at archive_path, with its memberships, assignments and grades,
+         and the students enrolled in it or graded in it; the archive
+         is created if it does not exist.  The courses are then deleted
+         from db_connection's database, along with their memberships,
+         assignments and grades (students are kept, since they may
+         belong to other courses).  Copying and deleting happen in one
+         transaction, so either the courses are moved or nothing
+         changes.
+       Rows get new ids in the archive, since SQLite reuses the ids of
+         deleted rows: a course created after an archive may have the
+         id of an archived one.  Students already in the archive (with
+         the same sid) are updated rather than copied again.
+       If compact is True, the database is then VACUUMed, to return
+         the space the courses occupied, and ANALYZEd, so the query
+         planner's statistics describe the data that is left.
+       The archive is an ordinary grade database: open it with
+         connect(archive_path, read_only=True), or attach it with
+         attach_database to query it alongside the live database.
+       Any open transaction on db_connection is committed first.
+       Returns a dictionary mapping each table in ARCHIVE_TABLES to the
+         number of rows copied to the archive.
+    """
+    course_ids = []
+    for year, semester in semesters:
+        course_ids.extend(c[0] for c in select_courses(
+            db_connection, year=year, semester=semester))
+    counts = dict((t, 0) for t in ARCHIVE_TABLES)
+    if not course_ids:
+        return counts
+
+    # create the archive, or bring it up to the current schema version,
+    # so its tables have the same columns as the live ones
+    connect(archive_path, create=True).close()
+    archive = attach_database(db_connection, archive_path)
+
+    selections = {
+        'students': """
+        id IN (SELECT live_id FROM temp.archived_students)
+        """,
+        'courses': "id IN (SELECT id FROM temp.archived_courses)",
+        'course_memberships':
+            "course_id IN (SELECT id FROM temp.archived_courses)",
+        'assignments': "course_id IN (SELECT id FROM temp.archived_courses)",
+        'grades': """
+        assignment_id IN (SELECT id FROM main.assignments
+                          WHERE course_id IN (SELECT id FROM temp.archived_courses))
+        """,
+        }
+
+    try:
+        with savepoint(db_connection, 'archive_semesters'):
+            execute_script(db_connection, """
+            CREATE TEMP TABLE archived_courses (id INTEGER PRIMARY KEY);
+            CREATE TEMP TABLE archived_students (
+              live_id INTEGER PRIMARY KEY,
+              archive_id INTEGER
+            );
+            """)
+            db_connection.executemany(
+                "INSERT INTO temp.archived_courses (id) VALUES (?);",
+                [(c,) for c in course_ids])
+
+            # new ids in the archive are the live ids plus the largest
+            # id already in the archive table, so they cannot collide
+            offsets = {}
+            for table in ARCHIVE_TABLES:
+                offsets[table] = db_connection.execute(
+                    "SELECT coalesce(max(id), 0) FROM %s.%s;" %
+                    (archive, table)).fetchone()[0]
+
+            # students: match students already archived by sid, and
+            # give the others new ids
+            counts['students'] = db_connection.execute("""
+            INSERT INTO temp.archived_students (live_id, archive_id)
+            SELECT students.id, archived.id
+            FROM main.students
+                 LEFT JOIN %(archive)s.students AS archived
+                 ON (archived.sid=students.sid)
+            WHERE students.id IN
+              (SELECT student_id FROM main.course_memberships
+               WHERE course_id IN (SELECT id FROM temp.archived_courses)
+               UNION
+               SELECT grades.student_id
+               FROM main.grades JOIN main.assignments
+                    ON (grades.assignment_id=assignments.id)
+               WHERE assignments.course_id IN
+                 (SELECT id FROM temp.archived_courses));
+            """ % {'archive': archive}).rowcount
+            db_connection.execute("""
+            UPDATE temp.archived_students SET archive_id=live_id + %d
+            WHERE archive_id IS NULL;
+            """ % offsets['students'])
+
+            remapped = {
+                'id': "id + %d",
+                'course_id': "course_id + %d" % offsets['courses'],
+                'assignment_id': "assignment_id + %d" % offsets['assignments'],
+                'student_id': """(SELECT archive_id FROM temp.archived_students
+                                  WHERE live_id=student_id)""",
+                }
+            for table in ARCHIVE_TABLES:
+                columns = [r[1] for r in db_connection.execute(
+                    "PRAGMA main.table_info(%s);" % table).fetchall()]
+                if table == 'students':
+                    values = ["(SELECT archive_id FROM temp.archived_students "
+                              "WHERE live_id=id)" if c == 'id' else c
+                              for c in columns]
+                    # keep the details of students archived with an
+                    # earlier semester current
+                    conflict = " ON CONFLICT (id) DO UPDATE SET %s" % ', '.join(
+                        '%s=excluded.%s' % (c, c) for c in columns if c != 'id')
+                else:
+                    values = [remapped[c] % offsets[table] if c == 'id'
+                              else remapped.get(c, c)
+                              for c in columns]
+                    conflict = ""
+                query = "INSERT INTO %s.%s (%s) SELECT %s FROM main.%s WHERE %s" % (
+                    archive, table, ', '.join(columns), ', '.join(values),
+                    table, selections[table])
+                rowcount = db_connection.execute(
+                    query + conflict + ";").rowcount
+                if table != 'students':
+                    counts[table] = rowcount
+
+            # memberships, assignments and grades follow by cascading
+            # deletes (see add_cascading_deletes)
+            db_connection.execute("""
+            DELETE FROM main.courses
+            WHERE id IN (SELECT id FROM temp.archived_courses);
+            """)
+        db_connection.commit()
+        db_connection.execute("ANALYZE %s;" % archive)
+    except:
+        db_connection.rollback()
+        raise
+    finally:
+        db_connection.execute("DROP TABLE IF EXISTS temp.archived_courses;")
+        db_connection.execute("DROP TABLE IF EXISTS temp.archived_students;")
+        detach_database(db_connection, archive)
+
+    if compact:
+        db_connection.execute("VACUUM;")
+        db_connection.execute("ANALYZE;")
+        db_connection.commit()
+
+    return counts
+
+#
+# transaction management
+#
+
+# default commit batching for TransactionManager: commit once this many
+# rows have been written, or this many seconds have passed since the
+# first uncommitted write
+COMMIT_EVERY = 20
+COMMIT_INTERVAL = 10.0
+
+class TransactionManager(object):
+    """Groups the writes made on a connection into units of work, and
+       commits them in batches.
+
+       Usage:
+         transactions = TransactionManager(db_connection)
+         with transactions.unit_of_work():
+             db.create_grade(db_connection, ...)
+
+       Each unit of work runs inside a savepoint: if the block raises
+       an exception, its changes (and only its changes) are rolled
+       back.  Units of work may be nested.  When an outermost unit of
+       work completes, its changes are committed if at least
+       commit_every rows have been written since the last commit, or
+       the oldest uncommitted write is at least commit_interval seconds
+       old.  This bounds both the amount of work lost in a crash and
+       the time the database's write lock is held, while avoiding the
+       cost of syncing the database to disk after every write.
+
+       The batch limits are only checked when a unit of work starts or
+       ends, or when commit_if_due is called.  A program which waits
+       for user input between units of work should call commit_if_due
+       before it waits, and commit when it is done with the batch;
+       otherwise, pending writes and the write lock are kept for as
+       long as it waits.  Even so, writes made less than
+       commit_interval seconds before the wait remain uncommitted
+       until the next unit of work or commit.
+    """
+    def __init__(self, db_connection, commit_every=COMMIT_EVERY,
+                 commit_interval=COMMIT_INTERVAL):
+        self.db_connection = db_connection
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.depth = 0
+        self.pending_writes = 0
+        self.first_write_time = None
+        self._total_changes = db_connection.total_changes
+
+    @contextlib.contextmanager
+    def unit_of_work(self, commit=False):
+        """Context manager: run a block of statements as a unit of work.
+           If commit is True, the changes are committed as soon as the
+           outermost unit of work completes, regardless of the batch
+           limits.
+        """
+        conn = self.db_connection
+        name = 'unit_of_work_%d' % self.depth
+        # the interval may have run out since the last unit ended
+        self.commit_if_due()
+        with transaction_control(conn):
+            conn.execute("SAVEPOINT %s;" % name)
+            self.depth += 1
+            try:
+                yield conn
+            except:
+                self.depth -= 1
+                conn.execute("ROLLBACK TO %s;" % name)
+                conn.execute("RELEASE %s;" % name)
+                # writes which were rolled back don't need committing
+                self._total_changes = conn.total_changes
+                if not self.depth and not self.pending_writes:
+                    # release the write lock, if the unit acquired it
+                    conn.rollback()
+                raise
+            else:
+                self.depth -= 1
+                conn.execute("RELEASE %s;" % name)
+                self._count_writes()
+                # with no writes pending, committing just ends the
+                # transaction, which is cheap
+                if commit or not self.pending_writes or self.batch_full():
+                    self.commit()
+
+    def batch_full(self):
+        "Returns True if the pending writes should be committed"
+        if not self.pending_writes:
+            return False
+        return (self.pending_writes >= self.commit_every or
+                time.time() - self.first_write_time >= self.commit_interval)
+
+    def commit_if_due(self):
+        """Commit the pending writes if the batch is full.
+           Like commit, this does nothing inside a unit of work.
+        """
+        if self.batch_full():
+            self.commit()
+
+    def commit(self):
+        """Commit all pending writes.
+           Inside a unit of work, this does nothing: committing would
+           end the transaction, and with it the unit's savepoint.  The
+           writes are committed when the outermost unit of work ends.
+        """
+        if self.depth:
+            return
+        self.db_connection.commit()
+        self.pending_writes = 0
+        self.first_write_time = None
+        self._total_changes = self.db_connection.total_changes
+
+    def rollback(self):
+        "Roll back all pending writes"
+        if self.depth:
+            raise sqlite3.ProgrammingError(
+                "Cannot roll back the transaction inside a unit of work")
+        self.db_connection.rollback()
+        self.pending_writes = 0
+        self.first_write_time = None
+        self._total_changes = self.db_connection.total_changes
+
+    def _count_writes(self):
+        "Update the count of uncommitted writes"
+        total = self.db_connection.total_changes
+        if total != self._total_changes:
+            self.pending_writes += total - self._total_changes
+            self._total_changes = total
+            if self.first_write_time is None:
+                self.first_write_time = time.time()
+        
 #            
 # utilities
 #
+
+# maximum number of parameters to bind in a single IN (...) clause;
+# older SQLite versions allow at most 999 parameters per statement
+MAX_QUERY_PARAMS = 500
+
+# sqlite3.Connection.in_transaction requires Python 3.2
+HAS_IN_TRANSACTION = hasattr(sqlite3.Connection, 'in_transaction')
+
+def in_transaction(db_connection):
+    """Returns True if a transaction is open on db_connection.
+       Python 2's sqlite3 module does not report this, so there, only
+       transactions opened by transaction_control are known.
+    """
+    if HAS_IN_TRANSACTION:
+        return db_connection.in_transaction
+    return db_connection.transaction_depth > 0
+
+@contextlib.contextmanager
+def transaction_control(db_connection, begin="BEGIN;"):
+    """Context manager for blocks which control a transaction with
+       SQL statements like SAVEPOINT and RELEASE.  Unless a transaction
+       is already open, one is opened with the statement begin.
+       Yields True if the transaction was opened by this block.
+
+       Python 2's sqlite3 module commits before any statement other
+       than INSERT, UPDATE, DELETE or REPLACE, which would end the
+       transaction at the first SAVEPOINT.  So there, the connection
+       is put in autocommit mode for the outermost such block, which
+       commits any transaction the module began implicitly, and the
+       nesting depth is recorded on the connection.
+    """
+    if HAS_IN_TRANSACTION:
+        began = not db_connection.in_transaction
+        if began:
+            db_connection.execute(begin)
+        yield began
+        return
+
+    depth = db_connection.transaction_depth
+    if not depth:
+        isolation_level = db_connection.isolation_level
+        db_connection.isolation_level = None
+        db_connection.execute(begin)
+    db_connection.transaction_depth = depth + 1
+    try:
+        yield not depth
+    finally:
+        db_connection.transaction_depth = depth
+        if not depth:
+            # the transaction stays open; the sqlite3 module commits
+            # or rolls it back as usual
+            db_connection.isolation_level = isolation_level
+
+@contextlib.contextmanager
+def savepoint(db_connection, name='grade_db_savepoint'):
+    """Context manager: run a block of statements atomically.
+       If the block raises an exception, all of its changes are rolled
+       back; otherwise they are kept as part of the current
+       transaction.  Like other functions in this module, this does
+       not commit: the transaction remains open for the caller to
+       commit.
+    """
+    with transaction_control(db_connection):
+        db_connection.execute("SAVEPOINT %s;" % name)
+        try:
+            yield db_connection
+        except:
+            db_connection.execute("ROLLBACK TO %s;" % name)
+            db_connection.execute("RELEASE %s;" % name)
+            raise
+        else:
+            db_connection.execute("RELEASE %s;" % name)
+
+@contextlib.contextmanager
+def read_transaction(db_connection):
+    """Context manager: run a block of queries against a single,
+       consistent snapshot of the database.
+       Without an explicit transaction, each query sees the database as
+       of the moment it runs, so a report built from several queries
+       may mix data from before and after another connection's
+       writes.  Inside this block, every query sees the same snapshot.
+       In WAL mode, the snapshot does not block writers on other
+       connections, and they do not block it.
+       If a transaction is already open on db_connection, the block
+       simply runs inside it.
+    """
+    with transaction_control(db_connection, "BEGIN DEFERRED;") as began:
+        if not began:
+            yield db_connection
+            return
+
+        try:
+            # a deferred transaction takes its snapshot at the first read
+            db_connection.execute(
+                "SELECT 1 FROM sqlite_master LIMIT 1;").fetchall()
+            yield db_connection
+        except:
+            db_connection.rollback()
+            raise
+        else:
+            db_connection.commit()
+
+def iter_query(db_connection, query, params=(), arraysize=ARRAYSIZE):
+    """Execute a query and return a generator over its result rows.
+       Rows are fetched from the cursor arraysize at a time, so only
+       that many rows are held in memory at once, however large the
+       result set.  The cursor is closed when the generator is
+       exhausted or discarded.
+
+       Since the query runs lazily, the generator should be consumed
+       before the connection is used to modify the tables it reads;
+       use read_transaction to keep several iterators consistent with
+       each other.
+    """
+    cursor = db_connection.cursor()
+    try:
+        cursor.execute(query, params)
+        cursor.arraysize = arraysize
+        while True:
+            rows = cursor.fetchmany()
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        cursor.close()
+
+def iter_pages(select_page, page_key, page_size, after=None):
+    """Return a generator over pages of rows, for keyset pagination.
+       select_page should be a function which, given the key of the
+       last row on the previous page (or after, for the first page),
+       returns a list of at most page_size rows following it.
+       page_key should be a function which returns the key of a row.
+
+       Unlike iter_query, no cursor is held open between pages, so the
+       connection may be used freely, even to modify the rows being
+       paged through, while the generator is suspended.
+    """
+    while True:
+        rows = select_page(after)
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            break
+        after = page_key(rows[-1])
+
+def chunks(seq, size):
+    "Split a sequence into a list of tuples of at most size items"
+    seq = tuple(seq)
+    return [seq[i:i+size] for i in range(0, len(seq), size)]
+
 def ensure_unique(rows, err_msg='', query='', params=None):
     "Ensure a set of rows contains a single value and returns it"
     if len(rows) == 0:
@@ -779,20 +3746,6 @@ def ensure_unique(rows, err_msg='', query='', params=None):
     else:
         return rows[0][0]
 
-def overlay(old_values, new_values):
-    """Overlay a new set of values on an old set.
-       If old_values[i] != new_values[i], uses new_values[i],
-       except if new_values[i] evaluates to False.
-    """
-    overlaid_vals = []
-    for ov, nv in zip(old_values, new_values):
-        if not nv or ov == nv:
-            overlaid_vals.append(ov)
-        else:
-            overlaid_vals.append(nv)
-
-    return overlaid_vals
-
 def make_constraint_clause(connective, fields, values,
                            extra='', extra_params=tuple(),
                            cmp_op="="):
@@ -812,17 +3765,21 @@ def make_constraint_clause(connective, fields, values,
        either side and a parameter place '?' is added to the right
        hand side
     """
-    constraints = []
     params = []
+    used = []
     for f, v in zip(fields, values):
         if v:
-            constraints.append(f + " " + cmp_op + " ?")
             params.append(v)
+            used.append(f)
 
-    if extra:
-        constraints.insert(0, "(" + extra + ")")
-        
-    clause = connective.join(constraints)
+    def build():
+        constraints = [f + " " + cmp_op + " ?" for f in used]
+        if extra:
+            constraints.insert(0, "(" + extra + ")")
+        return connective.join(constraints)
+
+    clause = compiled(('constraint', connective, tuple(used), extra, cmp_op),
+                      build)
     
     return clause, tuple(extra_params) + tuple(params)
 
@@ -842,42 +3799,254 @@ def make_disjunction_clause(fields, values,
                                   extra=extra, extra_params=extra_params,
                                   cmp_op=cmp_op)
 
+def make_keyset_clause(fields, values, extra='', extra_params=tuple()):
+    """Construct a constraint clause selecting the rows which come
+       after values in the order ORDER BY fields, and a tuple of
+       parameters for it.  This is the WHERE clause for keyset
+       pagination: values should be the fields of the last row on the
+       previous page.
+
+       extra and extra_params are as for make_constraint_clause.
+
+       When no value is NULL, this is a row value comparison,
+       e.g. "(field1, field2) > (?, ?)", which SQLite can answer with
+       an index on the fields.  Since NULL sorts before any other
+       value, comparisons with NULL are spelled out.
+    """
+    fields = tuple(fields)
+    values = tuple(values)
+    if len(fields) != len(values):
+        raise ValueError("Expected %d values for keyset clause, got %d" %
+                         (len(fields), len(values)))
+
+    nulls = tuple(v is None for v in values)
+    def build():
+        if not any(nulls):
+            clause = "(%s) > (%s)" % (", ".join(fields),
+                                      ", ".join("?" for f in fields))
+        else:
+            # (f1 > v1) OR (f1 IS v1 AND f2 > v2) OR ...
+            disjuncts = []
+            for i, f in enumerate(fields):
+                terms = [g + " IS ?" for g in fields[:i]]
+                if nulls[i]:
+                    terms.append(f + " IS NOT NULL")
+                else:
+                    terms.append(f + " > ?")
+                disjuncts.append("(" + " AND ".join(terms) + ")")
+            clause = " OR ".join(disjuncts)
+        if extra:
+            return "(" + extra + ") AND (" + clause + ")"
+        return clause
+
+    clause = compiled(('keyset', fields, nulls, extra), build)
+
+    if not any(nulls):
+        params = values
+    else:
+        params = []
+        for i, v in enumerate(values):
+            params.extend(values[:i])
+            if v is not None:
+                params.append(v)
+
+    return clause, tuple(extra_params) + tuple(params)
+
+def add_limit_clause(query, params, limit):
+    """Add a LIMIT clause and its parameter to a query and its
+       parameters, if limit is not None"""
+    if limit is None:
+        return query, params
+    query = compiled(('limit', query), lambda: query.rstrip() + "\n    LIMIT ?")
+    return query, tuple(params) + (limit,)
+
 def add_where_clause(base_query, constraints):
     """Add a WHERE clause to a query if there are any constraints.
        base_query should be a dictionary-style format string
        containing the format specifier %(where)s and constraints
        should be a string of field constraints.
     """
-    if constraints:
-        where_clause = "WHERE " + constraints
-        query = base_query % {'where': where_clause}
-    else:
-        query = base_query % {'where': ''}
+    def build():
+        if constraints:
+            return base_query % {'where': "WHERE " + constraints}
+        else:
+            return base_query % {'where': ''}
 
-    return query
+    return compiled(('where', base_query, constraints), build)
 
 def make_values_clause(fields, values):
     """Construct strings of field names and query parameter places, and
        a tuple of parameters"""
     used_fields = []
     params = []
-    places = []
     
     for i, v in enumerate(values):
         if v:
             used_fields.append(fields[i])
             params.append(values[i])
-            places.append('?')
-    
-    return ', '.join(used_fields), ', '.join(places), tuple(params)
 
-def last_insert_rowid(db_connection):
-    "Returns the id of the last inserted row"
-    return ensure_unique(
-        db_connection.execute("SELECT last_insert_rowid()").fetchall())
-
-def num_changes(db_connection):
-    "Returns the number of rows affected by the last INSERT, UPDATE, or DELETE"
-    return ensure_unique(
-        db_connection.execute("SELECT changes()").fetchall())
+    fields_str, places = compiled(
+        ('values', tuple(used_fields)),
+        lambda: (', '.join(used_fields), ', '.join('?' for f in used_fields)))
+    
+    return fields_str, places, tuple(params)
+
+def make_upsert_query(table, conflict_fields, fields, values,
+                      returning=False):
+    """Construct an INSERT ... ON CONFLICT DO UPDATE query and a tuple of
+       parameters.
+       Only the fields with non-empty values are inserted; on a
+       conflict with an existing row on conflict_fields, those fields
+       (except the conflict fields themselves) are updated, and the
+       row's other fields are left unchanged.
+       If returning is True, the query returns the id of the inserted
+       or updated row (see returning_id).
+       Requires SQLite 3.24 or later.
+    """
+    used_fields = [f for f, v in zip(fields, values) if v]
+
+    def build():
+        fields_str, places, params = make_values_clause(fields, values)
+        updates = ', '.join('%s=excluded.%s' % (f, f) for f in used_fields
+                            if f not in conflict_fields)
+        if updates:
+            action = 'DO UPDATE SET ' + updates
+        else:
+            action = 'DO NOTHING'
+        query = ("INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (%s) %s;" %
+                 (table, fields_str, places, ', '.join(conflict_fields),
+                  action))
+        if returning:
+            query = returning_id(query)
+        return query
+
+    query = compiled(('upsert', table, tuple(conflict_fields),
+                      tuple(used_fields), returning),
+                     build)
+    return query, tuple(v for v in values if v)
+
+def returning_id(query):
+    """Add a RETURNING id clause to an INSERT or UPDATE query, if SQLite
+       supports it (3.35 or later); otherwise return the query
+       unchanged.
+       With the clause, the query returns the id of each row it inserts
+       or updates, without a second query.  (After an upsert which
+       updates an existing row, cursor.lastrowid does not give its id.)
+    """
+    if not HAS_RETURNING:
+        return query
+    return compiled(('returning', query),
+                    lambda: query.rstrip().rstrip(';') + " RETURNING id;")
+
+# Cache of generated SQL.  The query builders above produce the same
+# SQL text whenever they are given the same query template and the
+# same set of non-empty fields, so we memoize that text: this skips
+# the string building in Python, and since identical SQL text hits
+# sqlite3's per-connection statement cache (see the cached_statements
+# argument to connect), SQLite does not need to re-parse it either.
+QUERY_CACHE_SIZE = 1024
+_compiled_queries = {}
+
+def compiled(key, build):
+    """Return the SQL generated by build() for a given cache key.
+       key should be a hashable value that determines the output of
+         build, e.g., a query template and the set of non-empty fields
+         it will be constrained on.
+       build should be a function of no arguments that generates the
+         SQL; it is only called if key is not already in the cache.
+    """
+    try:
+        return _compiled_queries[key]
+    except KeyError:
+        pass
+    if len(_compiled_queries) >= QUERY_CACHE_SIZE:
+        # the set of distinct queries is small in practice, so a
+        # full cache usually indicates a leak (e.g., values being
+        # formatted into SQL); start over rather than grow unbounded
+        _compiled_queries.clear()
+    sql = _compiled_queries[key] = build()
+    return sql
+
+def rebuild_table(db_connection, table, create_sql):
+    """Rebuild a table with a new definition, keeping its data.
+       create_sql should be a CREATE TABLE statement for the new
+         definition, with %(table)s in place of the table name.
+       Data in the columns the old and new definitions have in common
+         is copied to the new table.  The table's indexes and triggers
+         are recreated on the new table.  (Indexes created by UNIQUE
+         constraints must be part of create_sql.)
+       This follows the procedure for altering tables recommended by
+       SQLite (https://www.sqlite.org/lang_altertable.html).  It must
+       be run inside a transaction, with foreign key enforcement
+       turned off, as gradedb_migrate does; otherwise dropping the old
+       table would delete the rows that refer to it.
+    """
+    new_table = table + '_new'
+    schema = [r[0] for r in db_connection.execute(
+        "SELECT sql FROM sqlite_master "
+        "WHERE tbl_name=? AND type IN ('index', 'trigger') "
+        "AND sql IS NOT NULL;", (table,)).fetchall()]
+    old_columns = [r[1] for r in db_connection.execute(
+        "PRAGMA table_info(%s);" % table).fetchall()]
+
+    execute_script(db_connection, create_sql % {'table': new_table})
+    new_columns = [r[1] for r in db_connection.execute(
+        "PRAGMA table_info(%s);" % new_table).fetchall()]
+    columns = ', '.join(c for c in new_columns if c in old_columns)
+    db_connection.execute("INSERT INTO %s (%s) SELECT %s FROM %s;" %
+                          (new_table, columns, columns, table))
+    db_connection.execute("DROP TABLE %s;" % table)
+    # triggers on other tables may refer to the table (e.g., those of
+    # the grade matrix); in legacy mode, RENAME does not try to
+    # rewrite them while the table is missing
+    db_connection.execute("PRAGMA legacy_alter_table = ON;")
+    try:
+        db_connection.execute("ALTER TABLE %s RENAME TO %s;" %
+                              (new_table, table))
+    finally:
+        db_connection.execute("PRAGMA legacy_alter_table = OFF;")
+    for sql in schema:
+        db_connection.execute(sql)
+
+def make_timestamp(value=None):
+    """Convert a time to a grade timestamp.
+       Grade timestamps are integers: microseconds since the Unix
+       epoch.  value may be a datetime (if it is naive, it is taken to
+       be in local time, like datetime.datetime.now()) or an integer
+       timestamp, which is returned unchanged.  If value is None, the
+       current time is used.
+    """
+    if value is None:
+        return int(time.time() * 1000000)
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            seconds = time.mktime(value.timetuple())
+        else:
+            seconds = calendar.timegm(value.utctimetuple())
+        return int(seconds) * 1000000 + value.microsecond
+    return int(value)
+
+def timestamp_to_datetime(timestamp):
+    "Convert a grade timestamp to a naive datetime in local time"
+    if timestamp is None:
+        return None
+    seconds, microseconds = divmod(timestamp, 1000000)
+    return (datetime.datetime.fromtimestamp(seconds) +
+            datetime.timedelta(microseconds=microseconds))
+
+def execute_script(db_connection, script):
+    """Execute each statement in a SQL script.
+       Unlike sqlite3.Connection.executescript, this function does not
+       COMMIT before executing the script, so it may be used inside a
+       transaction.
+    """
+    statement = ''
+    for line in script.splitlines(True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            db_connection.execute(statement)
+            statement = ''
+    if statement.strip():
+        raise sqlite3.ProgrammingError("Incomplete SQL statement: %s" %
+                                       statement)
 
@@ -0,0 +1,194 @@
+"""
+pool.py
+
+Thread-safe pool of grade database connections
+"""
+# This file is part of the schoolutils package.
+# Copyright (C) 2013 Richard Lawrence <richard.lawrence@berkeley.edu>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import sqlite3, threading, contextlib, time
+
+from schoolutils.grading import db
+
+class PoolTimeout(db.ConnectionError):
+    pass
+
+class PoolClosed(db.ConnectionError):
+    pass
+
+class ConnectionPool(object):
+    """A pool of connections to a single grade database, which may be
+       shared by many threads.
+
+       Usage:
+         pool = ConnectionPool('/path/to/grades.db', size=4)
+         with pool.connection() as conn:
+             students = db.select_students(conn, course_id=course_id)
+
+       Connections are ordinary connections made by db.connect, so all
+       of the select_* and create_* functions in db work with them
+       unchanged.  A thread holds at most one connection at a time:
+       nested calls to connection() in the same thread return the
+       connection the thread has already checked out.
+    """
+    def __init__(self, path, size=5, timeout=30.0, **connect_args):
+        """Create a connection pool.
+           path is the path of the grade database.
+           size is the maximum number of open connections.  Connections
+             are opened as they are needed, up to this limit.
+           timeout is the number of seconds to wait for a connection
+             when all of them are checked out, before raising
+             PoolTimeout.  None means wait forever.
+           Any other keyword arguments are passed to db.connect.
+        """
+        if size < 1:
+            raise ValueError("Connection pool size must be at least 1")
+
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.connect_args = connect_args
+        self.connect_args['check_same_thread'] = False
+
+        self._idle = []
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._num_open = 0
+        self._closed = False
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Context manager: check out a connection from the pool.
+           If the block completes normally, its transaction is
+           committed; if it raises an exception, the transaction is
+           rolled back.  Either way, the connection is returned to the
+           pool afterward.
+        """
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        if conn is not None:
+            # already checked out by this thread; the outermost block
+            # commits or rolls back
+            yield conn
+            return
+
+        conn = self._checkout()
+        local.conn = conn
+        try:
+            yield conn
+        except:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+        finally:
+            local.conn = None
+            self._checkin(conn)
+
+    def close(self):
+        """Close all connections in the pool.
+           Connections which are checked out are closed when they are
+           returned.  After closing, no more connections may be checked
+           out.
+        """
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for conn in idle:
+            self._discard(conn)
+
+    def _checkout(self):
+        """Get a healthy connection from the pool.
+           Reuses an idle connection if there is one, opens a new one
+           if the pool is below its size limit, and otherwise waits for
+           another thread to return one."""
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        while True:
+            conn = None
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolClosed("Connection pool is closed")
+                    if self._idle:
+                        conn = self._idle.pop()
+                        break
+                    if self._num_open < self.size:
+                        self._num_open += 1
+                        break
+                    if self.timeout is None:
+                        self._cond.wait()
+                        continue
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolTimeout(
+                            "No connection available after %s seconds" %
+                            self.timeout)
+                    self._cond.wait(remaining)
+
+            if conn is None:
+                try:
+                    return db.connect(self.path, **self.connect_args)
+                except:
+                    with self._cond:
+                        self._num_open -= 1
+                        self._cond.notify()
+                    raise
+
+            if is_healthy(conn):
+                return conn
+            self._discard(conn)
+
+    def _checkin(self, conn):
+        "Return a connection to the pool"
+        if self._closed or not is_healthy(conn):
+            self._discard(conn)
+            return
+        with self._cond:
+            # most recently used connections are handed out first,
+            # since their page caches are most likely to be warm
+            self._idle.append(conn)
+            self._cond.notify()
+
+    def _discard(self, conn):
+        "Close a connection and make room for another in the pool"
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._cond:
+            self._num_open -= 1
+            self._cond.notify()
+
+#
+# utilities
+#
+def is_healthy(conn):
+    """Check that a pooled connection is usable.
+       A connection is healthy if it is open, responds to a trivial
+       query, and has no transaction left open by a previous user.
+    """
+    try:
+        conn.execute("SELECT 1;").fetchall()
+        # rolling back does nothing if no transaction is open.  (Python
+        # 2's sqlite3 does not provide Connection.in_transaction.)
+        conn.rollback()
+        return True
+    except sqlite3.Error:
+        return False
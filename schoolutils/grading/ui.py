@@ -30,7 +30,7 @@ except NameError:
     pass
 
 # imports compatible across Python versions
-import os, sys, csv, datetime, tempfile
+import os, sys, csv, datetime, tempfile, sqlite3, time, contextlib
 
 from schoolutils.config import user_config, user_calculators
 from schoolutils.grading import db, validators
@@ -77,6 +77,8 @@ class BaseUI(object):
         self.current_courses = []
         self.course_id = None
         self.assignment_id = None
+        self.transactions = None
+        self.tracer = None
 
         self.initial_database_setup()
         self.initial_course_setup()
@@ -103,14 +105,44 @@ class BaseUI(object):
     def initial_database_setup(self):
         "Set db_file and db_connection from user config and CLI options"
         self.db_file = self.get_config_option('gradedb_file', file_path)
+        self.db_profile = self.get_config_option('gradedb_profile',
+                                                 connection_profile)
+        self.commit_every = self.get_config_option('gradedb_commit_every',
+                                                   positive_int,
+                                                   db.COMMIT_EVERY)
+        self.commit_interval = self.get_config_option(
+            'gradedb_commit_interval', positive_float, db.COMMIT_INTERVAL)
+        self.in_memory = self.get_config_option('gradedb_in_memory', bool,
+                                                False)
+        self.snapshot_interval = self.get_config_option(
+            'gradedb_snapshot_interval', positive_float, db.SNAPSHOT_INTERVAL)
+        self.tracer = self.make_tracer()
         if self.db_file and os.path.exists(self.db_file):
             try:
-                self.db_connection = db.connect(self.db_file, create=False)
+                self.db_connection = self.open_database(self.db_file)
             except db.ConnectionError:
                 self.db_connection = None
         else:
             self.db_connection = None
 
+
+    def open_database(self, path, create=False):
+        """Connect to the grade database at path with the configured
+           connection settings, and report any rows the connection
+           found orphaned (see report_orphaned_rows)"""
+        conn = db.connect(path, create=create, profile=self.db_profile,
+                          tracer=self.tracer, in_memory=self.in_memory)
+        orphans = db.orphaned_rows(conn)
+        if orphans:
+            self.report_orphaned_rows(path, orphans)
+        return conn
+
+    def report_orphaned_rows(self, path, orphans):
+        """Tell the user about rows of the database at path which were
+           set aside when it was upgraded, because they referred to
+           missing records.  orphans is as returned by
+           db.orphaned_rows."""
+        pass
             
     def initial_course_setup(self):
         """Set semester, year, current_courses, and course_id from user config
@@ -150,6 +182,70 @@ class BaseUI(object):
             except AttributeError: # select_last_due_assignment is currently defined by SimpleUI
                 sys.stderr.write("Ignoring use_last_due_assignment.\n")
 
+
+    def make_tracer(self):
+        """Return a QueryTracer if the user asked to trace SQL statements
+           (with --trace-sql), or None"""
+        trace_path = getattr(self.cli_options, 'trace_sql', None)
+        if not trace_path:
+            return None
+        if trace_path == '-':
+            log = sys.stderr
+        else:
+            # line buffered, so the log is complete up to the last
+            # statement even if the program dies
+            log = open(file_path(trace_path), 'a', 1)
+        slow_ms = getattr(self.cli_options, 'slow_query_ms', None)
+        if slow_ms is None:
+            slow_query_time = db.SLOW_QUERY_TIME
+        else:
+            slow_query_time = slow_ms / 1000.0
+        return db.QueryTracer(log=log, slow_query_time=slow_query_time)
+
+    @contextlib.contextmanager
+    def unit_of_work(self, commit=False):
+        """Context manager: run a unit of work on the current
+           database.  See db.TransactionManager."""
+        if (self.transactions is None or
+            self.transactions.db_connection is not self.db_connection):
+            self.transactions = db.TransactionManager(
+                self.db_connection,
+                commit_every=self.commit_every,
+                commit_interval=self.commit_interval)
+        with self.transactions.unit_of_work(commit=commit) as conn:
+            yield conn
+        self.snapshot_if_due()
+
+    def commit(self):
+        "Commit any pending changes to the current database"
+        if not self.db_connection:
+            return
+        if (self.transactions and
+            self.transactions.db_connection is self.db_connection):
+            self.transactions.commit()
+        else:
+            self.db_connection.commit()
+        self.snapshot_if_due()
+
+    def commit_if_due(self):
+        """Commit pending changes to the current database if enough of
+           them have been made, or the oldest is old enough; see
+           db.TransactionManager.  Call this before waiting for user
+           input in the middle of an action."""
+        if (self.transactions and
+            self.transactions.db_connection is self.db_connection):
+            self.transactions.commit_if_due()
+            self.snapshot_if_due()
+
+    def snapshot_if_due(self):
+        """Write an in-memory database back to its file, if the last
+           snapshot is at least snapshot_interval seconds old and no
+           changes are waiting to be committed.  See db.snapshot."""
+        conn = self.db_connection
+        if not (conn and conn.in_memory) or db.in_transaction(conn):
+            return
+        if time.time() - conn.snapshot_time >= self.snapshot_interval:
+            db.snapshot(conn)
        
 
 class SimpleUI(BaseUI):
@@ -182,6 +278,21 @@ class SimpleUI(BaseUI):
         pass
    
     # BaseUI overrides
+    def report_orphaned_rows(self, path, orphans):
+        """Warn about rows set aside when the database was upgraded.
+           See db.add_cascading_deletes."""
+        print("")
+        print("WARNING: when the database at %s was upgraded, some rows\n"
+              "referred to courses, assignments or students that no longer\n"
+              "exist.  They were not deleted, but moved to these tables, and\n"
+              "are not shown by this program:" % path)
+        for table in sorted(orphans):
+            print("  orphaned_%s: %d rows" % (table, orphans[table]))
+        print("Once you have recovered any data you need from them, you can\n"
+              "discard them with, e.g.:\n"
+              "  sqlite3 %s 'DROP TABLE orphaned_grades;'" % path)
+        print("")
+
     def initial_database_setup(self):
         """Set db_file and db_connection from user config and CLI options.
            Query the user if automatic database connection fails."""
@@ -196,14 +307,15 @@ class SimpleUI(BaseUI):
             prompt = "No existing database at %s.\nCreate? (Y/N) " % self.db_file
             if typed_input(prompt, yn_bool):
                 try:
-                    self.db_connection = db.connect(self.db_file, create=True)
+                    self.db_connection = self.open_database(self.db_file,
+                                                            create=True)
                 except db.ConnectionError as e:
                     err_msg = ("FAILED to create database at {path}.\n"
                                "Error was: {err}".format(path=self.db_file, err=e))
         else:
             # retry automatic connection, mostly to get error message
             try:
-                self.db_connection = db.connect(self.db_file, create=False)
+                self.db_connection = self.open_database(self.db_file)
             except db.ConnectionError as e:
                 err_msg = ("FAILED to open file at {path} as a grade database.\n"
                            "Error was: {err}".format(path=self.db_file, err=e))
@@ -227,9 +339,10 @@ class SimpleUI(BaseUI):
         """Close the current database connection."""
         if self.db_connection:
             print("Closing current database located at: %s" % self.db_file)
-            self.db_connection.commit()
+            self.commit()
             self.db_connection.close()
             self.db_connection = None
+            self.transactions = None
             self.db_file = None
             # these fields will now be invalid, so erase them too:
             self.course_id = None
@@ -250,7 +363,7 @@ class SimpleUI(BaseUI):
                 yn_bool)
         try:
             self.db_file = db_path
-            self.db_connection = db.connect(db_path, create=create)
+            self.db_connection = self.open_database(db_path, create=create)
         except db.ConnectionError as e:
             print("Could not open {path} as a grade database.\n"
                   "Error was: {err}".format(path=db_path, err=e))
@@ -386,12 +499,12 @@ class SimpleUI(BaseUI):
                  #self.import_grades,
                  self.export_grades,
                  self.grade_report,
+                 self.archive_semesters,
                  self.exit])
 
             # commit after successful completion of any top-level action
             # to avoid data-loss
-            if self.db_connection:
-                self.db_connection.commit()
+            self.commit()
 
            
     @require('db_connection', change_database,
@@ -640,6 +753,7 @@ class SimpleUI(BaseUI):
         print("Use Control-C to finish entering grades.")
         while True:
             try:
+                self.commit_if_due()
                 student = self.get_student()
                 # avoid entering grades for non-member students:
                 try:
@@ -655,16 +769,27 @@ class SimpleUI(BaseUI):
                             course=self.course_formatter(course)))
                     # offer to add to course, but don't refuse to continue if not
                     if typed_input("Add this student to the course? (Y/N) ", yn_bool):
-                        db.create_course_member(self.db_connection,
-                                                student_id=student['id'],
-                                                course_id=self.course_id)
+                        with self.unit_of_work():
+                            db.create_course_member(self.db_connection,
+                                                    student_id=student['id'],
+                                                    course_id=self.course_id)
                     else:
                         print("WARNING: grades for this student will not be "
                               "calculated or reported unless you add him or her "
                               "to the course later.")
                            
-                grade_id = None
                 grade_val = typed_input("Enter grade value: ", grade_validator)
+                # in the usual case, where the student has no grade
+                # yet, this saves the grade in a single statement
+                with self.unit_of_work():
+                    grade_id = db.create_grade_if_absent(
+                        self.db_connection,
+                        assignment_id=self.assignment_id,
+                        student_id=student['id'],
+                        value=grade_val)
+                if grade_id:
+                    continue
+
                 existing_grades = db.select_grades(self.db_connection,
                                                    student_id=student['id'],
                                                    course_id=self.course_id,
@@ -687,12 +812,25 @@ class SimpleUI(BaseUI):
                                     g['assignment_name'],
                                     g['value']))
                         grade_id = grade['id']
-
-                db.create_or_update_grade(self.db_connection,
-                                          grade_id=grade_id,
-                                          assignment_id=self.assignment_id,
-                                          student_id=student['id'],
-                                          value=grade_val)
+                    elif self.db_connection.unique_grades:
+                        # the database allows only one grade per
+                        # student per assignment
+                        print("Grade not saved.")
+                        continue
+
+                with self.unit_of_work():
+                    if grade_id:
+                        db.create_or_update_grade(
+                            self.db_connection,
+                            grade_id=grade_id,
+                            assignment_id=self.assignment_id,
+                            student_id=student['id'],
+                            value=grade_val)
+                    else:
+                        db.create_grade(self.db_connection,
+                                        assignment_id=self.assignment_id,
+                                        student_id=student['id'],
+                                        value=grade_val)
                                           
             except KeyboardInterrupt:
                 print("")
@@ -721,7 +859,7 @@ class SimpleUI(BaseUI):
             print("Editing grades for %s." % self.student_formatter(tbl_row['student']))
             
             prompt = "New grade value for %s (default: %s): "
-            any_updates = False
+            updates = []
             for g in tbl_row['grades']:
                 grade_validator = validators.validator_for_grade_type(g['grade_type'])
                 old_val = g['value']
@@ -735,15 +873,20 @@ class SimpleUI(BaseUI):
                 if new_val == old_val:
                     continue
                 elif new_val:
-                    any_updates = True
-                    new_grade_id = db.create_or_update_grade(
+                    updates.append((g, new_val))
+
+            # save the student's new grades together, once they have
+            # all been entered
+            with self.unit_of_work():
+                for g, new_val in updates:
+                    db.create_or_update_grade(
                         self.db_connection,
                         student_id=g['student_id'],
                         assignment_id=g['assignment_id'],
                         grade_id=g['grade_id'], # may be None if grade didn't exist
                         value=new_val)
 
-            if any_updates:
+            if updates:
                 return {
                     'student': tbl_row['student'],
                     'grades': db.select_grades_for_course_members(
@@ -755,15 +898,9 @@ class SimpleUI(BaseUI):
                 return tbl_row
 
             
-        students = db.select_students(self.db_connection,
-                                      course_id=self.course_id)
-        all_grades = db.select_grades_for_course_members(
-            self.db_connection,
-            course_id=self.course_id)
-        rows = [
-            {'student': s,
-             'grades': [r for r in all_grades if r['student_id'] == s['id']]}
-            for s in students]
+        rows = [{'student': s, 'grades': grades}
+                for s, grades in db.iter_students_with_grades(
+                        self.db_connection, self.course_id)]
 
         # we use select_assignments here because it orders the
         # assignments by due date
@@ -809,25 +946,13 @@ class SimpleUI(BaseUI):
                                    editor=editor, creator=creator,
                                    deleter=lambda s: True)
 
-        for s in students:
-            try:
-                s['student_id'] = db.get_student_id(self.db_connection,
-                                                    sid=s['sid'],
-                                                    first_name=s['first_name'],
-                                                    last_name=s['last_name'])
-            except db.NoRecordsFound:
-                s['student_id'] = None
-
-            student_id = db.create_or_update_student(
+        with self.unit_of_work(commit=True):
+            student_ids = db.upsert_students_bulk(self.db_connection,
+                                                  students)
+            db.create_course_members_bulk(
                 self.db_connection,
-                sid=s['sid'],
-                first_name=s['first_name'],
-                last_name=s['last_name'],
-                email=s['email'])
-            course_member_id = db.create_course_member(
-                self.db_connection,
-                student_id=student_id,
-                course_id=self.course_id)
+                [{'student_id': student_id, 'course_id': self.course_id}
+                 for student_id in student_ids])
 
         print("%d students imported successfully." % len(students))
 
@@ -940,17 +1065,19 @@ class SimpleUI(BaseUI):
                   self.student_formatter(student))
             return True
 
-        current_students = db.select_students(self.db_connection,
-                                              course_id=self.course_id)
+        # fetch the roster a page at a time, as it is shown
+        pages = db.iter_student_pages(self.db_connection,
+                                      course_id=self.course_id)
         current_course = db.select_courses(self.db_connection,
                                            course_id=self.course_id)[0]
         self.edit_table(
-            current_students,
+            next(pages, []),
             "Current students in %s" % self.course_formatter(current_course),
             self.student_formatter,
             creator=add_to_course,
             deleter=remove_from_course,
-            entity_type="student's membership")
+            entity_type="student's membership",
+            more=lambda: next(pages, []))
         print("Course enrollments updated.")
  
     def import_grades(self):
@@ -974,49 +1101,46 @@ class SimpleUI(BaseUI):
 
         out_file = open(out_file_name, 'w')
         
-        # format, for now:
-        # last_name + first_name, sid, grade1, grade2, grade3...
-        # we use select_assignments here because it orders the
-        # assignments by due date
-        assignments = db.select_assignments(self.db_connection,
-                                            course_id=self.course_id)
-        assignment_names = [a['name'] for a in assignments]
-        header = ["Name", "SID"] + assignment_names
-        writer = csv.DictWriter(out_file, header)
-        
-        students = db.select_students(self.db_connection,
-                                      course_id=self.course_id)
-
-        # writeheader() became available in Python 2.7:
-        try:
-            writer.writeheader()
-        except AttributeError:
-            writer.writerow(dict(zip(header,header)))
-
-        all_grades = db.select_grades_for_course_members(
-            self.db_connection,
-            course_id=self.course_id)
+        # read everything from one consistent snapshot of the database
+        with db.read_transaction(self.db_connection):
+            # format, for now:
+            # last_name + first_name, sid, grade1, grade2, grade3...
+            # we use select_assignments here because it orders the
+            # assignments by due date
+            assignments = db.select_assignments(self.db_connection,
+                                                course_id=self.course_id)
+            assignment_names = [a['name'] for a in assignments]
+            header = ["Name", "SID"] + assignment_names
+            writer = csv.DictWriter(out_file, header)
         
-        for s in students:
-            row = {}
-            row["Name"] = "%s, %s" % (s['last_name'], s['first_name'])
-            row["SID"] = s['sid']
-            grades = [r for r in all_grades if r['student_id'] == s['id']]
-            for g in grades:
-                assignment_name = g['assignment_name']
-                if assignment_name not in row:
-                    row[assignment_name] = g['value']
-                else:
-                    print("Warning: multiple grades found for student %s "
-                          "for assignment %s; only exporting first result."
-                          % (self.student_formatter(s), assignment_name))
-                    continue
-            
+            # writeheader() became available in Python 2.7:
             try:
-                writer.writerow(row)
-            except IOError:
-                print("Warning: could not write row to CSV: %r." % row)
-                continue
+                writer.writeheader()
+            except AttributeError:
+                writer.writerow(dict(zip(header,header)))
+
+            # stream students and their grades one at a time, rather
+            # than loading the whole course into memory
+            for s, grades in db.iter_students_with_grades(
+                    self.db_connection, self.course_id):
+                row = {}
+                row["Name"] = "%s, %s" % (s['last_name'], s['first_name'])
+                row["SID"] = s['sid']
+                for g in grades:
+                    assignment_name = g['assignment_name']
+                    if assignment_name not in row:
+                        row[assignment_name] = g['value']
+                    else:
+                        print("Warning: multiple grades found for student %s "
+                              "for assignment %s; only exporting first result."
+                              % (self.student_formatter(s), assignment_name))
+                        continue
+            
+                try:
+                    writer.writerow(row)
+                except IOError:
+                    print("Warning: could not write row to CSV: %r." % row)
+                    continue
 
         out_file.close()
         print("Grades exported successfully to: %s.\n" % out_file_name)
@@ -1048,46 +1172,30 @@ class SimpleUI(BaseUI):
                 raise ValueError("No value given for calculated grade %s." % name)
 
             if grade_id:
-                db.update_grade(self.db_connection,
-                                student_id=student_id,
-                                grade_id=grade_id,
-                                value=value)
-                return grade_id
+                updated_grades[grade_id] = value
+                return
 
             if not assignment_id:
-                try:
-                    assignment_id = db.ensure_unique(db.select_assignments(
-                        self.db_connection,
-                        course_id=self.course_id,
-                        name=name))
-                except db.NoRecordsFound:
-                    assignment_id = db.create_assignment(
-                        self.db_connection,
-                        course_id=self.course_id,
-                        name=name,
+                ids = assignment_ids.get(name)
+                if not ids:
+                    # the assignment is created after the loop over
+                    # students, whose cursor is still open
+                    new_assignments.setdefault(name, dict(
                         description=description,
                         grade_type=grade_type,
                         due_date=due_date,
-                        weight=weight)
-                # MultipleRecordsFound should propagate
+                        weight=weight))
+                    new_grades[(student_id, name)] = value
+                    return
+                elif len(ids) > 1:
+                    raise db.MultipleRecordsFound(
+                        "Multiple assignments named %s in this course" % name)
+                else:
+                    assignment_id = ids[0]
                 
-            # avoid storing calculated grades multiple times
-            try:
-                grade_id = db.ensure_unique(
-                    db.select_grades(self.db_connection,
-                                     student_id=student_id,
-                                     assignment_id=assignment_id))
-            except db.NoRecordsFound:
-                grade_id = None
-                                            
-            row_id = db.create_or_update_grade(
-                self.db_connection,
-                student_id=student_id,
-                assignment_id=assignment_id,
-                grade_id=grade_id,
-                value=value)
-
-            return row_id
+            # saving replaces any existing grade, which avoids
+            # storing calculated grades multiple times
+            saved_grades[(student_id, assignment_id)] = value
         
                                   
         course = db.select_courses(self.db_connection,
@@ -1103,31 +1211,62 @@ class SimpleUI(BaseUI):
             print("")
             return
 
-        students = db.select_students(self.db_connection,
-                                      course_id=self.course_id)
-        all_grades = db.select_grades_for_course_members(
-                self.db_connection,
-                course_id=self.course_id)
-        
-        for s in students:
-            grades = [r for r in all_grades
-                      if (r['student_id'] == s['id'] and r['weight'] != 'CALC')]
-
-            try:
-                calculated_grades = calc_func(grades)
-            except Exception as e:
-                print("Failed to calculate grades for %s. "
-                      "Error was: %s.  Skipping..." %
-                      (self.student_formatter(s), e))
-                continue
-            if type(calculated_grades) is dict:
-                # transpose to the list format to use save_calculated_grades
-                calculated_grades = [
-                    {'name': k, 'value': v}
-                    for k, v in calculated_grades.items()]
+        # run all the calculations as one unit of work, so a failure
+        # leaves no partially-saved grades behind
+        with self.unit_of_work(commit=True):
+            # look up assignments once, and save calculated grades in
+            # bulk after all calculations have run
+            assignment_ids = {}
+            for a in db.select_assignments(self.db_connection,
+                                           course_id=self.course_id):
+                assignment_ids.setdefault(a['name'], []).append(a['id'])
+            saved_grades = {}
+            updated_grades = {}
+            new_assignments = {}
+            new_grades = {}
+
+            # stream students and their grades one at a time; nothing is
+            # written until the loop is done
+            for s, student_grades in db.iter_students_with_grades(
+                    self.db_connection, self.course_id):
+                grades = [r for r in student_grades if r['weight'] != 'CALC']
 
-            for cg in calculated_grades:
-                save_calculated_grade(s['id'], **cg)
+                try:
+                    calculated_grades = calc_func(grades)
+                except Exception as e:
+                    print("Failed to calculate grades for %s. "
+                          "Error was: %s.  Skipping..." %
+                          (self.student_formatter(s), e))
+                    continue
+                if type(calculated_grades) is dict:
+                    # transpose to the list format to use save_calculated_grades
+                    calculated_grades = [
+                        {'name': k, 'value': v}
+                        for k, v in calculated_grades.items()]
+
+                for cg in calculated_grades:
+                    save_calculated_grade(s['id'], **cg)
+
+            for name, assignment in new_assignments.items():
+                assignment_id = db.create_assignment(
+                    self.db_connection,
+                    course_id=self.course_id,
+                    name=name,
+                    **assignment)
+                assignment_ids[name] = [assignment_id]
+            for (student_id, name), value in new_grades.items():
+                saved_grades[(student_id, assignment_ids[name][0])] = value
+
+            db.update_grades_bulk(
+                self.db_connection,
+                [{'grade_id': grade_id, 'value': value}
+                 for grade_id, value in updated_grades.items()])
+            db.upsert_grades_bulk(
+                self.db_connection,
+                [{'student_id': student_id, 'assignment_id': assignment_id,
+                  'value': value}
+                 for (student_id, assignment_id), value
+                 in saved_grades.items()])
 
         print("Grade calculations ran successfully.\n")
 
@@ -1159,10 +1298,61 @@ class SimpleUI(BaseUI):
                 t.write(report_bytes)
                 print("Full report saved at: %s\n" % t.name)
 
+    @require('db_connection', change_database,
+             "A database connection is required to archive semesters.")
+    def archive_semesters(self):
+        """Archive a semester.
+           Move a past semester's courses and grades to an archive database."""
+        year = typed_input("Enter year of semester to archive: ",
+                           validators.year)
+        semester = typed_input("Enter semester to archive: ",
+                               validators.semester)
+        courses = db.select_courses(self.db_connection,
+                                    year=year, semester=semester)
+        if not courses:
+            print("No courses found for %s %s." % (semester, year))
+            return
+
+        print("The following courses, with their assignments and grades, "
+              "will be moved to the archive:")
+        for c in courses:
+            print(self.course_formatter(c))
+        archive_path = typed_input("Enter path to archive database: ",
+                                   file_path)
+        if (self.db_file and
+            os.path.abspath(archive_path) == os.path.abspath(self.db_file)):
+            print("The archive must be a different file than the current "
+                  "database.")
+            return
+        if not typed_input("Move these courses to %s? (Y/N) " % archive_path,
+                           yn_bool):
+            print("Abort.")
+            return
+
+        self.commit()
+        try:
+            counts = db.archive_semesters(self.db_connection, archive_path,
+                                          [(year, semester)])
+        except (sqlite3.Error, db.GradeDBException) as e:
+            print("FAILED to archive %s %s; no changes were made.\n"
+                  "Error was: %s" % (semester, year, e))
+            return
+
+        if self.course_id in [c['id'] for c in courses]:
+            # these fields refer to courses that have been moved
+            self.course_id = None
+            self.assignment_id = None
+        print("Archived %(courses)d courses, with %(assignments)d assignments "
+              "and %(grades)d grades." % counts)
+
     def exit(self):
         """Quit grader.
            Closes database connection and exits."""
         self.close_database()
+        if self.tracer:
+            self.tracer.log.write(self.tracer.summary())
+            if self.tracer.log is not sys.stderr:
+                self.tracer.log.close()
         exit(0)
         
     # Helper methods:
@@ -1206,6 +1396,10 @@ class SimpleUI(BaseUI):
                         default=actions.index(default) if default in actions else None)
         print("") # visually separate menu and selection 
         
+        if self.tracer:
+            # attribute traced statements to the selected action
+            with self.tracer.section(actions[i].__name__):
+                return actions[i]()
         return actions[i]()
 
     def options_menu(self, query, options, formatter,
@@ -1251,7 +1445,8 @@ class SimpleUI(BaseUI):
             return None
 
     def edit_table(self, rows, header, formatter, editor=None,
-                   creator=None, deleter=None, selector=None, entity_type='row'):
+                   creator=None, deleter=None, selector=None, entity_type='row',
+                   more=None):
         """Present a simple interface for reviewing and editing tabular data.
            rows should be a sequence of values for the user to review and edit
            header should be a string to print above the table
@@ -1272,9 +1467,14 @@ class SimpleUI(BaseUI):
              is made, False otherwise.
            entity_type, if provided, will be used instead of the generic name 'row'
              when displaying the prompts for selecting, editing, creating, etc.
+           more, if provided, should be a function with no arguments which
+             returns the next page of rows, or an empty list if there are no
+             more.  rows is then the first page, and only the latest page
+             is displayed; the user can ask for the next one.
            Returns the edited rows.
         """
         editable_rows = [r for r in rows]
+        page_start = 0
         header_underline = "-".ljust(80, "-")
         row_format = "{index: >5}: {frow: <73s}"
         def validator(s):
@@ -1288,6 +1488,9 @@ class SimpleUI(BaseUI):
             elif s.startswith('c'):
                 action = 'c'
                 idx = None
+            elif s.startswith('n'):
+                action = 'n'
+                idx = None
             else:
                 action = 's'
                 idx = validators.int_in_range(s, 0, len(editable_rows)+1)
@@ -1299,13 +1502,16 @@ class SimpleUI(BaseUI):
                 print(row_format.format(index='Row #', frow=header))
                 print(header_underline)
                 if editable_rows:
-                    for i, r in enumerate(editable_rows):
+                    for i, r in enumerate(editable_rows[page_start:],
+                                          page_start):
                         print(row_format.format(index=i, frow=formatter(r)))
                 else:
                     print("(No %s data yet.)" % entity_type)
 
                 print("")
                 prompt = "Press Ctrl-C to end.\n"
+                if more:
+                    prompt += "Enter 'n' to show more %s data. " % entity_type
                 if creator:
                     prompt += "Enter 'c' to create a new %s. " % entity_type
                 if editor:
@@ -1317,6 +1523,7 @@ class SimpleUI(BaseUI):
                                entity_type)
                 prompt += "\nWhat do you want to do? "
                     
+                self.commit_if_due()
                 action, idx = typed_input(prompt, validator)
                 if action == 'e' and editor:
                     new_row = editor(editable_rows[idx])
@@ -1326,12 +1533,22 @@ class SimpleUI(BaseUI):
                     success = deleter(editable_rows[idx])
                     if success:
                         editable_rows.pop(idx)
+                        if idx < page_start:
+                            page_start -= 1
                     else:
                         print("Deletion unsuccessful.")
                 elif action == 'c' and creator: 
                     new_row = creator()
                     if new_row: # creator might return None
                         editable_rows.append(new_row)
+                elif action == 'n' and more:
+                    new_rows = more()
+                    if new_rows:
+                        page_start = len(editable_rows)
+                        editable_rows.extend(new_rows)
+                    else:
+                        print("No more %s data." % entity_type)
+                        more = None
                 elif action == 's' and selector:
                     should_exit = selector(editable_rows[idx])
                     if should_exit:
@@ -1477,6 +1694,28 @@ def file_path(s):
         raise ValueError("File path may not be empty")
     return os.path.abspath(os.path.expanduser(fp))
 
+def connection_profile(s):
+    """Ensure s names a database connection profile.
+       The empty string selects no profile (i.e., SQLite's defaults)."""
+    p = s.strip().lower()
+    if p and p not in db.PROFILES:
+        raise ValueError("Not a connection profile: %s" % s)
+    return p or None
+
+def positive_int(s):
+    "Convert s to a positive integer"
+    i = int(s)
+    if i <= 0:
+        raise ValueError("Not a positive integer: %s" % s)
+    return i
+
+def positive_float(s):
+    "Convert s to a positive floating-point number"
+    f = float(s)
+    if f <= 0:
+        raise ValueError("Not a positive number: %s" % s)
+    return f
+
 def yn_bool(s):
     """Convert a yes/no string to a boolean.
        Strings beginning with 'Y' and 'y' return True, with 'N' and 'n' return False."""
@@ -21,7 +21,7 @@ Basic report definitions.
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
 # 02110-1301, USA.
 
-import math, io
+import math, io, collections
 
 # support io.StringIO.write requiring unicode in Python 3
 def u(s):
@@ -55,22 +55,38 @@ class GradeReport(Report):
         self.db_connection = db_connection
 
     def run(self):
-        "Run the calculations for this report"
-        assignments = db.select_assignments(
-            self.db_connection,
-            course_id=self.course_id)
+        """Run the calculations for this report.
+           All data for the report is read from a single consistent
+           snapshot of the database (see db.read_transaction)."""
+        with db.read_transaction(self.db_connection):
+            self.course = db.select_courses(self.db_connection,
+                                            course_id=self.course_id)[0]
+            assignments = db.select_assignments(
+                self.db_connection,
+                course_id=self.course_id)
         
-        all_grades = db.select_grades_for_course_members(
-            self.db_connection,
-            course_id=self.course_id)
+            # the grades are summarized by SQLite, grouped by
+            # assignment and histogram bin, rather than fetched
+            distributions = collections.defaultdict(list)
+            for d in db.select_grade_distribution(self.db_connection,
+                                                  course_id=self.course_id):
+                distributions[d['assignment_id']].append(d)
+
+            self.students = db.select_students(self.db_connection,
+                                               course_id=self.course_id)
 
         stats = []
         for a in assignments:
-            grades = [g for g in all_grades if g['assignment_id'] == a['id']]
-            missing = [g['student_id'] for g in grades if g['grade_id'] is None]
+            groups = distributions[a['id']]
+            missing = []
+            for d in groups:
+                if d['missing'] and d['missing_students']:
+                    missing.extend(int(i) for i in
+                                   d['missing_students'].split(','))
             try:
-                mn, mx, avg, lavg = self.calculate_stats(grades)
-                hist = self.histogram(grades)
+                mn, mx, avg, lavg = self.calculate_stats(a['grade_type'],
+                                                         groups)
+                hist = self.histogram(a['grade_type'], groups)
                 stats.append({
                         'assignment_id': a['id'],
                         'assignment_name': a['name'],
@@ -96,19 +112,29 @@ class GradeReport(Report):
         self.stats = stats
         return stats
 
-    def calculate_stats(self, grades):
+    def calculate_stats(self, grade_type, groups):
         """Calculate summary statistics for the grades for a particular assignment.
+           groups should be the assignment's rows from
+           db.select_grade_distribution.
            Returns minimum, maximum, mean, and mean converted to a letter grade
            for a set of grades.
         """
-        values, weights, types, _ = ch.unpack_entered_grades(grades)
-        grade_type = types[0] # values are for single assignment and grade type
-        mn = ch.min_for_type(values, grade_type, filter_nan=True)
-        mx = ch.max_for_type(values, grade_type, filter_nan=True)
-        avg = ch.mean_for_type(values, grade_type, filter_nan=True)
+        if grade_type not in ['points', '4points', 'percentage', 'letter']:
+            raise ValueError("Unknown grade type: %s" % grade_type)
+        groups = [d for d in groups if d['num_values']]
+        if not groups:
+            raise ValueError("No grades have been entered for this assignment")
+
+        mn = min(d['min_value'] for d in groups)
+        mx = max(d['max_value'] for d in groups)
+        avg = (sum(d['sum_value'] for d in groups) /
+               sum(d['num_values'] for d in groups))
+        if grade_type == 'letter':
+            # letter grades are aggregated on the 4.0 scale
+            mn = ch.points_to_letter(mn)
+            mx = ch.points_to_letter(mx)
+
         letter_avg = None
-        if math.isnan(avg):
-            avg = None
         if avg:
             if grade_type == '4points' or grade_type == 'letter':
                 letter_avg = ch.points_to_letter(avg)
@@ -117,24 +143,34 @@ class GradeReport(Report):
        
         return mn, mx, avg, letter_avg
 
-    def histogram(self, grades):
-        "Produce a simple text histogram indicating an assignment's distribution of grades."
-        values, weights, types, _ = ch.unpack_entered_grades(grades)
-
-        if types[0] == 'letter': # values are for single assignment and grade type
+    def histogram(self, grade_type, groups):
+        """Produce a simple text histogram indicating an assignment's distribution of grades.
+           groups should be the assignment's rows from
+           db.select_grade_distribution."""
+        groups = [d for d in groups if not d['missing']]
+        if grade_type == 'letter':
             bins = [p[0] for p in ch.POINTS] # grade values in descending order
-            freqs = ch.freqs_for_letters(values)
+            freqs = dict((b, 0) for b in bins)
+            for d in groups:
+                if d['bin'] in freqs:
+                    freqs[d['bin']] += d['num_rows']
         else:
-            if types[0] == '4points':
+            if grade_type == '4points':
                 scale = ch.POINTS
-            elif types[0] == 'percentage':
+            elif grade_type == 'percentage':
                 scale = ch.PERCENTS
             else:
                 raise ValueError("Can't calculate histogram bins for assignment type %s" %
-                                 types[0])
+                                 grade_type)
             bins = [(p[2], p[3]) for p in scale]
             bins.pop(-1) # remove "dummy" limits bin with inf/-inf bounds 
-            freqs = ch.freqs_for_numbers(values, bins, filter_nan=True)
+            freqs = dict((b, 0) for b in bins)
+            for d in groups:
+                if d['bin'] is not None:
+                    freqs[bins[d['bin']]] += d['num_values']
+                elif d['num_values']:
+                    raise ValueError("Value %s did not fit in any bin!" %
+                                     (d['min_value'],))
 
         def bin_str(b):
             if isinstance(b, tuple):
@@ -173,8 +209,7 @@ class GradeReport(Report):
         
         output = io.StringIO()
 
-        course = db.select_courses(self.db_connection, course_id=self.course_id)[0]
-        output.write(u(title_template.format(**course)))
+        output.write(u(title_template.format(**self.course)))
         output.write(u(header))
         output.write(u(underline))
 
@@ -216,8 +251,7 @@ class GradeReport(Report):
         
         output = io.StringIO()
 
-        course = db.select_courses(self.db_connection, course_id=self.course_id)[0]
-        output.write(u(title_template.format(**course)))
+        output.write(u(title_template.format(**self.course)))
 
         for s in self.stats:
             if 'unavailable' in s:
@@ -226,10 +260,8 @@ class GradeReport(Report):
                         
             output.write(u(stats_template.format(**s)))
             if s['missing_students']:
-                students = db.select_students(self.db_connection,
-                                              course_id=self.course_id)
                 names = "\n".join(name_template.format(**stu)
-                                  for stu in students
+                                  for stu in self.students
                                   if stu['id'] in s['missing_students'])
                 output.write(u(missing_template.format(
                         num_missing=len(s['missing_students']),
@@ -0,0 +1,84 @@
+"""
+test_archive.py
+
+Tests for archiving semesters with db.archive_semesters
+"""
+# This file is part of the schoolutils package.
+# Copyright (C) 2013 Richard Lawrence <richard.lawrence@berkeley.edu>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import os, shutil, tempfile, unittest
+
+from schoolutils.grading import db
+
+class ArchiveSemestersTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.live_path = os.path.join(self.tmpdir, 'grades.db')
+        self.archive_path = os.path.join(self.tmpdir, 'archive.db')
+        self.conn = db.connect(self.live_path, create=True)
+        db.insert_sample_data(self.conn)
+        self.conn.commit()
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_archive_twice_into_same_file(self):
+        counts = db.archive_semesters(self.conn, self.archive_path,
+                                      [(2012, 'Spring')])
+        self.assertEqual(counts['courses'], 1)
+        archive = db.connect(self.archive_path, read_only=True)
+        archived_id = db.select_courses(archive)[0]['id']
+        archive.close()
+
+        # the live database reuses the archived course's id
+        course_id = db.create_course(self.conn, year=2013, semester='Fall',
+                                     name='Epistemology', number='133')
+        assignment_id = db.create_assignment(self.conn, course_id=course_id,
+                                             name='Paper', grade_type='letter',
+                                             weight=1)
+        db.create_course_member(self.conn, course_id=course_id, student_id=1)
+        db.create_grade(self.conn, assignment_id=assignment_id, student_id=1,
+                        value='A-')
+        self.conn.commit()
+        self.assertEqual(course_id, archived_id)
+
+        counts = db.archive_semesters(self.conn, self.archive_path,
+                                      [(2013, 'Fall')])
+        self.assertEqual(counts['courses'], 1)
+        self.assertEqual(counts['grades'], 1)
+
+        archive = db.connect(self.archive_path, read_only=True)
+        try:
+            courses = db.select_courses(archive)
+            self.assertEqual(sorted(c['name'] for c in courses),
+                             ['Epistemology', 'Introduction to logic'])
+            new_course = [c for c in courses if c['name'] == 'Epistemology'][0]
+            grades = db.select_grades(archive, course_id=new_course['id'])
+            self.assertEqual([g['value'] for g in grades], ['A-'])
+            # the student archived with both semesters is stored once
+            students = db.select_students(archive, sid='98765432')
+            self.assertEqual(len(students), 1)
+            self.assertEqual(grades[0]['student_id'], students[0]['id'])
+            self.assertEqual(
+                archive.execute("PRAGMA foreign_key_check;").fetchall(), [])
+        finally:
+            archive.close()
+
+if __name__ == '__main__':
+    unittest.main()